@@ -0,0 +1,186 @@
+"""Korpus sampel + microbenchmark parser webhook vs regex RX lama.
+
+Jalankan:  python bench_webhook_parser.py [--cepat]
+
+1. Cek kebenaran parse_pesan_webhook terhadap korpus sampel (hasil yang diharapkan).
+2. Bandingkan dengan RX lama pada sampel nyata (harus sama, kecuali yang ditandai)
+   dan pada pesan acak hasil fuzz dengan seed tetap.
+3. Ukur waktu keduanya pada sampel nyata dan pesan adversarial yang makin panjang.
+Exit code 1 bila ada sampel yang tidak sesuai.
+"""
+import random
+import re
+import sys
+import time
+
+from webhook_parser import PesanWebhook, parse_pesan_webhook
+
+# Regex lama dari bot_akrab_step_inline.py, disimpan hanya sebagai pembanding
+RX_LAMA = re.compile(
+    r'RC=(?P<reffid>[a-f0-9-]+)\s+TrxID=(?P<trxid>\d+)\s+'
+    r'(?P<produk>[A-Z0-9]+)\.(?P<tujuan>\d+)\s+'
+    r'(?P<status_text>[A-Za-z]+)\s*'
+    r'(?P<keterangan>.+?)'
+    r'(?:\s+Saldo[\s\S]*?)?'
+    r'(?:\bresult=(?P<status_code>\d+))?\s*>?$',
+    re.I
+)
+
+REF = "3f2a9c1e-7b4d-4e6a-9c0f-1a2b3c4d5e6f"
+
+
+def P(status, ket, code=None, produk="XLA14", tujuan="087812345678", trxid="99812345"):
+    return PesanWebhook(REF, trxid, produk, tujuan, status, ket, code)
+
+
+# (pesan, hasil yang diharapkan, sama_dengan_rx_lama)
+SAMPEL_NYATA = [
+    (f"RC={REF} TrxID=99812345 XLA14.087812345678 Sukses SN: 0512345678901234 Saldo 1.250.000 - 45.000 = 1.205.000 @14:02 result=0",
+     P("Sukses", "SN: 0512345678901234", "0"), True),
+    (f"RC={REF} TrxID=99812345 XLA14.087812345678 Gagal Nomor tujuan salah Saldo 1.205.000 result=1",
+     P("Gagal", "Nomor tujuan salah", "1"), True),
+    (f"RC={REF} TrxID=99812345 XLA14.087812345678 Diproses Menunggu respon operator",
+     P("Diproses", "Menunggu respon operator"), True),
+    (f"RC={REF} TrxID=99812345 XLA14.087812345678 Sukses SN:ABC123 result=0",
+     P("Sukses", "SN:ABC123", "0"), True),
+    (f"RC={REF} TrxID=99812345 XLA14.087812345678 Sukses SN:ABC123 >",
+     P("Sukses", "SN:ABC123"), True),
+    (f"RC={REF} TrxID=99812345 XLA14.087812345678 Sukses SN:ABC123 result=0 >\n",
+     P("Sukses", "SN:ABC123", "0"), True),
+    (f"RC={REF} TrxID=99812345 XLA14.087812345678 Sukses SN:ABC123\nSaldo 100.000\nTerima kasih result=0",
+     P("Sukses", "SN:ABC123", "0"), True),
+    (f"RC={REF.upper()} TrxID=99812345 xla14.087812345678 SUKSES sn 123 saldo 5000",
+     PesanWebhook(REF.upper(), "99812345", "xla14", "087812345678", "SUKSES", "sn 123", None), True),
+    (f"RC={REF} TrxID=1 BPAL3.0859 Gagal Stok kosong. Saldo 20.000 result=2",
+     P("Gagal", "Stok kosong.", "2", produk="BPAL3", tujuan="0859", trxid="1"), True),
+    (f"RC={REF} TrxID=99812345 XLA14.087812345678 Sukses Saldo 100.000",
+     P("Sukses", "Saldo 100.000"), True),
+    (f"RC={REF} TrxID=99812345 XLA14.087812345678 Gagal Dibatalkan (result=3)",
+     P("Gagal", "Dibatalkan (result=3)"), True),
+    (f"RC={REF} TrxID=99812345 XLA14.087812345678 Sukses tanpa-kode xresult=7",
+     P("Sukses", "tanpa-kode xresult=7"), True),
+    (f"RC={REF} TrxID=99812345 XLA14.087812345678 Gagal\nSaldo 20.000\nresult=1",
+     P("Gagal", "", "1"), False),
+    # RX lama memotong huruf terakhir status jadi keterangan ("Sukse" + "s"); parser baru tidak
+    (f"RC={REF} TrxID=99812345 XLA14.087812345678 Sukses",
+     P("Sukses", ""), False),
+]
+
+# Pesan yang harus ditolak (None)
+SAMPEL_DITOLAK = [
+    "",
+    "halo",
+    "RC= TrxID=1 X.1 Sukses ok",
+    f"RC={REF} TrxID=abc XLA14.0878 Sukses ok",
+    f"RC={REF} TrxID=1 XLA14-0878 Sukses ok",
+    f"RC={REF} TrxID=1 XLA14.0878 123 ok",
+    f"RC={REF} TrxID=1 XLA14.0878 Sukses baris satu\nbaris dua",
+    f"x RC={REF} TrxID=1 XLA14.0878 Sukses ok",
+]
+
+KEPALA = f"RC={REF} TrxID=99812345 XLA14.087812345678 "
+
+
+def sampel_adversarial(n):
+    """Pesan yang membuat RX lama backtracking kuadratik."""
+    return {
+        "spasi panjang": KEPALA + "Sukses a" + " " * n + "b",
+        "spasi + newline": KEPALA + "Sukses a" + " " * n + "b\nx",
+        "tab/spasi": KEPALA + "Sukses a" + "\t " * (n // 2) + "!",
+        "status panjang": KEPALA + "S" * n + " a\nb",
+        "saldo berulang": KEPALA + "Sukses ok" + " Saldo" * (n // 6) + " result=0",
+        "spasi sebelum saldo": KEPALA + "Sukses ok" + (" " * 50 + "saldo") * (n // 55),
+    }
+
+
+# Potongan pembentuk pesan fuzz: spasi/newline, kata kunci, angka, karakter batas kata
+TOKEN_FUZZ = [" ", "  ", "\t", "\n", "\r", "Saldo", "saldo", "SALDO", "result=", "result=0",
+              "12", "a", "x", ">", "_", ".", "(", "\u00e9"]
+
+
+def sampel_fuzz(jumlah, seed=15):
+    acak = random.Random(seed)
+    for _ in range(jumlah):
+        status = acak.choice(["Sukses", "Gagal", "S", ""])
+        ekor = "".join(acak.choice(TOKEN_FUZZ) for _ in range(acak.randint(0, 8)))
+        yield KEPALA + status + ekor
+
+
+def beda_disengaja(baru, lama):
+    """Keterangan kosong: RX lama gagal atau memotong huruf terakhir status, parser baru tidak."""
+    if baru is None or baru.keterangan:
+        return False
+    return (lama is None or lama.status_text != baru.status_text
+            or lama.keterangan in ("", baru.status_text[-1:]))
+
+
+def dari_rx(match):
+    if not match:
+        return None
+    g = match.groupdict()
+    return PesanWebhook(g["reffid"], g["trxid"], g["produk"], g["tujuan"],
+                        g["status_text"], (g["keterangan"] or "").strip(), g["status_code"])
+
+
+def ukur(fungsi, pesan, ulang):
+    mulai = time.perf_counter()
+    for _ in range(ulang):
+        fungsi(pesan)
+    return (time.perf_counter() - mulai) / ulang
+
+
+def cek_kebenaran():
+    gagal = 0
+    for pesan, harapan, sama_rx in SAMPEL_NYATA:
+        hasil = parse_pesan_webhook(pesan)
+        if hasil != harapan:
+            gagal += 1
+            print(f"[SALAH] {pesan!r}\n  dapat   : {hasil}\n  harapan : {harapan}")
+        lama = dari_rx(RX_LAMA.match(pesan))
+        if sama_rx and lama != hasil:
+            gagal += 1
+            print(f"[BEDA RX] {pesan!r}\n  parser : {hasil}\n  rx lama: {lama}")
+    for pesan in SAMPEL_DITOLAK:
+        hasil = parse_pesan_webhook(pesan)
+        if hasil is not None:
+            gagal += 1
+            print(f"[HARUS DITOLAK] {pesan!r} -> {hasil}")
+    for n in (200, 1000):
+        for nama, pesan in sampel_adversarial(n).items():
+            hasil, lama = parse_pesan_webhook(pesan), dari_rx(RX_LAMA.match(pesan))
+            if hasil != lama:
+                gagal += 1
+                print(f"[BEDA RX] adversarial '{nama}' n={n}\n  parser : {hasil}\n  rx lama: {lama}")
+    jumlah_fuzz = 20000
+    for pesan in sampel_fuzz(jumlah_fuzz):
+        hasil, lama = parse_pesan_webhook(pesan), dari_rx(RX_LAMA.match(pesan))
+        if hasil != lama and not beda_disengaja(hasil, lama):
+            gagal += 1
+            print(f"[BEDA RX] fuzz {pesan!r}\n  parser : {hasil}\n  rx lama: {lama}")
+    total = len(SAMPEL_NYATA) + len(SAMPEL_DITOLAK)
+    print(f"Kebenaran: {total} sampel + adversarial + {jumlah_fuzz} fuzz, {gagal} tidak sesuai")
+    return gagal
+
+
+def benchmark(cepat=False):
+    print("\nSampel nyata (rata-rata per pesan):")
+    t_baru = sum(ukur(parse_pesan_webhook, p, 2000) for p, _, _ in SAMPEL_NYATA)
+    t_lama = sum(ukur(RX_LAMA.match, p, 2000) for p, _, _ in SAMPEL_NYATA)
+    n = len(SAMPEL_NYATA)
+    print(f"  parser : {t_baru / n * 1e6:8.2f} us")
+    print(f"  rx lama: {t_lama / n * 1e6:8.2f} us")
+
+    ukuran = (1000, 2000, 4000) if cepat else (1000, 2000, 4000, 8000)
+    print("\nAdversarial (ms per pesan):")
+    print(f"  {'pola':<22}{'n':>6}{'parser':>10}{'rx lama':>12}")
+    for n in ukuran:
+        for nama, pesan in sampel_adversarial(n).items():
+            t_baru = ukur(parse_pesan_webhook, pesan, 20)
+            t_lama = ukur(RX_LAMA.match, pesan, 1)
+            print(f"  {nama:<22}{n:>6}{t_baru * 1e3:>10.3f}{t_lama * 1e3:>12.1f}")
+
+
+if __name__ == "__main__":
+    gagal = cek_kebenaran()
+    benchmark(cepat="--cepat" in sys.argv)
+    sys.exit(1 if gagal else 0)
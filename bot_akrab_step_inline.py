@@ -1,4 +1,7 @@
-import os, json, uuid, base64, logging, sqlite3, time, threading, random, re
+import os, json, uuid, base64, logging, sqlite3, time, threading, random, re, itertools, html, queue, secrets
+import csv, io, hashlib, hmac, weakref
+from collections import deque, OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
 from telegram import (
     Update, InlineKeyboardButton, InlineKeyboardMarkup, ParseMode, InputMediaPhoto
@@ -6,8 +9,18 @@ from telegram import (
 from telegram.ext import (
     Updater, CommandHandler, CallbackQueryHandler, MessageHandler, Filters, ConversationHandler, CallbackContext,
 )
+from telegram.error import RetryAfter, Unauthorized, BadRequest, TelegramError
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, request, jsonify
+from webhook_parser import parse_pesan_webhook
+import qris
+try:
+    from waitress import serve as waitress_serve
+except ImportError:
+    waitress_serve = None
 
 # Load configuration
 try:
@@ -29,6 +42,34 @@ WEBHOOK_URL = cfg["WEBHOOK_URL"]
 WEBHOOK_PORT = cfg["WEBHOOK_PORT"]
 LOG_FILE = 'bot_error.log'
 
+# Broadcast: batas kirim global (pesan/detik) dan per chat, bisa diatur di config.json
+BROADCAST_RATE = float(cfg.get("BROADCAST_RATE", 25))
+BROADCAST_PER_CHAT_RATE = float(cfg.get("BROADCAST_PER_CHAT_RATE", 1))
+BROADCAST_WORKERS = int(cfg.get("BROADCAST_WORKERS", 8))
+BROADCAST_BATCH = 100  # jumlah penerima per batch; cursor disimpan setelah setiap batch
+BROADCAST_PROGRESS_INTERVAL = 5  # detik antar update progres ke admin
+BROADCAST_MAX_RETRY = 3
+
+ORDER_WORKERS = int(cfg.get("ORDER_WORKERS", 4))  # thread yang mengirim order ke provider
+
+WEBHOOK_THREADS = int(cfg.get("WEBHOOK_THREADS", 8))  # thread waitress untuk endpoint webhook
+WEBHOOK_BATCH = 50  # pesan inbox yang diproses per transaksi
+WEBHOOK_INBOX_RETENSI_HARI = 7  # pesan inbox yang sudah diproses dihapus setelah ini
+# Jeda (detik) sebelum pesan yang RefID-nya belum ditemukan dicoba lagi; setelah habis ditandai gagal
+WEBHOOK_ULANG_DETIK = (10, 30, 60, 300, 900)
+NOTIF_RATE = 20  # pesan/detik untuk notifikasi user dari webhook
+# Notifikasi top up ke admin digabung jadi satu ringkasan per interval (detik); 0 = kirim per event
+ADMIN_DIGEST_INTERVAL = int(cfg.get("ADMIN_DIGEST_INTERVAL", 60))
+ADMIN_DIGEST_MAX_BARIS = 15  # event terbaru yang dirinci di pesan ringkasan
+
+# Rekonsiliasi transaksi yang tetap PENDING karena webhook tidak pernah datang
+REKON_INTERVAL = 300  # detik antar putaran rekonsiliasi
+REKON_UMUR_MIN = int(cfg.get("REKON_UMUR_MIN", 900))  # detik; transaksi lebih muda masih ditunggu webhook-nya
+REKON_WORKERS = int(cfg.get("REKON_WORKERS", 4))  # request cek status paralel ke provider
+REKON_BATCH = 50  # transaksi per batch; hasilnya diterapkan dalam satu transaksi database
+REKON_LAPOR_INTERVAL = 6 * 3600  # jeda minimal antar laporan otomatis ke admin
+STATUS_PATH = cfg.get("STATUS_PATH", "status")  # endpoint cek status transaksi di BASE_URL
+
 # Setup logging
 logging.basicConfig(
     filename=LOG_FILE, 
@@ -37,224 +78,1105 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Cache untuk data produk
-produk_cache = {
-    "data": [],
-    "last_updated": 0,
-    "update_in_progress": False
-}
-
-CACHE_DURATION = 300  # 5 menit
+CACHE_DURATION = 300  # 5 menit; katalog lebih tua dari ini ditandai "stale"
+KATALOG_REFRESH_INTERVAL = 60  # refresh katalog di JobQueue setiap 1 menit
+KATALOG_SNAPSHOT_FILE = "katalog_snapshot.json"  # katalog terakhir yang valid, dimuat saat boot
+PRODUK_PER_PAGE = 20  # jumlah tombol produk per halaman keyboard
+RIWAYAT_PER_PAGE = 10  # jumlah transaksi per halaman riwayat
+USER_PER_PAGE = 20  # jumlah tombol user per halaman direktori admin
+MAX_MSG_CHARS = 3800  # batas aman panjang pesan (limit Telegram 4096 karakter)
+STOK_WAIT_DEADLINE = 12  # batas waktu pemanggil menunggu fetch yang sedang berjalan
+KODE_UNIK_ALFABET = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789"  # tanpa 0/O/1/I supaya tidak salah ketik
+KODE_UNIK_PANJANG = 10  # 32^10 ~ 10^15 kemungkinan kode
+KODE_UNIK_MAX_BATCH = 100  # kode per sekali generate admin
+KODE_UNIK_MAX_GAGAL = 5  # percobaan kode salah per user sebelum diblokir sementara
+KODE_UNIK_BLOKIR_DETIK = 600
+TOPUP_KODE_MIN, TOPUP_KODE_MAX = 100, 999  # rentang angka unik yang ditambahkan ke nominal top up QRIS
+# Sweeper: top up pending tanpa bukti kedaluwarsa setelah TTL; data final lama dipindah ke tabel arsip
+TOPUP_TTL_MENIT = int(cfg.get("TOPUP_TTL_MENIT", 180))
+# Nominal top up yang kedaluwarsa/dibatalkan belum dipakai ulang selama sekian menit setelah TTL,
+# karena user bisa saja tetap mentransfer nominal lama tersebut
+TOPUP_JEDA_NOMINAL_MENIT = int(cfg.get("TOPUP_JEDA_NOMINAL_MENIT", 1440))
+ARSIP_HARI = int(cfg.get("ARSIP_HARI", 30))
+RIWAYAT_ARSIP_HARI = int(cfg.get("RIWAYAT_ARSIP_HARI", 90))
+USER_CACHE_MAX = int(cfg.get("USER_CACHE_MAX", 10000))  # jumlah user (dan saldonya) yang disimpan di memori
+SWEEPER_INTERVAL = 600  # detik antar putaran sweeper
+SWEEPER_BATCH = 500  # baris per transaksi, supaya penulis lain tidak tertahan lama
+TOPUP_STATUS_FINAL = ("approved", "rejected", "expired", "batal")
+MUTASI_TOKEN = cfg.get("MUTASI_TOKEN", "")  # token header X-Token untuk endpoint /mutasi; kosong = nonaktif
+QRIS_CACHE_BYTES = int(float(cfg.get("QRIS_CACHE_MB", 8)) * 1024 * 1024)  # batas memori cache gambar QRIS
 
 # Database setup
 DBNAME = "botdata.db"
-def get_conn(): 
-    return sqlite3.connect(DBNAME, check_same_thread=False)
+DB_BUSY_TIMEOUT_MS = 5000       # tunggu lock maksimal 5 detik sebelum "database is locked"
+DB_CACHE_SIZE_KB = 8192         # page cache per koneksi
+DB_CACHED_STATEMENTS = 256      # jumlah prepared statement yang disimpan per koneksi
+# Riwayat transaksi lama disimpan per bulan di file terpisah (di-ATTACH sebagai "arsip"),
+# supaya file utama, page cache dan backup-nya tidak ikut membesar seiring volume
+DBNAME_ARSIP = cfg.get("DB_ARSIP", "botdata_arsip.db")
+
+# Satu koneksi per thread (worker dispatcher PTB, thread Flask, dsb.) dipakai ulang
+# selama thread hidup, bukan connect/close di setiap query. Koneksi ditutup saat thread
+# selesai: isi threading.local dibuang dan finalizer _KoneksiThread menutup koneksinya.
+_db_local = threading.local()
+_db_koneksi = weakref.WeakSet()  # hanya untuk close_all_conn(), tidak menahan koneksi tetap hidup
+
+class _KoneksiThread:
+    def __init__(self, conn):
+        self.conn = conn
+        self.tutup = weakref.finalize(self, conn.close)
+
+def _open_conn():
+    conn = sqlite3.connect(
+        DBNAME,
+        timeout=DB_BUSY_TIMEOUT_MS / 1000,
+        isolation_level=None,  # transaksi dikelola manual lewat db_transaksi()
+        check_same_thread=False,
+        cached_statements=DB_CACHED_STATEMENTS,
+    )
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("ATTACH DATABASE ? AS arsip", (DBNAME_ARSIP,))
+    conn.execute("PRAGMA arsip.journal_mode=WAL")
+    conn.execute("PRAGMA arsip.synchronous=NORMAL")
+    return conn
+
+def get_conn():
+    koneksi = getattr(_db_local, "koneksi", None)
+    if koneksi is None:
+        koneksi = _KoneksiThread(_open_conn())
+        _db_koneksi.add(koneksi)
+        _db_local.koneksi = koneksi
+        _db_local.depth = 0
+    return koneksi.conn
+
+# Satu transaksi per koneksi thread; transaksi bersarang ikut yang terluar, hook setelah_commit jalan setelah commit
+@contextmanager
+def db_transaksi(immediate=False):
+    conn = get_conn()
+    if _db_local.depth > 0:
+        _db_local.depth += 1
+        try:
+            yield conn.cursor()
+        finally:
+            _db_local.depth -= 1
+        return
+    conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+    _db_local.depth = 1
+    _db_local.setelah_commit = []
+    try:
+        yield conn.cursor()
+        conn.execute("COMMIT")
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        _db_local.depth = 0
+        hooks, _db_local.setelah_commit = _db_local.setelah_commit, []
+    for fungsi in hooks:
+        fungsi()
+
+def dalam_transaksi():
+    return getattr(_db_local, "depth", 0) > 0
+
+# Jalankan fungsi setelah transaksi thread ini commit (langsung bila di luar transaksi)
+def setelah_commit(fungsi):
+    if dalam_transaksi():
+        _db_local.setelah_commit.append(fungsi)
+    else:
+        fungsi()
+
+# SAVEPOINT di dalam transaksi berjalan; bila gagal hanya blok ini (dan hook-nya) yang dibatalkan
+@contextmanager
+def db_savepoint(nama):
+    conn = get_conn()
+    jumlah_hook = len(_db_local.setelah_commit)
+    conn.execute(f"SAVEPOINT {nama}")
+    try:
+        yield
+    except BaseException:
+        conn.execute(f"ROLLBACK TO {nama}")
+        conn.execute(f"RELEASE {nama}")
+        del _db_local.setelah_commit[jumlah_hook:]
+        raise
+    conn.execute(f"RELEASE {nama}")
+
+def close_all_conn():
+    for koneksi in list(_db_koneksi):
+        try:
+            koneksi.tutup()
+        except Exception:
+            pass
 
 def init_db():
+    with db_transaksi() as c:
+        c.execute("""CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY, username TEXT, nama TEXT)""")
+        c.execute("""CREATE TABLE IF NOT EXISTS saldo (
+            user_id INTEGER PRIMARY KEY, saldo INTEGER DEFAULT 0)""")
+        c.execute("""CREATE TABLE IF NOT EXISTS riwayat_transaksi (
+            id TEXT PRIMARY KEY, user_id INTEGER, produk TEXT, tujuan TEXT, harga INTEGER, waktu TEXT, status_text TEXT, keterangan TEXT)""")
+        c.execute("""CREATE TABLE IF NOT EXISTS topup_pending (
+            id TEXT PRIMARY KEY, user_id INTEGER, username TEXT, nama TEXT, nominal INTEGER, waktu TEXT, status TEXT, bukti_file_id TEXT, bukti_caption TEXT)""")
+        c.execute("""CREATE TABLE IF NOT EXISTS produk_admin (
+            kode TEXT PRIMARY KEY, harga INTEGER, deskripsi TEXT
+        )""")
+        c.execute("""CREATE TABLE IF NOT EXISTS kode_unik_topup (
+            kode TEXT PRIMARY KEY, 
+            user_id INTEGER, 
+            nominal INTEGER, 
+            digunakan INTEGER DEFAULT 0,
+            dibuat_pada TEXT,
+            digunakan_pada TEXT
+        )""")
+        # Jurnal setiap perubahan saldo. (ref, jenis) unik supaya retry tidak diterapkan dua kali.
+        c.execute("""CREATE TABLE IF NOT EXISTS saldo_mutasi (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            ref TEXT,
+            jenis TEXT,
+            jumlah INTEGER,
+            saldo_akhir INTEGER,
+            waktu TEXT,
+            UNIQUE (ref, jenis)
+        )""")
+    run_migrations()
+
+def _fts5_tersedia(c):
+    return any(row[0] == "ENABLE_FTS5" for row in c.execute("PRAGMA compile_options").fetchall())
+
+def _buat_index_cari_user(c):
+    if not _fts5_tersedia(c):
+        c.execute("CREATE INDEX IF NOT EXISTS idx_users_nama ON users (nama COLLATE NOCASE)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users (username COLLATE NOCASE)")
+        return
+    # rowid users_fts = users.id; uid disimpan sebagai teks supaya ID bisa dicari dengan prefix
+    c.execute("CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(nama, username, uid)")
+    c.execute("""CREATE TRIGGER IF NOT EXISTS users_fts_ai AFTER INSERT ON users BEGIN
+        INSERT INTO users_fts (rowid, nama, username, uid) VALUES (new.id, new.nama, new.username, CAST(new.id AS TEXT));
+    END""")
+    _buat_trigger_fts_update(c)
+    c.execute("""CREATE TRIGGER IF NOT EXISTS users_fts_ad AFTER DELETE ON users BEGIN
+        DELETE FROM users_fts WHERE rowid=old.id;
+    END""")
+    c.execute("""INSERT INTO users_fts (rowid, nama, username, uid)
+        SELECT id, nama, username, CAST(id AS TEXT) FROM users""")
+
+def _buat_trigger_fts_update(c):
+    # Hanya saat nama/username berubah; update lain (mis. diblokir saat broadcast) tidak menyentuh FTS
+    c.execute("""CREATE TRIGGER IF NOT EXISTS users_fts_au AFTER UPDATE OF nama, username ON users BEGIN
+        UPDATE users_fts SET nama=new.nama, username=new.username WHERE rowid=new.id;
+    END""")
+
+def _perbaiki_trigger_fts_update(c):
+    if c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='users_fts'").fetchone():
+        c.execute("DROP TRIGGER IF EXISTS users_fts_au")
+        _buat_trigger_fts_update(c)
+
+# Migrasi skema berurutan; versi yang sudah diterapkan disimpan di PRAGMA user_version.
+# Setiap item berisi SQL (str) atau fungsi yang menerima cursor. Jangan ubah migrasi lama,
+# selalu tambahkan migrasi baru di akhir list.
+# Transaksi yang belum sukses/gagal/batal; sama dengan pengecekan status_final()
+RIWAYAT_BELUM_FINAL = ("status_text NOT LIKE '%sukses%' AND status_text NOT LIKE '%gagal%'"
+                       " AND status_text NOT LIKE '%batal%'")
+
+MIGRATIONS = [
+    # 1: index untuk query riwayat, top up, kode unik dan mutasi saldo
+    [
+        "CREATE INDEX IF NOT EXISTS idx_riwayat_user_waktu ON riwayat_transaksi (user_id, waktu)",
+        "CREATE INDEX IF NOT EXISTS idx_riwayat_waktu ON riwayat_transaksi (waktu)",
+        "CREATE INDEX IF NOT EXISTS idx_topup_status_waktu ON topup_pending (status, waktu)",
+        "CREATE INDEX IF NOT EXISTS idx_topup_user_waktu ON topup_pending (user_id, waktu)",
+        "CREATE INDEX IF NOT EXISTS idx_kode_unik_user_dibuat ON kode_unik_topup (user_id, dibuat_pada)",
+        "CREATE INDEX IF NOT EXISTS idx_mutasi_user ON saldo_mutasi (user_id, id)",
+    ],
+    # 2: ringkasan per user di tabel saldo supaya dashboard cukup satu lookup primary key
+    [
+        "ALTER TABLE saldo ADD COLUMN jml_transaksi INTEGER DEFAULT 0",
+        "ALTER TABLE saldo ADD COLUMN terakhir_aktif TEXT",
+        "INSERT OR IGNORE INTO saldo (user_id, saldo) SELECT DISTINCT user_id, 0 FROM riwayat_transaksi",
+        """UPDATE saldo SET
+            jml_transaksi = (SELECT COUNT(*) FROM riwayat_transaksi r WHERE r.user_id = saldo.user_id),
+            terakhir_aktif = (SELECT MAX(waktu) FROM riwayat_transaksi r WHERE r.user_id = saldo.user_id)""",
+    ],
+    # 3: index (waktu, id) untuk keyset pagination riwayat; menggantikan index dari migrasi 1
+    [
+        "CREATE INDEX IF NOT EXISTS idx_riwayat_user_waktu_id ON riwayat_transaksi (user_id, waktu, id)",
+        "CREATE INDEX IF NOT EXISTS idx_riwayat_waktu_id ON riwayat_transaksi (waktu, id)",
+        "DROP INDEX IF EXISTS idx_riwayat_user_waktu",
+        "DROP INDEX IF EXISTS idx_riwayat_waktu",
+    ],
+    # 4: index pencarian user (FTS5 jika tersedia, selain itu index prefix biasa)
+    [
+        _buat_index_cari_user,
+    ],
+    # 5: job broadcast yang bisa dilanjutkan setelah restart, dan penanda user yang memblokir bot
+    [
+        "ALTER TABLE users ADD COLUMN diblokir INTEGER DEFAULT 0",
+        """CREATE TABLE IF NOT EXISTS broadcast_job (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER,
+            progress_message_id INTEGER,
+            teks TEXT,
+            status TEXT,
+            cursor_user_id INTEGER DEFAULT 0,
+            total INTEGER DEFAULT 0,
+            terkirim INTEGER DEFAULT 0,
+            gagal INTEGER DEFAULT 0,
+            diblokir INTEGER DEFAULT 0,
+            dibuat_pada TEXT,
+            selesai_pada TEXT
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_broadcast_status ON broadcast_job (status)",
+    ],
+    # 6: antrean order pembelian (QUEUED -> SUBMITTED -> PENDING -> SUCCESS/FAILED)
+    [
+        """CREATE TABLE IF NOT EXISTS orders (
+            reffid TEXT PRIMARY KEY,
+            user_id INTEGER,
+            produk TEXT,
+            nama_produk TEXT,
+            tujuan TEXT,
+            harga INTEGER,
+            status TEXT,
+            keterangan TEXT,
+            chat_id INTEGER,
+            message_id INTEGER,
+            dibuat_pada TEXT,
+            diperbarui_pada TEXT
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_orders_status ON orders (status, dibuat_pada)",
+    ],
+    # 7: inbox webhook; pesan disimpan dulu, diproses consumer secara batch
+    [
+        """CREATE TABLE IF NOT EXISTS webhook_inbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            message TEXT,
+            status TEXT DEFAULT 'baru',
+            hasil TEXT,
+            diterima_pada TEXT,
+            diproses_pada TEXT
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_inbox_status ON webhook_inbox (status, id)",
+    ],
+    # 8: partial index transaksi belum final untuk rekonsiliasi dan laporan umur
+    [
+        f"CREATE INDEX IF NOT EXISTS idx_riwayat_belum_final ON riwayat_transaksi (waktu, id) WHERE {RIWAYAT_BELUM_FINAL}",
+    ],
+    # 9: pencocokan otomatis top up: index nominal top up yang masih pending dan jurnal mutasi masuk
+    [
+        "CREATE INDEX IF NOT EXISTS idx_topup_pending_nominal ON topup_pending (nominal) WHERE status='pending'",
+        """CREATE TABLE IF NOT EXISTS mutasi_masuk (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sumber TEXT,
+            ref TEXT,
+            nominal INTEGER,
+            keterangan TEXT,
+            status TEXT,
+            topup_id TEXT,
+            diterima_pada TEXT,
+            UNIQUE (sumber, ref)
+        )""",
+    ],
+    # 10: tabel arsip top up dan kode unik yang sudah final, supaya tabel utama tetap kecil
+    [
+        """CREATE TABLE IF NOT EXISTS topup_pending_arsip (
+            id TEXT PRIMARY KEY, user_id INTEGER, username TEXT, nama TEXT, nominal INTEGER, waktu TEXT,
+            status TEXT, bukti_file_id TEXT, bukti_caption TEXT, diarsipkan_pada TEXT)""",
+        """CREATE TABLE IF NOT EXISTS kode_unik_topup_arsip (
+            kode TEXT PRIMARY KEY, user_id INTEGER, nominal INTEGER, digunakan INTEGER,
+            dibuat_pada TEXT, digunakan_pada TEXT, diarsipkan_pada TEXT)""",
+        "CREATE INDEX IF NOT EXISTS idx_kode_unik_digunakan ON kode_unik_topup (digunakan, digunakan_pada)",
+    ],
+    # 11: kolom epoch (INTEGER) pendamping kolom waktu TEXT beserta index-nya. Data lama diisi
+    # bertahap oleh job_backfill_epoch; progresnya disimpan di backfill_epoch.
+    [
+        "ALTER TABLE riwayat_transaksi ADD COLUMN waktu_epoch INTEGER",
+        "ALTER TABLE topup_pending ADD COLUMN waktu_epoch INTEGER",
+        "ALTER TABLE kode_unik_topup ADD COLUMN dibuat_epoch INTEGER",
+        "ALTER TABLE kode_unik_topup ADD COLUMN digunakan_epoch INTEGER",
+        "ALTER TABLE topup_pending_arsip ADD COLUMN waktu_epoch INTEGER",
+        "ALTER TABLE kode_unik_topup_arsip ADD COLUMN dibuat_epoch INTEGER",
+        "ALTER TABLE kode_unik_topup_arsip ADD COLUMN digunakan_epoch INTEGER",
+        "CREATE INDEX IF NOT EXISTS idx_riwayat_user_epoch_id ON riwayat_transaksi (user_id, waktu_epoch, id)",
+        "CREATE INDEX IF NOT EXISTS idx_riwayat_epoch_id ON riwayat_transaksi (waktu_epoch, id)",
+        f"CREATE INDEX IF NOT EXISTS idx_riwayat_belum_final_epoch ON riwayat_transaksi (waktu_epoch, id) WHERE {RIWAYAT_BELUM_FINAL}",
+        "CREATE INDEX IF NOT EXISTS idx_topup_status_epoch ON topup_pending (status, waktu_epoch)",
+        "CREATE INDEX IF NOT EXISTS idx_topup_user_epoch ON topup_pending (user_id, waktu_epoch)",
+        "CREATE INDEX IF NOT EXISTS idx_kode_unik_user_epoch ON kode_unik_topup (user_id, dibuat_epoch)",
+        "CREATE INDEX IF NOT EXISTS idx_kode_unik_digunakan_epoch ON kode_unik_topup (digunakan, digunakan_epoch)",
+        """CREATE TABLE IF NOT EXISTS backfill_epoch (
+            target TEXT PRIMARY KEY,
+            posisi INTEGER DEFAULT 0,
+            selesai INTEGER DEFAULT 0
+        )""",
+    ],
+    # 12: trigger FTS users hanya untuk perubahan nama/username
+    [
+        _perbaiki_trigger_fts_update,
+    ],
+    # 13: pesan webhook yang RefID-nya belum ada dicoba ulang dengan jeda
+    [
+        "ALTER TABLE webhook_inbox ADD COLUMN percobaan INTEGER DEFAULT 0",
+        "ALTER TABLE webhook_inbox ADD COLUMN coba_lagi_pada INTEGER",
+    ],
+]
+
+# Kolom waktu TEXT ("%Y-%m-%d %H:%M:%S", waktu lokal) dan kolom epoch pendampingnya. Semua penulis
+# mengisi keduanya; query memakai kolom epoch setelah backfill data lama selesai (_epoch["aktif"]).
+FORMAT_WAKTU = "%Y-%m-%d %H:%M:%S"
+KOLOM_EPOCH = {"waktu": "waktu_epoch", "dibuat_pada": "dibuat_epoch", "digunakan_pada": "digunakan_epoch"}
+BACKFILL_EPOCH = [("riwayat_transaksi", "waktu"), ("topup_pending", "waktu"),
+                  ("kode_unik_topup", "dibuat_pada"), ("kode_unik_topup", "digunakan_pada"),
+                  ("topup_pending_arsip", "waktu"), ("kode_unik_topup_arsip", "dibuat_pada"),
+                  ("kode_unik_topup_arsip", "digunakan_pada")]
+# Index kolom TEXT yang digantikan index epoch dari migrasi 11; dihapus setelah backfill selesai
+INDEX_WAKTU_TEKS = ["idx_riwayat_user_waktu_id", "idx_riwayat_waktu_id", "idx_riwayat_belum_final",
+                    "idx_topup_status_waktu", "idx_topup_user_waktu", "idx_kode_unik_user_dibuat",
+                    "idx_kode_unik_digunakan"]
+BACKFILL_BATCH = 2000  # baris per transaksi backfill
+BACKFILL_INTERVAL = 2  # detik antar putaran job_backfill_epoch
+BACKFILL_DURASI = 0.5  # detik kerja maksimal per putaran
+_epoch = {"aktif": False}
+
+# Nama kolom waktu dan nilai pembanding tiap ts (detik epoch), sesuai mode saat ini
+def kolom_waktu(kolom, *ts):
+    if _epoch["aktif"]:
+        return (KOLOM_EPOCH[kolom], *(int(t) for t in ts))
+    return (kolom, *(datetime.fromtimestamp(t).strftime(FORMAT_WAKTU) for t in ts))
+
+# Detik epoch dari string FORMAT_WAKTU (waktu lokal), sama dengan strftime('%s', waktu, 'utc')
+def epoch_dari_teks(waktu):
+    try:
+        return int(time.mktime(time.strptime(waktu, FORMAT_WAKTU)))
+    except (TypeError, ValueError):
+        return None
+
+def get_schema_version():
+    return get_conn().execute("PRAGMA user_version").fetchone()[0]
+
+def run_migrations():
+    while True:
+        with db_transaksi(immediate=True) as c:
+            # Dibaca di dalam transaksi immediate (koneksi yang sama), jadi tidak balapan dengan proses lain
+            versi = get_schema_version()
+            if versi >= len(MIGRATIONS):
+                return
+            for step in MIGRATIONS[versi]:
+                if callable(step):
+                    step(c)
+                else:
+                    c.execute(step)
+            c.execute(f"PRAGMA user_version={versi + 1}")
+        logger.info(f"Migrasi database ke versi {versi + 1} selesai")
+
+def hot_queries():
+    # Query yang paling sering dipanggil, memakai kolom waktu sesuai mode saat ini (TEXT selama backfill)
+    w, t = kolom_waktu("waktu", 0)
+    d, _ = kolom_waktu("dibuat_pada", 0)
+    return [
+        ("get_riwayat_user", f"SELECT * FROM riwayat_transaksi WHERE user_id=? ORDER BY {w} DESC LIMIT ?", (0, 10)),
+        ("get_ringkasan_user", "SELECT saldo, jml_transaksi, terakhir_aktif FROM saldo WHERE user_id=?", (0,)),
+        ("get_all_riwayat", f"SELECT * FROM riwayat_transaksi ORDER BY {w} DESC LIMIT ?", (10,)),
+        ("get_riwayat_user_page", f"""SELECT * FROM riwayat_transaksi WHERE user_id=? AND ({w}, id) < (?, ?)
+            ORDER BY {w} DESC, id DESC LIMIT ?""", (0, t, "", 10)),
+        ("get_all_riwayat_page", f"""SELECT r.*, u.username FROM riwayat_transaksi r LEFT JOIN users u ON u.id = r.user_id
+            WHERE (r.{w}, r.id) < (?, ?) ORDER BY r.{w} DESC, r.id DESC LIMIT ?""", (t, "", 10)),
+        ("get_topup_pending_by_user", f"SELECT * FROM topup_pending WHERE user_id=? ORDER BY {w} DESC LIMIT ?", (0, 10)),
+        ("get_topup_pending_all", f"SELECT * FROM topup_pending WHERE status='pending' ORDER BY {w} DESC LIMIT ?", (10,)),
+        ("get_kode_unik_user", f"SELECT * FROM kode_unik_topup WHERE user_id=? ORDER BY {d} DESC LIMIT ?", (0, 5)),
+        ("get_riwayat_belum_final", f"""SELECT id, user_id, produk, harga, waktu, {w} FROM riwayat_transaksi
+            WHERE {RIWAYAT_BELUM_FINAL} AND {w} < ? AND ({w}, id) > (?, ?)
+            AND NOT EXISTS (SELECT 1 FROM orders o WHERE o.reffid = riwayat_transaksi.id AND o.status IN (?, ?))
+            ORDER BY {w}, id LIMIT ?""", (t, t, "", "", "", 50)),
+    ]
+
+# Cetak EXPLAIN QUERY PLAN hot_queries() dan peringatkan full scan / sort
+def cek_query_plan():
     conn = get_conn()
-    c = conn.cursor()
-    c.execute("""CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY, username TEXT, nama TEXT)""")
-    c.execute("""CREATE TABLE IF NOT EXISTS saldo (
-        user_id INTEGER PRIMARY KEY, saldo INTEGER DEFAULT 0)""")
-    c.execute("""CREATE TABLE IF NOT EXISTS riwayat_transaksi (
-        id TEXT PRIMARY KEY, user_id INTEGER, produk TEXT, tujuan TEXT, harga INTEGER, waktu TEXT, status_text TEXT, keterangan TEXT)""")
-    c.execute("""CREATE TABLE IF NOT EXISTS topup_pending (
-        id TEXT PRIMARY KEY, user_id INTEGER, username TEXT, nama TEXT, nominal INTEGER, waktu TEXT, status TEXT, bukti_file_id TEXT, bukti_caption TEXT)""")
-    c.execute("""CREATE TABLE IF NOT EXISTS produk_admin (
-        kode TEXT PRIMARY KEY, harga INTEGER, deskripsi TEXT
-    )""")
-    c.execute("""CREATE TABLE IF NOT EXISTS kode_unik_topup (
-        kode TEXT PRIMARY KEY, 
-        user_id INTEGER, 
-        nominal INTEGER, 
-        digunakan INTEGER DEFAULT 0,
-        dibuat_pada TEXT,
-        digunakan_pada TEXT
-    )""")
-    conn.commit()
-    conn.close()
+    for nama, sql, params in hot_queries():
+        plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()]
+        print(f"[QUERY PLAN] {nama}: {' | '.join(plan)}")
+        if any((p.startswith("SCAN") and "INDEX" not in p) or "TEMP B-TREE" in p for p in plan):
+            logger.warning(f"[QUERY PLAN] {nama} tidak memakai index: {plan}")
+
+# LRU user terdaftar beserta saldonya; diperbarui mutasi_saldo setelah commit, versi = id saldo_mutasi
+class CacheUser:
+    def __init__(self, max_entri=USER_CACHE_MAX):
+        self.max_entri = max_entri
+        self._data = OrderedDict()  # user_id -> [dikenal, saldo atau None, versi saldo]
+        self._lock = threading.Lock()
+        self.hit = {"user": 0, "saldo": 0}
+        self.miss = {"user": 0, "saldo": 0}
+
+    def _entri(self, user_id):
+        entri = self._data.get(user_id)
+        if entri is None:
+            entri = self._data[user_id] = [False, None, -1]
+            while len(self._data) > self.max_entri:
+                self._data.popitem(last=False)
+        else:
+            self._data.move_to_end(user_id)
+        return entri
+
+    def dikenal(self, user_id):
+        with self._lock:
+            entri = self._data.get(user_id)
+            if entri and entri[0]:
+                self._data.move_to_end(user_id)
+                self.hit["user"] += 1
+                return True
+            self.miss["user"] += 1
+            return False
+
+    def tandai_dikenal(self, user_id):
+        with self._lock:
+            self._entri(user_id)[0] = True
+
+    def lupakan(self, user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                entri = self._data.get(user_id)
+                if entri:
+                    entri[0] = False
+
+    def get_saldo(self, user_id):
+        with self._lock:
+            entri = self._data.get(user_id)
+            if entri and entri[1] is not None:
+                self._data.move_to_end(user_id)
+                self.hit["saldo"] += 1
+                return entri[1]
+            self.miss["saldo"] += 1
+            return None
+
+    def set_saldo(self, user_id, saldo, versi):
+        with self._lock:
+            entri = self._entri(user_id)
+            if versi >= entri[2]:
+                entri[1], entri[2] = saldo, versi
+
+    def laporan(self):
+        with self._lock:
+            baris = [f"Entri: {len(self._data)}/{self.max_entri}"]
+            for jenis in ("user", "saldo"):
+                total = self.hit[jenis] + self.miss[jenis]
+                rasio = f"{self.hit[jenis] * 100 / total:.1f}%" if total else "-"
+                baris.append(f"{jenis}: hit {self.hit[jenis]}, miss {self.miss[jenis]} ({rasio})")
+        return "\n".join(baris)
+
+user_cache = CacheUser()
 
 # Database functions
 def tambah_user(user_id, username, nama):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("INSERT OR IGNORE INTO users (id, username, nama) VALUES (?, ?, ?)", (user_id, username, nama))
-    c.execute("INSERT OR IGNORE INTO saldo (user_id, saldo) VALUES (?, 0)", (user_id,))
-    conn.commit()
-    conn.close()
+    # User yang sudah terdaftar dan tidak diblokir: tidak ada yang perlu ditulis
+    if user_cache.dikenal(user_id):
+        return
+    with db_transaksi() as c:
+        c.execute("INSERT OR IGNORE INTO users (id, username, nama) VALUES (?, ?, ?)", (user_id, username, nama))
+        c.execute("INSERT OR IGNORE INTO saldo (user_id, saldo) VALUES (?, 0)", (user_id,))
+        # User yang pernah memblokir bot lalu /start lagi bisa menerima broadcast kembali
+        c.execute("UPDATE users SET diblokir=0 WHERE id=? AND diblokir=1", (user_id,))
+        setelah_commit(lambda: user_cache.tandai_dikenal(user_id))
 
 def get_saldo(user_id):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT saldo FROM saldo WHERE user_id=?", (user_id,))
-    row = c.fetchone()
-    conn.close()
-    return row[0] if row else 0
+    # Di dalam transaksi selalu baca database: saldo bisa sudah berubah tetapi belum di-commit
+    if not dalam_transaksi():
+        saldo = user_cache.get_saldo(user_id)
+        if saldo is not None:
+            return saldo
+    row = get_conn().execute(
+        "SELECT saldo, (SELECT MAX(id) FROM saldo_mutasi WHERE user_id=?) FROM saldo WHERE user_id=?",
+        (user_id, user_id)).fetchone()
+    if not row:
+        return 0
+    saldo, versi = row[0], row[1] or 0
+    setelah_commit(lambda: user_cache.set_saldo(user_id, saldo, versi))
+    return saldo
+
+# Hasil mutasi_saldo()
+MUTASI_OK = "ok"
+MUTASI_DUPLIKAT = "duplikat"
+MUTASI_SALDO_KURANG = "saldo_kurang"
+
+# Ubah saldo atomik + catat ke saldo_mutasi; debit hanya jika cukup, (ref, jenis) yang sama tidak diulang
+def mutasi_saldo(user_id, jumlah, ref, jenis):
+    waktu = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with db_transaksi(immediate=True) as c:
+        if ref is not None:
+            c.execute("SELECT 1 FROM saldo_mutasi WHERE ref=? AND jenis=?", (ref, jenis))
+            if c.fetchone():
+                return MUTASI_DUPLIKAT
+        if jumlah < 0:
+            c.execute("UPDATE saldo SET saldo=saldo+? WHERE user_id=? AND saldo>=?", (jumlah, user_id, -jumlah))
+            if c.rowcount == 0:
+                return MUTASI_SALDO_KURANG
+        else:
+            c.execute("INSERT OR IGNORE INTO saldo(user_id, saldo) VALUES (?,0)", (user_id,))
+            c.execute("UPDATE saldo SET saldo=saldo+? WHERE user_id=?", (jumlah, user_id))
+        c.execute("SELECT saldo FROM saldo WHERE user_id=?", (user_id,))
+        saldo_akhir = c.fetchone()[0]
+        c.execute("""INSERT INTO saldo_mutasi (user_id, ref, jenis, jumlah, saldo_akhir, waktu)
+            VALUES (?, ?, ?, ?, ?, ?)""", (user_id, ref, jenis, jumlah, saldo_akhir, waktu))
+        versi = c.lastrowid
+        setelah_commit(lambda: user_cache.set_saldo(user_id, saldo_akhir, versi))
+    return MUTASI_OK
+
+def debit_saldo(user_id, amount, ref, jenis="beli"):
+    return mutasi_saldo(user_id, -amount, ref, jenis)
+
+def kredit_saldo(user_id, amount, ref, jenis):
+    return mutasi_saldo(user_id, amount, ref, jenis)
 
-def tambah_saldo(user_id, amount):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("INSERT OR IGNORE INTO saldo(user_id, saldo) VALUES (?,0)", (user_id,))
-    c.execute("UPDATE saldo SET saldo=saldo+? WHERE user_id=?", (amount, user_id))
-    conn.commit()
-    conn.close()
+def get_riwayat_user(user_id, limit=10):
+    return get_riwayat_user_page(user_id, None, limit)
 
-def kurang_saldo(user_id, amount):
+def get_all_riwayat(limit=10):
+    return _baca_riwayat("", (), limit)
+
+# Keyset pagination: cursor = (kunci urut, id) baris terakhir halaman sebelumnya
+def get_riwayat_user_page(user_id, cursor=None, limit=10):
+    if cursor is None:
+        return _baca_riwayat("r.user_id=?", (user_id,), limit)
+    return _baca_riwayat("r.user_id=? AND (r.{urut}, r.id) < (?, ?)", (user_id, cursor[0], cursor[1]), limit)
+
+# Seperti get_riwayat_user_page untuk semua user, username di kolom terakhir
+def get_all_riwayat_page(cursor=None, limit=10):
+    if cursor is None:
+        return _baca_riwayat("", (), limit, dengan_username=True)
+    return _baca_riwayat("(r.{urut}, r.id) < (?, ?)", (cursor[0], cursor[1]), limit, dengan_username=True)
+
+# Cold storage riwayat_transaksi: transaksi final yang lebih tua dari RIWAYAT_ARSIP_HARI dipindah
+# ke tabel bulanan arsip.riwayat_YYYYMM. Semua pembacaan riwayat menggabungkan tabel utama dan arsip.
+_riwayat_arsip = []  # [(tabel, awal bulan berikutnya)], bulan terbaru dulu
+_riwayat_arsip_lock = threading.Lock()
+
+def _awal_bulan_berikut(bulan):
+    tahun, bln = int(bulan[:4]), int(bulan[4:])
+    tahun, bln = (tahun + 1, 1) if bln == 12 else (tahun, bln + 1)
+    return f"{tahun:04d}-{bln:02d}-01"
+
+def _kolom_riwayat(c):
+    return [(row[1], row[2]) for row in c.execute("PRAGMA main.table_info(riwayat_transaksi)").fetchall()]
+
+# Muat daftar tabel arsip riwayat dan samakan kolomnya dengan riwayat_transaksi
+def muat_tabel_arsip():
+    global _riwayat_arsip
+    with _riwayat_arsip_lock, db_transaksi(immediate=True) as c:
+        kolom = _kolom_riwayat(c)
+        tabel = [row[0] for row in c.execute(
+            """SELECT name FROM arsip.sqlite_master
+            WHERE type='table' AND name GLOB 'riwayat_[0-9][0-9][0-9][0-9][0-9][0-9]'""").fetchall()]
+        for nama in tabel:
+            ada = {row[1] for row in c.execute(f"PRAGMA arsip.table_info({nama})").fetchall()}
+            for k, tipe in kolom:
+                if k not in ada:
+                    c.execute(f"ALTER TABLE arsip.{nama} ADD COLUMN {k} {tipe}")
+            _index_tabel_arsip(c, nama)
+        _riwayat_arsip = [(f"arsip.{nama}", _awal_bulan_berikut(nama[-6:])) for nama in sorted(tabel, reverse=True)]
+
+def _buat_tabel_arsip(c, bulan):
+    nama = f"riwayat_{bulan}"
+    kolom = ", ".join(f"{k} {tipe}" + (" PRIMARY KEY" if k == "id" else "") for k, tipe in _kolom_riwayat(c))
+    c.execute(f"CREATE TABLE IF NOT EXISTS arsip.{nama} ({kolom})")
+    _index_tabel_arsip(c, nama)
+
+def _index_tabel_arsip(c, nama):
+    # Pengarsipan hanya berjalan dalam mode epoch, jadi cukup index kolom epoch
+    c.execute(f"CREATE INDEX IF NOT EXISTS arsip.idx_{nama}_user_epoch_id ON {nama} (user_id, waktu_epoch, id)")
+    c.execute(f"CREATE INDEX IF NOT EXISTS arsip.idx_{nama}_epoch_id ON {nama} (waktu_epoch, id)")
+
+# Kolom riwayat yang dikembalikan _baca_riwayat, urutannya sama dengan tabel sebelum migrasi 11
+KOLOM_RIWAYAT = "r.id, r.user_id, r.produk, r.tujuan, r.harga, r.waktu, r.status_text, r.keterangan"
+
+# Riwayat terbaru dari tabel utama lalu arsip per bulan; {urut} di syarat = kolom kunci urut
+def _baca_riwayat(syarat, params, limit, dengan_username=False):
     conn = get_conn()
-    c = conn.cursor()
-    c.execute("UPDATE saldo SET saldo=saldo-? WHERE user_id=?", (amount, user_id))
-    conn.commit()
-    conn.close()
-
-def get_riwayat_user(user_id, limit=10):
+    urut, = kolom_waktu("waktu")
+    kolom = f"{KOLOM_RIWAYAT}, u.username" if dengan_username else KOLOM_RIWAYAT
+    join = " LEFT JOIN main.users u ON u.id = r.user_id" if dengan_username else ""
+    where = f" WHERE {syarat.format(urut=urut)}" if syarat else ""
+    hasil, dilihat = [], set()
+    for tabel, batas in [("main.riwayat_transaksi", None)] + _riwayat_arsip:
+        if batas is not None and len(hasil) >= limit and hasil[limit - 1][5] >= batas:
+            break
+        for row in conn.execute(f"""SELECT {kolom}, r.{urut} FROM {tabel} r{join}{where}
+                ORDER BY r.{urut} DESC, r.id DESC LIMIT ?""", params + (limit,)):
+            # Baris bisa sementara ada di dua tempat bila arsipkan_riwayat terhenti di tengah
+            if row[0] not in dilihat:
+                dilihat.add(row[0])
+                hasil.append(row)
+        hasil.sort(key=lambda r: (r[-1], r[0]), reverse=True)
+        del hasil[limit:]
+    return hasil
+
+# Salin satu batch riwayat final ke arsip bulanan (commit) baru hapus dari tabel utama
+def arsipkan_riwayat(sebelum, limit):
+    kolom, sebelum = kolom_waktu("waktu", sebelum)
+    rows = get_conn().execute(
+        f"""SELECT id, substr(waktu, 1, 4) || substr(waktu, 6, 2) FROM main.riwayat_transaksi
+        WHERE {kolom} < ? AND waktu GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-*' AND NOT ({RIWAYAT_BELUM_FINAL})
+        ORDER BY {kolom}, id LIMIT ?""", (sebelum, limit)).fetchall()
+    if not rows:
+        return 0
+    per_bulan = {}
+    for id, bulan in rows:
+        per_bulan.setdefault(bulan, []).append(id)
+    with db_transaksi(immediate=True) as c:
+        kolom = ", ".join(k for k, _ in _kolom_riwayat(c))
+        for bulan, ids in per_bulan.items():
+            _buat_tabel_arsip(c, bulan)
+            c.execute(f"""INSERT OR REPLACE INTO arsip.riwayat_{bulan} ({kolom})
+                SELECT {kolom} FROM main.riwayat_transaksi WHERE id IN ({','.join('?' * len(ids))})""", ids)
+    if any(f"arsip.riwayat_{bulan}" not in dict(_riwayat_arsip) for bulan in per_bulan):
+        muat_tabel_arsip()
+    ids = [row[0] for row in rows]
+    with db_transaksi(immediate=True) as c:
+        c.execute(f"""DELETE FROM main.riwayat_transaksi
+            WHERE id IN ({','.join('?' * len(ids))}) AND NOT ({RIWAYAT_BELUM_FINAL})""", ids)
+    return len(ids)
+
+# Aktifkan auto_vacuum=INCREMENTAL pada database utama (sekali, lewat VACUUM)
+def siapkan_auto_vacuum():
     conn = get_conn()
-    c = conn.cursor()
-    c.execute("""SELECT * FROM riwayat_transaksi WHERE user_id=? ORDER BY waktu DESC LIMIT ?""", (user_id, limit))
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    if conn.execute("PRAGMA main.auto_vacuum").fetchone()[0] == 2:
+        return
+    print("[DB] Mengaktifkan auto_vacuum incremental (VACUUM sekali, mungkin butuh waktu)...")
+    conn.execute("PRAGMA main.auto_vacuum=INCREMENTAL")
+    conn.execute("VACUUM main")
 
-def get_all_riwayat(limit=10):
+def muat_mode_epoch():
+    _epoch["aktif"] = get_conn().execute(
+        "SELECT 1 FROM backfill_epoch WHERE target='*' AND selesai=1").fetchone() is not None
+    return _epoch["aktif"]
+
+# Isi kolom epoch satu rentang rowid per transaksi; True bila semua target selesai
+def backfill_epoch_batch(limit=BACKFILL_BATCH):
     conn = get_conn()
-    c = conn.cursor()
-    c.execute("""SELECT * FROM riwayat_transaksi ORDER BY waktu DESC LIMIT ?""", (limit,))
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    progres = {row[0]: row[1:] for row in conn.execute("SELECT target, posisi, selesai FROM backfill_epoch")}
+    target = [(f"main.{tabel}", kolom) for tabel, kolom in BACKFILL_EPOCH]
+    target += [(tabel, "waktu") for tabel, _ in _riwayat_arsip]
+    for tabel, kolom in target:
+        kunci = f"{tabel}.{kolom}"
+        posisi, selesai = progres.get(kunci, (0, 0))
+        if selesai:
+            continue
+        epoch = KOLOM_EPOCH[kolom]
+        with db_transaksi(immediate=True) as c:
+            akhir = c.execute(f"SELECT MAX(rowid) FROM (SELECT rowid FROM {tabel} WHERE rowid > ? ORDER BY rowid LIMIT ?)",
+                              (posisi, limit)).fetchone()[0]
+            if akhir is not None:
+                c.execute(f"""UPDATE {tabel} SET {epoch} = CAST(strftime('%s', {kolom}, 'utc') AS INTEGER)
+                    WHERE rowid > ? AND rowid <= ? AND {epoch} IS NULL AND {kolom} IS NOT NULL""", (posisi, akhir))
+            c.execute("INSERT OR REPLACE INTO backfill_epoch (target, posisi, selesai) VALUES (?, ?, ?)",
+                      (kunci, akhir if akhir is not None else posisi, int(akhir is None)))
+        return False
+    with db_transaksi(immediate=True) as c:
+        for index in INDEX_WAKTU_TEKS:
+            c.execute(f"DROP INDEX IF EXISTS {index}")
+        for tabel, _ in _riwayat_arsip:
+            # Index TEXT tabel arsip lama (sebelum kolom epoch ada)
+            nama = tabel.split(".", 1)[1]
+            c.execute(f"DROP INDEX IF EXISTS arsip.idx_{nama}_user_waktu_id")
+            c.execute(f"DROP INDEX IF EXISTS arsip.idx_{nama}_waktu_id")
+        c.execute("INSERT OR REPLACE INTO backfill_epoch (target, posisi, selesai) VALUES ('*', 0, 1)")
+    _epoch["aktif"] = True
+    return True
+
+# Kembalikan halaman kosong ke sistem bila lebih dari `ambang` ukuran file
+def kompak_db(ambang=0.1):
+    conn = get_conn()
+    halaman = conn.execute("PRAGMA main.page_count").fetchone()[0]
+    bebas = conn.execute("PRAGMA main.freelist_count").fetchone()[0]
+    if not halaman or bebas <= halaman * ambang:
+        return 0
+    # execute() hanya menjalankan satu step (satu halaman); executescript menjalankannya sampai selesai
+    conn.executescript("PRAGMA main.incremental_vacuum;")
+    conn.execute("PRAGMA main.wal_checkpoint(TRUNCATE)").fetchall()
+    return bebas
 
 def log_riwayat(id, user_id, produk, tujuan, harga, waktu, status_text, keterangan):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("""INSERT INTO riwayat_transaksi
-        (id, user_id, produk, tujuan, harga, waktu, status_text, keterangan)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
-        (id, user_id, produk, tujuan, harga, waktu, status_text, keterangan))
-    conn.commit()
-    conn.close()
+    with db_transaksi() as c:
+        c.execute("""INSERT INTO riwayat_transaksi
+            (id, user_id, produk, tujuan, harga, waktu, status_text, keterangan, waktu_epoch)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (id, user_id, produk, tujuan, harga, waktu, status_text, keterangan, epoch_dari_teks(waktu)))
+        c.execute("INSERT OR IGNORE INTO saldo (user_id, saldo) VALUES (?, 0)", (user_id,))
+        c.execute("UPDATE saldo SET jml_transaksi=jml_transaksi+1, terakhir_aktif=? WHERE user_id=?",
+                  (waktu, user_id))
 
 def update_riwayat_status(reffid, status_text, keterangan):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("UPDATE riwayat_transaksi SET status_text=?, keterangan=? WHERE id=?",
-              (status_text, keterangan, reffid))
-    conn.commit()
-    conn.close()
+    with db_transaksi() as c:
+        c.execute("UPDATE riwayat_transaksi SET status_text=?, keterangan=? WHERE id=?",
+                  (status_text, keterangan, reffid))
+        c.execute("""UPDATE saldo SET terakhir_aktif=?
+            WHERE user_id=(SELECT user_id FROM riwayat_transaksi WHERE id=?)""",
+                  (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), reffid))
 
 def get_riwayat_by_refid(reffid):
     conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT * FROM riwayat_transaksi WHERE id=?", (reffid,))
-    row = c.fetchone()
-    conn.close()
-    return row
+    row = conn.execute("SELECT * FROM main.riwayat_transaksi WHERE id=?", (reffid,)).fetchone()
+    if row:
+        return row
+    # Transaksi lama yang sudah diarsipkan (selalu final), dicari dari bulan terbaru
+    for tabel, _ in _riwayat_arsip:
+        row = conn.execute(f"SELECT * FROM {tabel} WHERE id=?", (reffid,)).fetchone()
+        if row:
+            return row
+    return None
+
+def status_final(status_text):
+    s = (status_text or "").lower()
+    return "sukses" in s or "gagal" in s or "batal" in s
+
+# Transaksi belum final sebelum `sebelum`, dari yang terlama; cursor = (kunci urut, id)
+def get_riwayat_belum_final(sebelum, cursor=None, limit=50, tanpa_antrean=False):
+    kolom, sebelum = kolom_waktu("waktu", sebelum)
+    syarat, params = "", (sebelum,)
+    if cursor is not None:
+        syarat, params = f" AND ({kolom}, id) > (?, ?)", (sebelum, cursor[0], cursor[1])
+    if tanpa_antrean:
+        syarat += """ AND NOT EXISTS (SELECT 1 FROM orders o
+            WHERE o.reffid = riwayat_transaksi.id AND o.status IN (?, ?))"""
+        params += (ORDER_QUEUED, ORDER_SUBMITTED)
+    return get_conn().execute(
+        f"""SELECT id, user_id, produk, harga, waktu, {kolom} FROM riwayat_transaksi
+        WHERE {RIWAYAT_BELUM_FINAL} AND {kolom} < ?{syarat} ORDER BY {kolom}, id LIMIT ?""",
+        params + (limit,)).fetchall()
+
+# Kelompok umur untuk laporan transaksi belum final: (batas atas dalam detik, label)
+KELOMPOK_UMUR = [(15 * 60, "< 15 menit"), (3600, "15-60 menit"), (6 * 3600, "1-6 jam"),
+                 (86400, "6-24 jam"), (None, "> 24 jam")]
+
+# [(label, jumlah, total_harga)] transaksi belum final per kelompok umur
+def get_umur_belum_final():
+    sekarang = time.time()
+    kolom, *batas = kolom_waktu("waktu", *(sekarang - detik for detik, _ in KELOMPOK_UMUR[:-1]))
+    kasus = " ".join(f"WHEN {kolom} >= ? THEN {i}" for i in range(len(batas)))
+    rows = get_conn().execute(
+        f"""SELECT CASE {kasus} ELSE {len(batas)} END AS kelompok, COUNT(*), COALESCE(SUM(harga), 0)
+        FROM riwayat_transaksi WHERE {RIWAYAT_BELUM_FINAL} GROUP BY kelompok""", batas).fetchall()
+    per_kelompok = {k: (jumlah, total) for k, jumlah, total in rows}
+    return [(label, *per_kelompok.get(i, (0, 0))) for i, (_, label) in enumerate(KELOMPOK_UMUR)]
 
 def get_user(user_id):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT id, username, nama FROM users WHERE id=?", (user_id,))
-    user = c.fetchone()
-    conn.close()
-    return user
+    return get_conn().execute("SELECT id, username, nama FROM users WHERE id=?", (user_id,)).fetchone()
 
-def get_all_users():
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT id, username, nama FROM users")
-    users = c.fetchall()
-    conn.close()
-    return users
+# Keyset pagination direktori user, urut ID
+def get_users_page(after_id=None, limit=20):
+    if after_id is None:
+        return get_conn().execute("SELECT id, username, nama FROM users ORDER BY id LIMIT ?", (limit,)).fetchall()
+    return get_conn().execute(
+        "SELECT id, username, nama FROM users WHERE id > ? ORDER BY id LIMIT ?", (after_id, limit)).fetchall()
+
+_users_fts = {"ada": None}
 
-def get_riwayat_jml(user_id):
+# Cari user berdasarkan awalan nama, username atau ID
+def cari_user(teks, after_id=None, limit=20):
     conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT COUNT(*) FROM riwayat_transaksi WHERE user_id=?", (user_id,))
-    row = c.fetchone()
-    conn.close()
-    return row[0] if row else 0
+    if _users_fts["ada"] is None:
+        _users_fts["ada"] = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='users_fts'").fetchone() is not None
+    after_id = -1 if after_id is None else after_id
+    if _users_fts["ada"]:
+        tokens = [t for t in re.split(r"\s+", teks.strip().lstrip("@")) if t]
+        if not tokens:
+            return []
+        match = " ".join('"' + t.replace('"', '""') + '"*' for t in tokens)
+        return conn.execute(
+            """SELECT u.id, u.username, u.nama FROM users_fts f JOIN users u ON u.id = f.rowid
+            WHERE users_fts MATCH ? AND f.rowid > ? ORDER BY f.rowid LIMIT ?""",
+            (match, after_id, limit)).fetchall()
+    prefix = teks.strip().lstrip("@").replace("%", "").replace("_", "") + "%"
+    return conn.execute(
+        """SELECT id, username, nama FROM users
+        WHERE (nama LIKE ? OR username LIKE ? OR CAST(id AS TEXT) LIKE ?) AND id > ?
+        ORDER BY id LIMIT ?""", (prefix, prefix, prefix, after_id, limit)).fetchall()
+
+# Fungsi untuk job broadcast
+BROADCAST_KOLOM = ("id", "admin_id", "progress_message_id", "teks", "status", "cursor_user_id",
+                   "total", "terkirim", "gagal", "diblokir", "dibuat_pada", "selesai_pada")
+
+def buat_broadcast_job(admin_id, teks):
+    with db_transaksi(immediate=True) as c:
+        c.execute("SELECT COUNT(*) FROM users WHERE diblokir=0")
+        total = c.fetchone()[0]
+        c.execute("""INSERT INTO broadcast_job (admin_id, teks, status, total, dibuat_pada)
+            VALUES (?, ?, 'berjalan', ?, ?)""",
+            (admin_id, teks, total, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+        return c.lastrowid
+
+def get_broadcast_job(job_id):
+    row = get_conn().execute(
+        f"SELECT {', '.join(BROADCAST_KOLOM)} FROM broadcast_job WHERE id=?", (job_id,)).fetchone()
+    return dict(zip(BROADCAST_KOLOM, row)) if row else None
+
+def get_broadcast_job_berjalan():
+    return [r[0] for r in get_conn().execute("SELECT id FROM broadcast_job WHERE status='berjalan'").fetchall()]
+
+def set_broadcast_progress_message(job_id, message_id):
+    with db_transaksi() as c:
+        c.execute("UPDATE broadcast_job SET progress_message_id=? WHERE id=?", (message_id, job_id))
+
+def get_broadcast_penerima(after_id, limit):
+    return [r[0] for r in get_conn().execute(
+        "SELECT id FROM users WHERE id > ? AND diblokir=0 ORDER BY id LIMIT ?", (after_id, limit)).fetchall()]
+
+# Simpan cursor dan hitungan satu batch, sekaligus tandai user yang memblokir bot
+def simpan_broadcast_batch(job_id, cursor_user_id, terkirim, gagal, user_diblokir):
+    with db_transaksi() as c:
+        c.execute("""UPDATE broadcast_job SET cursor_user_id=?, terkirim=terkirim+?, gagal=gagal+?, diblokir=diblokir+?
+            WHERE id=?""", (cursor_user_id, terkirim, gagal, len(user_diblokir), job_id))
+        c.executemany("UPDATE users SET diblokir=1 WHERE id=?", [(uid,) for uid in user_diblokir])
+        # /start berikutnya dari user ini harus menulis ulang supaya diblokir kembali 0
+        setelah_commit(lambda: user_cache.lupakan(user_diblokir))
+
+def selesai_broadcast_job(job_id, status):
+    with db_transaksi() as c:
+        c.execute("UPDATE broadcast_job SET status=?, selesai_pada=? WHERE id=? AND status IN ('berjalan', 'jeda')",
+                  (status, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), job_id))
+
+def lanjutkan_broadcast_job(job_id):
+    with db_transaksi() as c:
+        c.execute("UPDATE broadcast_job SET status='berjalan', selesai_pada=NULL WHERE id=? AND status='jeda'", (job_id,))
+        return c.rowcount > 0
+
+# Fungsi untuk order pembelian
+ORDER_QUEUED = "QUEUED"
+ORDER_SUBMITTED = "SUBMITTED"
+ORDER_PENDING = "PENDING"
+ORDER_SUCCESS = "SUCCESS"
+ORDER_FAILED = "FAILED"
+
+ORDER_KOLOM = ("reffid", "user_id", "produk", "nama_produk", "tujuan", "harga", "status", "keterangan",
+               "chat_id", "message_id", "dibuat_pada", "diperbarui_pada")
+
+# Potong saldo, simpan order QUEUED dan riwayat PENDING dalam satu transaksi
+def buat_order(reffid, user_id, produk, nama_produk, tujuan, harga, chat_id):
+    waktu = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with db_transaksi(immediate=True) as c:
+        hasil = debit_saldo(user_id, harga, reffid)
+        if hasil != MUTASI_OK:
+            return hasil
+        c.execute("""INSERT INTO orders
+            (reffid, user_id, produk, nama_produk, tujuan, harga, status, keterangan, chat_id, dibuat_pada, diperbarui_pada)
+            VALUES (?, ?, ?, ?, ?, ?, ?, '', ?, ?, ?)""",
+            (reffid, user_id, produk, nama_produk, tujuan, harga, ORDER_QUEUED, chat_id, waktu, waktu))
+        log_riwayat(reffid, user_id, produk, tujuan, harga, waktu, "PENDING", "Pesanan masuk antrean.")
+    return MUTASI_OK
+
+def get_order(reffid):
+    row = get_conn().execute(f"SELECT {', '.join(ORDER_KOLOM)} FROM orders WHERE reffid=?", (reffid,)).fetchone()
+    return dict(zip(ORDER_KOLOM, row)) if row else None
+
+def get_order_by_status(status):
+    return [r[0] for r in get_conn().execute(
+        "SELECT reffid FROM orders WHERE status=? ORDER BY dibuat_pada", (status,)).fetchall()]
+
+def set_order_message(reffid, message_id):
+    with db_transaksi() as c:
+        c.execute("UPDATE orders SET message_id=? WHERE reffid=?", (message_id, reffid))
+
+# Ubah status order; jika `dari` diisi hanya berhasil dari salah satu status itu
+def set_order_status(reffid, status, keterangan=None, dari=None):
+    waktu = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with db_transaksi() as c:
+        sql = "UPDATE orders SET status=?, keterangan=COALESCE(?, keterangan), diperbarui_pada=? WHERE reffid=?"
+        params = [status, keterangan, waktu, reffid]
+        if dari:
+            sql += f" AND status IN ({','.join('?' * len(dari))})"
+            params += list(dari)
+        c.execute(sql, params)
+        return c.rowcount > 0
+
+# Fungsi untuk inbox webhook
+def simpan_webhook_inbox(message):
+    with db_transaksi() as c:
+        c.execute("INSERT INTO webhook_inbox (message, status, diterima_pada) VALUES (?, 'baru', ?)",
+                  (message, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+        return c.lastrowid
+
+# Pesan 'baru' yang siap diproses (yang masih menunggu jeda coba ulang dilewati)
+def get_webhook_inbox_baru(limit):
+    return get_conn().execute(
+        """SELECT id, message, percobaan FROM webhook_inbox
+        WHERE status='baru' AND (coba_lagi_pada IS NULL OR coba_lagi_pada <= ?) ORDER BY id LIMIT ?""",
+        (int(time.time()), limit)).fetchall()
+
+def hapus_webhook_inbox_lama(hari):
+    batas = datetime.fromtimestamp(time.time() - hari * 86400).strftime("%Y-%m-%d %H:%M:%S")
+    with db_transaksi() as c:
+        c.execute("DELETE FROM webhook_inbox WHERE status != 'baru' AND diterima_pada < ?", (batas,))
+        return c.rowcount
+
+# Saldo, jumlah transaksi dan waktu aktif terakhir dalam satu lookup
+def get_ringkasan_user(user_id):
+    row = get_conn().execute(
+        "SELECT saldo, jml_transaksi, terakhir_aktif FROM saldo WHERE user_id=?", (user_id,)).fetchone()
+    return row if row else (0, 0, None)
 
 def insert_topup_pending(id, user_id, username, nama, nominal, waktu, status):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("""INSERT INTO topup_pending
-        (id, user_id, username, nama, nominal, waktu, status, bukti_file_id, bukti_caption)
-        VALUES (?, ?, ?, ?, ?, ?, ?, '', '')""",
-        (id, user_id, username, nama, nominal, waktu, status))
-    conn.commit()
-    conn.close()
+    with db_transaksi() as c:
+        c.execute("""INSERT INTO topup_pending
+            (id, user_id, username, nama, nominal, waktu, status, bukti_file_id, bukti_caption, waktu_epoch)
+            VALUES (?, ?, ?, ?, ?, ?, ?, '', '', ?)""",
+            (id, user_id, username, nama, nominal, waktu, status, epoch_dari_teks(waktu)))
+
+# Top up expired/batal dengan nominal di rentang ini yang masih dalam jeda TTL + TOPUP_JEDA_NOMINAL_MENIT
+def _topup_baru_berakhir(c, nominal_min, nominal_max):
+    kolom, batas = kolom_waktu("waktu", time.time() - (TOPUP_TTL_MENIT + TOPUP_JEDA_NOMINAL_MENIT) * 60)
+    return c.execute(
+        f"""SELECT id, nominal FROM topup_pending WHERE status IN ('expired', 'batal') AND {kolom} >= ?
+        AND nominal BETWEEN ? AND ?""", (batas, nominal_min, nominal_max)).fetchall()
+
+# Simpan top up pending dengan nominal + angka unik yang sedang tidak dipakai; None bila habis
+def alokasi_topup_pending(id, user_id, username, nama, nominal, waktu):
+    with db_transaksi(immediate=True) as c:
+        # Transaksi immediate: tidak ada alokasi lain di antara cek dan insert
+        terpakai = {row[0] for row in c.execute(
+            "SELECT nominal FROM topup_pending WHERE status='pending' AND nominal BETWEEN ? AND ?",
+            (nominal + TOPUP_KODE_MIN, nominal + TOPUP_KODE_MAX))}
+        terpakai.update(n for _, n in _topup_baru_berakhir(c, nominal + TOPUP_KODE_MIN, nominal + TOPUP_KODE_MAX))
+        bebas = [nominal + k for k in range(TOPUP_KODE_MIN, TOPUP_KODE_MAX + 1) if nominal + k not in terpakai]
+        if not bebas:
+            return None
+        final_nominal = random.choice(bebas)
+        insert_topup_pending(id, user_id, username, nama, final_nominal, waktu, "pending")
+    return final_nominal
+
+# Cocokkan mutasi masuk dengan top up pending lewat nominal; yang cocok tepat satu langsung di-approve,
+# nominal milik top up yang baru kedaluwarsa/dibatalkan diserahkan ke admin
+def cocokkan_mutasi(mutasi, sumber):
+    waktu = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    ringkasan = {"cocok": 0, "tidak_cocok": 0, "ganda": 0, "kedaluwarsa": 0, "duplikat": 0}
+    notifikasi, tidak_cocok = [], []
+    with db_transaksi(immediate=True) as c:
+        for ref, nominal, keterangan in mutasi:
+            c.execute("""INSERT OR IGNORE INTO mutasi_masuk (sumber, ref, nominal, keterangan, status, diterima_pada)
+                VALUES (?, ?, ?, ?, 'baru', ?)""", (sumber, ref, nominal, keterangan, waktu))
+            if c.rowcount == 0:
+                ringkasan["duplikat"] += 1
+                continue
+            mutasi_id = c.lastrowid
+            kandidat = c.execute("SELECT id, user_id FROM topup_pending WHERE status='pending' AND nominal=? LIMIT 2",
+                                 (nominal,)).fetchall()
+            berakhir = _topup_baru_berakhir(c, nominal, nominal)
+            topup_id = None
+            if not kandidat and berakhir:
+                status = "kedaluwarsa"  # transfer untuk top up yang sudah kedaluwarsa/dibatalkan; diputuskan admin
+                topup_id = berakhir[0][0]
+            elif not kandidat:
+                status = "tidak_cocok"
+            elif len(kandidat) + len(berakhir) > 1:
+                status = "ganda"  # sisa data lama sebelum alokasi nominal unik; diputuskan admin
+            else:
+                status = "cocok"
+                topup_id, user_id = kandidat[0]
+                c.execute("UPDATE topup_pending SET status='approved' WHERE id=? AND status='pending'", (topup_id,))
+                if kredit_saldo(user_id, nominal, topup_id, "topup") == MUTASI_OK:
+                    notifikasi.append({"chat_id": user_id, "text": (
+                        f"✅ <b>TOP UP BERHASIL</b>\n\n"
+                        f"Pembayaran Rp {nominal:,} sudah diterima dan saldo otomatis ditambahkan.\n"
+                        f"Saldo Anda sekarang: Rp {get_saldo(user_id):,}")})
+            c.execute("UPDATE mutasi_masuk SET status=?, topup_id=? WHERE id=?", (status, topup_id, mutasi_id))
+            ringkasan[status] += 1
+            if status != "cocok":
+                tidak_cocok.append((ref, nominal, keterangan, status))
+    return ringkasan, notifikasi, tidak_cocok
+
+# Tandai 'expired' top up pending tanpa bukti yang dibuat sebelum `sebelum`
+def expire_topup_pending(sebelum, limit):
+    kolom, sebelum = kolom_waktu("waktu", sebelum)
+    with db_transaksi(immediate=True) as c:
+        rows = c.execute(
+            f"""SELECT id, user_id, nominal FROM topup_pending
+            WHERE status='pending' AND {kolom} < ? AND COALESCE(bukti_file_id, '') = '' LIMIT ?""",
+            (sebelum, limit)).fetchall()
+        if rows:
+            c.execute(f"UPDATE topup_pending SET status='expired' WHERE status='pending' AND id IN ({','.join('?' * len(rows))})",
+                      [r[0] for r in rows])
+    return rows
+
+def _pindah_ke_arsip(c, tabel, kunci, kolom, ids):
+    tanda = ",".join("?" * len(ids))
+    c.execute(f"""INSERT OR REPLACE INTO {tabel}_arsip ({', '.join(kolom)}, diarsipkan_pada)
+        SELECT {', '.join(kolom)}, ? FROM {tabel} WHERE {kunci} IN ({tanda})""",
+              [datetime.now().strftime("%Y-%m-%d %H:%M:%S")] + ids)
+    c.execute(f"DELETE FROM {tabel} WHERE {kunci} IN ({tanda})", ids)
+
+# Pindahkan satu batch top up final yang lebih tua dari `sebelum` ke topup_pending_arsip
+def arsipkan_topup(sebelum, limit):
+    kolom, sebelum = kolom_waktu("waktu", sebelum)
+    with db_transaksi(immediate=True) as c:
+        ids = [r[0] for r in c.execute(
+            f"""SELECT id FROM topup_pending WHERE status IN ({','.join('?' * len(TOPUP_STATUS_FINAL))})
+            AND {kolom} < ? LIMIT ?""", TOPUP_STATUS_FINAL + (sebelum, limit))]
+        if ids:
+            _pindah_ke_arsip(c, "topup_pending", "id", ("id", "user_id", "username", "nama", "nominal", "waktu",
+                             "status", "bukti_file_id", "bukti_caption", "waktu_epoch"), ids)
+    return len(ids)
+
+# Pindahkan satu batch kode unik terpakai sebelum `sebelum` ke kode_unik_topup_arsip
+def arsipkan_kode_unik(sebelum, limit):
+    kolom, sebelum = kolom_waktu("digunakan_pada", sebelum)
+    with db_transaksi(immediate=True) as c:
+        ids = [r[0] for r in c.execute(
+            f"SELECT kode FROM kode_unik_topup WHERE digunakan=1 AND {kolom} < ? LIMIT ?", (sebelum, limit))]
+        if ids:
+            _pindah_ke_arsip(c, "kode_unik_topup", "kode", ("kode", "user_id", "nominal", "digunakan",
+                             "dibuat_pada", "digunakan_pada", "dibuat_epoch", "digunakan_epoch"), ids)
+    return len(ids)
 
 def update_topup_bukti(id, bukti_file_id, bukti_caption):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("UPDATE topup_pending SET bukti_file_id=?, bukti_caption=? WHERE id=?",
-              (bukti_file_id, bukti_caption, id))
-    conn.commit()
-    conn.close()
+    # Bukti hanya untuk top up yang masih pending (daftar admin hanya menampilkan yang pending)
+    with db_transaksi() as c:
+        c.execute("UPDATE topup_pending SET bukti_file_id=?, bukti_caption=? WHERE id=? AND status='pending'",
+                  (bukti_file_id, bukti_caption, id))
+        return c.rowcount > 0
 
 def update_topup_status(id, status):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("UPDATE topup_pending SET status=? WHERE id=?", (status, id))
-    conn.commit()
-    conn.close()
+    # Hanya top up yang masih pending; False bila sudah diproses (auto-approve, sweeper, admin lain)
+    with db_transaksi() as c:
+        c.execute("UPDATE topup_pending SET status=? WHERE id=? AND status='pending'", (status, id))
+        return c.rowcount > 0
 
 def get_topup_pending_by_user(user_id, limit=10):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("""SELECT * FROM topup_pending WHERE user_id=? ORDER BY waktu DESC LIMIT ?""", (user_id, limit))
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    kolom, = kolom_waktu("waktu")
+    return get_conn().execute(
+        f"""SELECT * FROM topup_pending WHERE user_id=? ORDER BY {kolom} DESC LIMIT ?""", (user_id, limit)).fetchall()
 
 def get_topup_pending_all(limit=10):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("""SELECT * FROM topup_pending WHERE status='pending' ORDER BY waktu DESC LIMIT ?""", (limit,))
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    kolom, = kolom_waktu("waktu")
+    return get_conn().execute(
+        f"""SELECT * FROM topup_pending WHERE status='pending' ORDER BY {kolom} DESC LIMIT ?""", (limit,)).fetchall()
 
 def get_topup_by_id(id):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT * FROM topup_pending WHERE id=?", (id,))
-    row = c.fetchone()
-    conn.close()
-    return row
+    return get_conn().execute("SELECT * FROM topup_pending WHERE id=?", (id,)).fetchone()
 
 def get_produk_admin(kode):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT harga, deskripsi FROM produk_admin WHERE kode=?", (kode,))
-    row = c.fetchone()
-    conn.close()
+    row = get_conn().execute("SELECT harga, deskripsi FROM produk_admin WHERE kode=?", (kode,)).fetchone()
     if row:
         return {"harga": row[0], "deskripsi": row[1]}
     return None
 
 def set_produk_admin_harga(kode, harga):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("INSERT OR IGNORE INTO produk_admin (kode, harga, deskripsi) VALUES (?, ?, '')", (kode, harga))
-    c.execute("UPDATE produk_admin SET harga=? WHERE kode=?", (harga, kode))
-    conn.commit()
-    conn.close()
+    with db_transaksi() as c:
+        c.execute("INSERT OR IGNORE INTO produk_admin (kode, harga, deskripsi) VALUES (?, ?, '')", (kode, harga))
+        c.execute("UPDATE produk_admin SET harga=? WHERE kode=?", (harga, kode))
+    perbarui_katalog()
 
 def set_produk_admin_deskripsi(kode, deskripsi):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("INSERT OR IGNORE INTO produk_admin (kode, harga, deskripsi) VALUES (?, 0, ?)", (kode, deskripsi))
-    c.execute("UPDATE produk_admin SET deskripsi=? WHERE kode=?", (deskripsi, kode))
-    conn.commit()
-    conn.close()
+    with db_transaksi() as c:
+        c.execute("INSERT OR IGNORE INTO produk_admin (kode, harga, deskripsi) VALUES (?, 0, ?)", (kode, deskripsi))
+        c.execute("UPDATE produk_admin SET deskripsi=? WHERE kode=?", (deskripsi, kode))
+    perbarui_katalog()
 
 def get_all_produk_admin():
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT kode, harga, deskripsi FROM produk_admin")
-    rows = c.fetchall()
-    conn.close()
+    rows = get_conn().execute("SELECT kode, harga, deskripsi FROM produk_admin").fetchall()
     
     produk_dict = {}
     for row in rows:
@@ -262,50 +1184,115 @@ def get_all_produk_admin():
     return produk_dict
 
 # Fungsi untuk kode unik top up
-def generate_kode_unik():
-    return str(random.randint(100, 999))
+def normalisasi_kode(teks):
+    return re.sub(r"[\s-]", "", teks or "").upper()
 
-def simpan_kode_unik(kode, user_id, nominal):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("""INSERT INTO kode_unik_topup 
-        (kode, user_id, nominal, digunakan, dibuat_pada) 
-        VALUES (?, ?, ?, 0, ?)""",
-        (kode, user_id, nominal, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-    conn.commit()
-    conn.close()
-
-def get_kode_unik(kode):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT * FROM kode_unik_topup WHERE kode=?", (kode,))
-    row = c.fetchone()
-    conn.close()
-    if row:
-        return {
-            "kode": row[0],
-            "user_id": row[1],
-            "nominal": row[2],
-            "digunakan": row[3],
-            "dibuat_pada": row[4],
-            "digunakan_pada": row[5]
-        }
-    return None
+def format_kode(kode):
+    if len(kode) == KODE_UNIK_PANJANG:
+        return f"{kode[:5]}-{kode[5:]}"
+    return kode
 
-def gunakan_kode_unik(kode):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("UPDATE kode_unik_topup SET digunakan=1, digunakan_pada=? WHERE kode=?",
-              (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), kode))
-    conn.commit()
-    conn.close()
+def generate_kode_unik():
+    return "".join(secrets.choice(KODE_UNIK_ALFABET) for _ in range(KODE_UNIK_PANJANG))
+
+# Buat `jumlah` kode baru yang dijamin unik
+def buat_kode_unik(user_id, nominal, jumlah=1):
+    waktu = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    kode_baru = set()
+    with db_transaksi(immediate=True) as c:
+        # Di dalam transaksi immediate tidak ada penulis lain, jadi cek bentrok lalu insert aman
+        while len(kode_baru) < jumlah:
+            calon = {generate_kode_unik() for _ in range(jumlah - len(kode_baru))} - kode_baru
+            calon = list(calon)
+            tanda = ','.join('?' * len(calon))
+            ada = {row[0] for row in c.execute(
+                f"""SELECT kode FROM kode_unik_topup WHERE kode IN ({tanda})
+                UNION SELECT kode FROM kode_unik_topup_arsip WHERE kode IN ({tanda})""", calon + calon)}
+            kode_baru.update(k for k in calon if k not in ada)
+        kode_baru = sorted(kode_baru)
+        epoch = epoch_dari_teks(waktu)
+        c.executemany("""INSERT INTO kode_unik_topup
+            (kode, user_id, nominal, digunakan, dibuat_pada, dibuat_epoch)
+            VALUES (?, ?, ?, 0, ?, ?)""",
+            [(kode, user_id, nominal, waktu, epoch) for kode in kode_baru])
+    kode_unik_filter.tambah(kode_baru)
+    return kode_baru
+
+# Pakai kode dan tambah saldo dalam satu transaksi; None bila kode tidak ada / sudah digunakan
+def tukar_kode_unik(kode, user_id):
+    try:
+        with db_transaksi(immediate=True) as c:
+            sekarang = time.time()
+            c.execute("""UPDATE kode_unik_topup SET digunakan=1, digunakan_pada=?, digunakan_epoch=?
+                WHERE kode=? AND digunakan=0""",
+                      (datetime.fromtimestamp(sekarang).strftime(FORMAT_WAKTU), int(sekarang), kode))
+            if c.rowcount == 0:
+                return None
+            nominal = c.execute("SELECT nominal FROM kode_unik_topup WHERE kode=?", (kode,)).fetchone()[0]
+            if kredit_saldo(user_id, nominal, kode, "kode_unik") != MUTASI_OK:
+                # Raise supaya penandaan digunakan ikut di-rollback; kode tidak hangus tanpa saldo
+                raise ValueError("kredit saldo sudah tercatat di jurnal")
+    except ValueError as e:
+        logger.error(f"[KODE UNIK] Gagal menukar {kode}: {e}")
+        return None
+    return nominal
+
+def get_kode_unik_aktif():
+    return [row[0] for row in get_conn().execute("SELECT kode FROM kode_unik_topup WHERE digunakan=0")]
+
+# Kode yang belum digunakan di memori plus batas percobaan salah per user
+class FilterKodeUnik:
+    def __init__(self):
+        self._kode = set()
+        self._gagal = {}  # user_id -> deque waktu percobaan salah
+        self._lock = threading.Lock()
+
+    def muat(self):
+        kode = get_kode_unik_aktif()
+        with self._lock:
+            self._kode = set(kode)
+
+    def tambah(self, kode_list):
+        with self._lock:
+            self._kode.update(kode_list)
+
+    def buang(self, kode):
+        with self._lock:
+            self._kode.discard(kode)
+
+    def ada(self, kode):
+        with self._lock:
+            return kode in self._kode
+
+    def _bersihkan(self, user_id, sekarang):
+        gagal = self._gagal.get(user_id)
+        while gagal and sekarang - gagal[0] > KODE_UNIK_BLOKIR_DETIK:
+            gagal.popleft()
+        if gagal is not None and not gagal:
+            del self._gagal[user_id]
+        return gagal
+
+    # Detik sampai user boleh mencoba lagi; 0 jika tidak diblokir
+    def sisa_blokir(self, user_id):
+        sekarang = time.monotonic()
+        with self._lock:
+            gagal = self._bersihkan(user_id, sekarang)
+            if not gagal or len(gagal) < KODE_UNIK_MAX_GAGAL:
+                return 0
+            return int(KODE_UNIK_BLOKIR_DETIK - (sekarang - gagal[0])) + 1
+
+    def catat_gagal(self, user_id):
+        sekarang = time.monotonic()
+        with self._lock:
+            self._bersihkan(user_id, sekarang)
+            self._gagal.setdefault(user_id, deque()).append(sekarang)
+
+kode_unik_filter = FilterKodeUnik()
 
 def get_kode_unik_user(user_id, limit=5):
-    conn = get_conn()
-    c = conn.cursor()
-    c.execute("SELECT * FROM kode_unik_topup WHERE user_id=? ORDER BY dibuat_pada DESC LIMIT ?", (user_id, limit))
-    rows = c.fetchall()
-    conn.close()
+    kolom, = kolom_waktu("dibuat_pada")
+    rows = get_conn().execute(
+        f"SELECT * FROM kode_unik_topup WHERE user_id=? ORDER BY {kolom} DESC LIMIT ?", (user_id, limit)).fetchall()
     
     result = []
     for row in rows:
@@ -319,30 +1306,313 @@ def get_kode_unik_user(user_id, limit=5):
         })
     return result
 
+# Client HTTP provider (trx, cek_stock_akrab, API QRIS)
+# timeout dalam detik; retry hanya untuk endpoint yang idempotent (aman diulang)
+PROVIDER_ENDPOINTS = {
+    "trx": {"timeout": 15, "retry": 0},
+    "cek_stock_akrab": {"timeout": 10, "retry": 2},
+    "qris": {"timeout": 20, "retry": 1},
+    "status": {"timeout": 10, "retry": 1},
+}
+PROVIDER_POOL_SIZE = 16
+PROVIDER_RETRY_BACKOFF = 0.5  # detik, dikali 2 setiap percobaan + jitter
+BREAKER_FAILURE_THRESHOLD = 5  # gagal berturut-turut sebelum circuit dibuka
+BREAKER_RESET_TIMEOUT = 30  # detik circuit terbuka sebelum satu request percobaan diizinkan
+
+class ProviderError(Exception):
+    def __init__(self, pesan, terkirim=True):
+        super().__init__(pesan)
+        self.terkirim = terkirim  # False hanya bila request pasti belum sampai ke provider
+
+def belum_terkirim(e):
+    # Gagal membuka koneksi = request belum sampai; timeout baca/putus di tengah bisa sudah diproses provider
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    if isinstance(e, requests.ConnectionError) and e.args:
+        return isinstance(getattr(e.args[0], "reason", None), NewConnectionError)
+    return False
+
+# Setelah beberapa kegagalan berturut-turut, tolak request sampai reset_timeout lewat
+class CircuitBreaker:
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self.failures >= self.failure_threshold or self.opened_at is not None:
+                self.opened_at = time.monotonic()
+
+class EndpointStats:
+    def __init__(self):
+        self.total = 0
+        self.gagal = 0
+        self.ditolak = 0  # ditolak circuit breaker tanpa request
+        self.latency = deque(maxlen=200)
+        self._lock = threading.Lock()
+
+    def catat_ditolak(self):
+        with self._lock:
+            self.ditolak += 1
+
+    def catat_request(self):
+        with self._lock:
+            self.total += 1
+
+    def catat_hasil(self, latency, gagal=False):
+        with self._lock:
+            self.latency.append(latency)
+            if gagal:
+                self.gagal += 1
+
+    def ringkasan(self):
+        with self._lock:
+            lat = sorted(self.latency)
+            total, gagal, ditolak = self.total, self.gagal, self.ditolak
+        if not lat:
+            return {"total": total, "gagal": gagal, "ditolak": ditolak, "avg": 0, "p95": 0}
+        return {
+            "total": total,
+            "gagal": gagal,
+            "ditolak": ditolak,
+            "avg": sum(lat) / len(lat),
+            "p95": lat[min(len(lat) - 1, int(len(lat) * 0.95))],
+        }
+
+# Satu requests.Session dengan connection pool untuk semua panggilan ke provider
+class ProviderClient:
+    def __init__(self, endpoints=PROVIDER_ENDPOINTS):
+        self.endpoints = endpoints
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=len(endpoints), pool_maxsize=PROVIDER_POOL_SIZE)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.breakers = {name: CircuitBreaker() for name in endpoints}
+        self.stats = {name: EndpointStats() for name in endpoints}
+
+    def request(self, endpoint, method, url, **kwargs):
+        conf = self.endpoints[endpoint]
+        breaker = self.breakers[endpoint]
+        stats = self.stats[endpoint]
+        terkirim = False
+        for attempt in range(conf["retry"] + 1):
+            if not breaker.allow():
+                stats.catat_ditolak()
+                raise ProviderError(f"Provider {endpoint} sedang gangguan, coba lagi nanti", terkirim)
+            stats.catat_request()
+            start = time.monotonic()
+            try:
+                res = self.session.request(method, url, timeout=conf["timeout"], **kwargs)
+                if res.status_code >= 500:
+                    raise ProviderError(f"HTTP {res.status_code}")
+            except (requests.RequestException, ProviderError) as e:
+                stats.catat_hasil(time.monotonic() - start, gagal=True)
+                breaker.failure()
+                terkirim = terkirim or not belum_terkirim(e)
+                if attempt >= conf["retry"]:
+                    raise ProviderError(f"{endpoint}: {e}", terkirim) from e
+                time.sleep(PROVIDER_RETRY_BACKOFF * (2 ** attempt) * (1 + random.random()))
+                continue
+            stats.catat_hasil(time.monotonic() - start)
+            breaker.success()
+            return res
+
+    def get(self, endpoint, url, **kwargs):
+        return self.request(endpoint, "GET", url, **kwargs)
+
+    def post(self, endpoint, url, **kwargs):
+        return self.request(endpoint, "POST", url, **kwargs)
+
+    def laporan(self):
+        lines = []
+        for name in self.endpoints:
+            r = self.stats[name].ringkasan()
+            lines.append(
+                f"<b>{name}</b> [{self.breakers[name].state}]\n"
+                f"Request: {r['total']} | Gagal: {r['gagal']} | Ditolak: {r['ditolak']}\n"
+                f"Latency avg: {r['avg'] * 1000:.0f} ms | p95: {r['p95'] * 1000:.0f} ms"
+            )
+        return "\n\n".join(lines)
+
+provider = ProviderClient()
+
+# Katalog produk di memori: snapshot tidak pernah diubah, refresh membuat objek baru lalu mengganti `katalog`
+class KatalogProduk:
+    _versi = itertools.count(1)
+
+    def __init__(self, produk_api, produk_admin, last_updated):
+        self.versi = next(KatalogProduk._versi)
+        self.produk_api = list(produk_api)
+        self.by_kode = {p["type"]: p for p in self.produk_api}
+        self.admin = dict(produk_admin)
+        self.last_updated = last_updated
+        self.hanya_admin = [kode for kode in self.admin if kode not in self.by_kode]
+        self._harga = {}
+        for kode in set(self.by_kode) | set(self.admin):
+            admin_data = self.admin.get(kode)
+            if admin_data and admin_data["harga"] and admin_data["harga"] > 0:
+                self._harga[kode] = admin_data["harga"]
+            else:
+                self._harga[kode] = int(self.by_kode.get(kode, {}).get("harga", 0))
+
+    def get(self, kode):
+        return self.by_kode.get(kode)
+
+    def ada(self, kode):
+        return kode in self._harga
+
+    def harga(self, kode):
+        return self._harga.get(kode, 0)
+
+    def deskripsi(self, kode):
+        admin_data = self.admin.get(kode)
+        return admin_data["deskripsi"] if admin_data and admin_data["deskripsi"] else ""
+
+    def is_stale(self):
+        return time.time() - self.last_updated > CACHE_DURATION
+
+    # Catatan untuk user jika data stok sudah lama tidak diperbarui
+    def info_stale(self):
+        if not self.produk_api or not self.is_stale():
+            return ""
+        waktu = datetime.fromtimestamp(self.last_updated).strftime("%Y-%m-%d %H:%M")
+        return f"\n⚠️ <i>Data stok terakhir diperbarui {waktu}, mungkin kurang akurat.</i>\n"
+
+katalog = KatalogProduk([], {}, 0)
+_katalog_lock = threading.Lock()
+
+# Bangun snapshot baru dan pasang; produk_api=None memakai data API lama
+def perbarui_katalog(produk_api=None, last_updated=None):
+    global katalog
+    with _katalog_lock:
+        if produk_api is None:
+            produk_api, last_updated = katalog.produk_api, katalog.last_updated
+        elif last_updated is None:
+            last_updated = time.time()
+        katalog = KatalogProduk(produk_api, get_all_produk_admin(), last_updated)
+    return katalog
+
+def simpan_snapshot_katalog(k):
+    tmp = KATALOG_SNAPSHOT_FILE + ".tmp"
+    try:
+        with open(tmp, "w") as f:
+            json.dump({"last_updated": k.last_updated, "data": k.produk_api}, f)
+        os.replace(tmp, KATALOG_SNAPSHOT_FILE)
+    except Exception as e:
+        logger.error(f"Gagal menyimpan snapshot katalog: {e}")
+
+# Muat katalog terakhir dari disk supaya daftar produk tidak kosong setelah restart
+def muat_snapshot_katalog():
+    try:
+        with open(KATALOG_SNAPSHOT_FILE) as f:
+            snap = json.load(f)
+        if isinstance(snap.get("data"), list):
+            perbarui_katalog(snap["data"], snap.get("last_updated", 0))
+            logger.info(f"Snapshot katalog dimuat. Jumlah produk: {len(snap['data'])}")
+            return
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.error(f"Gagal memuat snapshot katalog: {e}")
+    perbarui_katalog()
+
+# Panggilan bersamaan digabung: satu yang jalan, sisanya menunggu hasilnya
+class SingleFlight:
+    class _Call:
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._call = None
+
+    def sedang_berjalan(self):
+        return self._call is not None
+
+    def do(self, fn, timeout=None):
+        with self._lock:
+            call = self._call
+            leader = call is None
+            if leader:
+                call = self._call = SingleFlight._Call()
+        if leader:
+            try:
+                call.result = fn()
+            except Exception as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    self._call = None
+                call.event.set()
+        elif not call.event.wait(timeout):
+            raise TimeoutError("Menunggu fetch yang sedang berjalan terlalu lama")
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+_stok_flight = SingleFlight()
+
+def _fetch_stok_akrab():
+    start_time = time.time()
+    res = provider.get("cek_stock_akrab", cfg["BASE_URL_AKRAB"] + "cek_stock_akrab")
+    data = res.json()
+    if not isinstance(data.get("data"), list):
+        raise ValueError("Format data stok tidak dikenali")
+    k = perbarui_katalog(data["data"])
+    simpan_snapshot_katalog(k)
+    logger.info(f"Cache produk diperbarui. Jumlah produk: {len(data['data'])}. Waktu: {time.time() - start_time:.2f}s")
+    return k
+
+# Ambil cek_stock_akrab dan perbarui katalog; pemanggil bersamaan berbagi satu request
+def ambil_stok_akrab(timeout=STOK_WAIT_DEADLINE):
+    return _stok_flight.do(_fetch_stok_akrab, timeout)
+
 # Fungsi untuk memperbarui cache produk di background
 def update_produk_cache_background():
-    if produk_cache["update_in_progress"]:
+    if _stok_flight.sedang_berjalan():
         return
-        
-    produk_cache["update_in_progress"] = True
     try:
-        start_time = time.time()
-        res = requests.get(cfg["BASE_URL_AKRAB"] + "cek_stock_akrab", timeout=10)
-        data = res.json()
-        
-        if isinstance(data.get("data"), list):
-            produk_cache["data"] = data["data"]
-            produk_cache["last_updated"] = time.time()
-            logger.info(f"Cache produk diperbarui. Jumlah produk: {len(data['data'])}. Waktu: {time.time() - start_time:.2f}s")
-        else:
-            logger.error("Format data stok tidak dikenali")
+        ambil_stok_akrab()
     except Exception as e:
         logger.error(f"Gagal memperbarui cache produk: {e}")
-    finally:
-        produk_cache["update_in_progress"] = False
+
+def job_refresh_katalog(context: CallbackContext):
+    update_produk_cache_background()
 
 # Conversation states
-CHOOSING_PRODUK, INPUT_TUJUAN, KONFIRMASI, BC_MESSAGE, TOPUP_AMOUNT, TOPUP_UPLOAD, ADMIN_CEKUSER, ADMIN_EDIT_HARGA, ADMIN_EDIT_DESKRIPSI, INPUT_KODE_UNIK = range(10)
+CHOOSING_PRODUK, INPUT_TUJUAN, KONFIRMASI, BC_MESSAGE, TOPUP_AMOUNT, TOPUP_UPLOAD, ADMIN_CEKUSER, ADMIN_EDIT_HARGA, ADMIN_EDIT_DESKRIPSI, INPUT_KODE_UNIK, ADMIN_CARI_USER, ADMIN_GENERATE_KODE, ADMIN_IMPORT_MUTASI = range(13)
 
 # UI components modern dengan emoji dan layout yang lebih baik
 def btn_kembali(): 
@@ -351,6 +1621,23 @@ def btn_kembali():
 def btn_kembali_menu(): 
     return [InlineKeyboardButton("🏠 Menu Utama", callback_data="main_menu")]
 
+# Tombol sebelumnya/berikutnya "{prefix}|{page}"; total_pages=None untuk keyset pagination
+def btn_navigasi(prefix, page, total_pages=None, ada_berikutnya=False):
+    if total_pages is not None:
+        ada_berikutnya = page < total_pages - 1
+        if total_pages <= 1:
+            return []
+    elif page == 0 and not ada_berikutnya:
+        return []
+    row = []
+    if page > 0:
+        row.append(InlineKeyboardButton("⬅️ Sebelumnya", callback_data=f"{prefix}|{page - 1}"))
+    label = f"📄 {page + 1}/{total_pages}" if total_pages is not None else f"📄 {page + 1}"
+    row.append(InlineKeyboardButton(label, callback_data="noop"))
+    if ada_berikutnya:
+        row.append(InlineKeyboardButton("Berikutnya ➡️", callback_data=f"{prefix}|{page + 1}"))
+    return row
+
 def menu_user(uid):
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("🛒 Beli Produk", callback_data='beli_produk'),
@@ -382,7 +1669,10 @@ def admin_panel_menu():
          InlineKeyboardButton("📢 Broadcast", callback_data='broadcast')],
         [InlineKeyboardButton("✅ Approve Top Up", callback_data="admin_topup_pending"),
          InlineKeyboardButton("⚙️ Manajemen Produk", callback_data="admin_produk")],
-        [InlineKeyboardButton("🔑 Generate Kode Unik", callback_data="admin_generate_kode")],
+        [InlineKeyboardButton("🔑 Generate Kode Unik", callback_data="admin_generate_kode"),
+         InlineKeyboardButton("📡 Status Provider", callback_data="admin_provider_stats")],
+        [InlineKeyboardButton("⏳ Transaksi Pending", callback_data="admin_pending_report"),
+         InlineKeyboardButton("📥 Import Mutasi", callback_data="admin_import_mutasi")],
         btn_kembali()
     ])
 
@@ -397,8 +1687,7 @@ def get_menu(uid):
     return menu_admin(uid) if uid in ADMIN_IDS else menu_user(uid)
 
 def dashboard_msg(user):
-    saldo = get_saldo(user.id)
-    total_trx = get_riwayat_jml(user.id)
+    saldo, total_trx, _ = get_ringkasan_user(user.id)
     msg = (
         f"✨ <b>DASHBOARD USER</b> ✨\n\n"
         f"👤 <b>{user.full_name}</b>\n"
@@ -444,110 +1733,107 @@ def cek_stok_menu(update: Update, context: CallbackContext):
     query.answer()
     
     # Gunakan data dari cache
-    if produk_cache["data"]:
-        data = {"data": produk_cache["data"]}
+    if katalog.produk_api:
+        data = {"data": katalog.produk_api}
     else:
         # Jika cache kosong, ambil data langsung
         try:
-            res = requests.get(cfg["BASE_URL_AKRAB"] + "cek_stock_akrab", timeout=10)
-            data = res.json()
+            data = {"data": ambil_stok_akrab().produk_api}
         except Exception as e:
             query.edit_message_text(f"❌ Gagal mengambil data stok: {e}", parse_mode=ParseMode.HTML, reply_markup=InlineKeyboardMarkup([btn_kembali()]))
             return ConversationHandler.END
     
-    msg = "📦 <b>Info Stok Akrab XL/Axis</b>\n\n"
-    if isinstance(data.get("data"), list):
-        for produk in data["data"]:
-            status = "✅" if int(produk['sisa_slot']) > 0 else "❌"
-            msg += f"{status} <b>[{produk['type']}]</b> {produk['nama']}: {produk['sisa_slot']} unit\n"
-    else:
-        msg += "❌ Format data stok tidak dikenali."
+    msg = "📦 <b>Info Stok Akrab XL/Axis</b>\n" + katalog.info_stale() + "\n"
+    for produk in data["data"]:
+        status = "✅" if int(produk['sisa_slot']) > 0 else "❌"
+        msg += f"{status} <b>[{produk['type']}]</b> {produk['nama']}: {produk['sisa_slot']} unit\n"
     
     query.edit_message_text(msg, parse_mode=ParseMode.HTML, reply_markup=InlineKeyboardMarkup([btn_kembali()]))
     return ConversationHandler.END
 
 # Product related functions
 def get_harga_produk(kode, api_produk=None):
-    admin_data = get_produk_admin(kode)
-    if admin_data and admin_data["harga"] and admin_data["harga"] > 0:
-        return admin_data["harga"]
+    k = katalog
+    if k.ada(kode):
+        return k.harga(kode)
     
     # Jika ada data produk dari API, gunakan harganya
     if api_produk and "harga" in api_produk:
         return int(api_produk["harga"])
     
-    # Jika tidak ada data, coba ambil dari cache atau API
+    # Jika katalog masih kosong, ambil dari API
     try:
-        if produk_cache["data"]:
-            for produk in produk_cache["data"]:
-                if produk["type"] == kode:
-                    return int(produk.get("harga", 0))
-        else:
-            res = requests.get(cfg["BASE_URL_AKRAB"] + "cek_stock_akrab", timeout=10)
-            data = res.json()
-            for produk in data.get("data", []):
-                if produk["type"] == kode:
-                    return int(produk.get("harga", 0))
+        if not k.produk_api:
+            return ambil_stok_akrab().harga(kode)
     except Exception:
         pass
     
     return 0
 
-def produk_inline_keyboard(is_admin=False):
-    try:
-        # Gunakan data dari cache jika tersedia dan masih fresh
-        current_time = time.time()
-        if current_time - produk_cache["last_updated"] > CACHE_DURATION:
-            # Mulai update cache di background thread
-            thread = threading.Thread(target=update_produk_cache_background)
-            thread.daemon = True
-            thread.start()
-        
-        data = {"data": produk_cache["data"]} if produk_cache["data"] else None
-        
-        # Jika cache kosong, ambil data langsung (blocking)
-        if not data:
-            res = requests.get(cfg["BASE_URL_AKRAB"] + "cek_stock_akrab", timeout=10)
-            data = res.json()
-            # Simpan ke cache
-            if isinstance(data.get("data"), list):
-                produk_cache["data"] = data["data"]
-                produk_cache["last_updated"] = current_time
-        
-        keyboard = []
-        
-        # Dapatkan semua produk dari database admin
-        admin_produk = get_all_produk_admin()
+# Keyboard produk yang sudah dirender, per versi katalog: {(versi, is_admin): [InlineKeyboardMarkup, ...]}
+_keyboard_cache = {}
+_keyboard_cache_lock = threading.Lock()
+
+def _render_produk_pages(k, is_admin):
+    tombol = []
+    
+    for produk in k.produk_api:
+        kode = produk['type']
+        nama = produk['nama']
+        slot = int(produk.get('sisa_slot', 0))
+        harga = k.harga(kode)
         
-        if isinstance(data.get("data"), list):
-            for produk in data["data"]:
-                kode = produk['type']
-                nama = produk['nama']
-                slot = int(produk.get('sisa_slot', 0))
-                harga = get_harga_produk(kode, produk)
-                
-                # Untuk admin, tampilkan semua produk bahkan yang stok 0
-                if is_admin:
-                    status = "✅" if slot > 0 else "❌"
-                    label = f"{status} [{kode}] {nama} | Rp{harga:,}"
-                    keyboard.append([InlineKeyboardButton(label, callback_data=f"admin_produk_detail|{kode}")])
-                else:
-                    # Untuk user biasa, hanya tampilkan yang stok > 0
-                    if slot > 0:
-                        label = f"✅ [{kode}] {nama} | Rp{harga:,}"
-                        keyboard.append([InlineKeyboardButton(label, callback_data=f"produk|{kode}|{nama}")])
+        # Untuk admin, tampilkan semua produk bahkan yang stok 0
+        if is_admin:
+            status = "✅" if slot > 0 else "❌"
+            label = f"{status} [{kode}] {nama} | Rp{harga:,}"
+            tombol.append([InlineKeyboardButton(label, callback_data=f"admin_produk_detail|{kode}")])
+        else:
+            # Untuk user biasa, hanya tampilkan yang stok > 0
+            if slot > 0:
+                label = f"✅ [{kode}] {nama} | Rp{harga:,}"
+                tombol.append([InlineKeyboardButton(label, callback_data=f"produk|{kode}|{nama}")])
+    
+    # Tambahkan produk yang ada di database admin tapi tidak di API
+    if is_admin:
+        for kode in k.hanya_admin:
+            label = f"⚠️ [{kode}] (Tidak di API) | Rp{k.admin[kode]['harga'] or 0:,}"
+            tombol.append([InlineKeyboardButton(label, callback_data=f"admin_produk_detail|{kode}")])
+    
+    if not tombol:
+        tombol.append([InlineKeyboardButton("❌ Tidak ada produk tersedia", callback_data="disabled_produk")])
+    
+    prefix = "admin_produk_page" if is_admin else "produk_page"
+    total_pages = (len(tombol) + PRODUK_PER_PAGE - 1) // PRODUK_PER_PAGE
+    pages = []
+    for page in range(total_pages):
+        keyboard = tombol[page * PRODUK_PER_PAGE:(page + 1) * PRODUK_PER_PAGE]
+        nav = btn_navigasi(prefix, page, total_pages)
+        if nav:
+            keyboard.append(nav)
+        keyboard.append(btn_kembali())
+        pages.append(InlineKeyboardMarkup(keyboard))
+    return pages
+
+def produk_inline_keyboard(is_admin=False, page=0):
+    try:
+        # Selalu pakai snapshot terakhir; refresh dilakukan job_refresh_katalog di JobQueue
+        k = katalog
         
-        # Tambahkan produk yang ada di database admin tapi tidak di API
-        for kode, info in admin_produk.items():
-            if not any(kode == p['type'] for p in data.get("data", [])):
-                label = f"⚠️ [{kode}] (Tidak di API) | Rp{info['harga']:,}"
-                if is_admin:
-                    keyboard.append([InlineKeyboardButton(label, callback_data=f"admin_produk_detail|{kode}")])
+        # Hanya jika belum pernah ada data sama sekali, ambil langsung (blocking)
+        if not k.produk_api:
+            k = ambil_stok_akrab()
         
-        if not keyboard:
-            keyboard.append([InlineKeyboardButton("❌ Tidak ada produk tersedia", callback_data="disabled_produk")])
-        keyboard.append(btn_kembali())
-        return InlineKeyboardMarkup(keyboard)
+        key = (k.versi, is_admin)
+        pages = _keyboard_cache.get(key)
+        if pages is None:
+            pages = _render_produk_pages(k, is_admin)
+            with _keyboard_cache_lock:
+                # Buang hasil render versi katalog lama
+                for old in [c for c in _keyboard_cache if c[0] != k.versi]:
+                    del _keyboard_cache[old]
+                _keyboard_cache[key] = pages
+        return pages[max(0, min(page, len(pages) - 1))]
     except Exception as e:
         logger.error(f"Error loading products: {e}")
         return InlineKeyboardMarkup([[InlineKeyboardButton("🔄 Ulangi", callback_data="beli_produk")], btn_kembali()])
@@ -556,49 +1842,53 @@ def beli_produk_menu(update: Update, context: CallbackContext):
     query = update.callback_query
     query.answer()
     
-    # Kirim pesan loading terlebih dahulu
-    query.edit_message_text(
-        "🔄 Memuat daftar produk...",
-        reply_markup=InlineKeyboardMarkup([btn_kembali()])
-    )
+    # Kirim pesan loading hanya jika katalog masih kosong (fetch pertama bisa butuh waktu)
+    if not katalog.produk_api:
+        query.edit_message_text(
+            "🔄 Memuat daftar produk...",
+            reply_markup=InlineKeyboardMarkup([btn_kembali()])
+        )
     
-    # Dapatkan keyboard produk (mungkin butuh waktu)
     keyboard = produk_inline_keyboard()
     
     # Update pesan dengan daftar produk
     query.edit_message_text(
-        "🛒 <b>PILIH PRODUK</b>\n\nPilih produk yang ingin dibeli:",
+        "🛒 <b>PILIH PRODUK</b>\n\nPilih produk yang ingin dibeli:\n" + katalog.info_stale(),
         parse_mode=ParseMode.HTML,
         reply_markup=keyboard
     )
     return CHOOSING_PRODUK
 
+def produk_page_callback(update: Update, context: CallbackContext):
+    query = update.callback_query
+    query.answer()
+    is_admin = query.data.startswith("admin_produk_page|")
+    try:
+        page = int(query.data.split("|")[1])
+    except (ValueError, IndexError):
+        page = 0
+    query.edit_message_reply_markup(reply_markup=produk_inline_keyboard(is_admin=is_admin, page=page))
+    return ADMIN_CEKUSER if is_admin else CHOOSING_PRODUK
+
 def pilih_produk_callback(update: Update, context: CallbackContext):
     query = update.callback_query
     data = query.data
-    if data.startswith("produk|"):
+    if data.startswith("produk_page|"):
+        return produk_page_callback(update, context)
+    elif data == "noop":
+        query.answer()
+        return CHOOSING_PRODUK
+    elif data.startswith("produk|"):
         try:
             _, kode, nama = data.split("|")
             
             # Dapatkan harga produk dari cache jika tersedia
-            harga = 0
-            produk_api = None
-            
-            if produk_cache["data"]:
-                for p in produk_cache["data"]:
-                    if p["type"] == kode:
-                        produk_api = p
-                        break
+            produk_api = katalog.get(kode)
             
             # Jika tidak ditemukan di cache, cari di API
             if not produk_api:
                 try:
-                    res = requests.get(cfg["BASE_URL_AKRAB"] + "cek_stock_akrab", timeout=10)
-                    data_api = res.json()
-                    for p in data_api.get("data", []):
-                        if p["type"] == kode:
-                            produk_api = p
-                            break
+                    produk_api = ambil_stok_akrab().get(kode)
                 except Exception:
                     pass
             
@@ -606,8 +1896,7 @@ def pilih_produk_callback(update: Update, context: CallbackContext):
             
             context.user_data["produk"] = {"kode": kode, "nama": nama, "harga": harga}
             
-            admin_data = get_produk_admin(kode)
-            deskripsi = admin_data["deskripsi"] if admin_data and admin_data["deskripsi"] else ""
+            deskripsi = katalog.deskripsi(kode)
             if deskripsi:
                 desc_show = f"\n📝 <b>Deskripsi:</b>\n<code>{deskripsi}</code>\n"
             else:
@@ -639,8 +1928,7 @@ def input_tujuan_step(update: Update, context: CallbackContext):
         return INPUT_TUJUAN
     context.user_data["tujuan"] = tujuan
     produk = context.user_data["produk"]
-    admin_data = get_produk_admin(produk["kode"])
-    deskripsi = admin_data["deskripsi"] if admin_data and admin_data["deskripsi"] else ""
+    deskripsi = katalog.deskripsi(produk["kode"])
     if deskripsi:
         desc_show = f"\n📝 <b>Deskripsi:</b>\n<code>{deskripsi}</code>\n"
     else:
@@ -657,6 +1945,112 @@ def input_tujuan_step(update: Update, context: CallbackContext):
     )
     return KONFIRMASI
 
+def pesan_order(order, status_text, keterangan):
+    emoji = {ORDER_SUCCESS: "✅", ORDER_FAILED: "❌"}.get(order["status"], "⏳")
+    judul = {
+        ORDER_QUEUED: "PESANAN DITERIMA",
+        ORDER_SUBMITTED: "PESANAN DIKIRIM KE PROVIDER",
+        ORDER_PENDING: "TRANSAKSI SEDANG DIPROSES",
+        ORDER_SUCCESS: "TRANSAKSI SUKSES",
+        ORDER_FAILED: "TRANSAKSI GAGAL",
+    }[order["status"]]
+    msg = (
+        f"{emoji} <b>{judul}</b>\n\n"
+        f"📦 <b>Produk:</b> [{order['produk']}] {order['nama_produk']}\n"
+        f"📱 <b>Tujuan:</b> {order['tujuan']}\n"
+        f"🔖 <b>RefID:</b> <code>{order['reffid']}</code>\n"
+        f"📊 <b>Status:</b> {status_text.upper()}\n"
+        f"💬 Keterangan: {keterangan}\n"
+    )
+    if order["status"] not in (ORDER_SUCCESS, ORDER_FAILED):
+        msg += "\nMohon tunggu beberapa saat untuk pembaruan status."
+    return msg
+
+# Kirim order ke provider dari worker pool; antrean hanya berisi reffid dari tabel orders
+class OrderPipeline:
+    def __init__(self, bot, workers=ORDER_WORKERS):
+        self.bot = bot
+        self.queue = queue.Queue()
+        self.workers = []
+        for i in range(workers):
+            t = threading.Thread(target=self._worker, name=f"order-worker-{i}")
+            t.daemon = True
+            t.start()
+            self.workers.append(t)
+
+    def submit(self, reffid):
+        self.queue.put(reffid)
+
+    def pulihkan(self):
+        # Order SUBMITTED saat proses mati tidak diketahui nasibnya di provider: riwayat PENDING-nya
+        # sudah ada sejak buat_order, jadi diselesaikan oleh webhook atau rekonsiliasi
+        for reffid in get_order_by_status(ORDER_SUBMITTED):
+            set_order_status(reffid, ORDER_PENDING, dari=(ORDER_SUBMITTED,))
+        for reffid in get_order_by_status(ORDER_QUEUED):
+            self.submit(reffid)
+
+    def edit_pesan(self, order, status_text, keterangan):
+        if not order.get("message_id"):
+            return
+        try:
+            self.bot.edit_message_text(
+                pesan_order(order, status_text, keterangan),
+                chat_id=order["chat_id"], message_id=order["message_id"],
+                parse_mode=ParseMode.HTML, reply_markup=get_menu(order["user_id"]))
+        except TelegramError as e:
+            logger.warning(f"Gagal edit pesan order {order['reffid']}: {e}")
+
+    def _worker(self):
+        while True:
+            reffid = self.queue.get()
+            try:
+                self._proses(reffid)
+            except Exception as e:
+                logger.error(f"[ORDER] Error memproses {reffid}: {e}", exc_info=True)
+            finally:
+                self.queue.task_done()
+
+    def _proses(self, reffid):
+        if not set_order_status(reffid, ORDER_SUBMITTED, dari=(ORDER_QUEUED,)):
+            return
+        order = get_order(reffid)
+        self.edit_pesan(order, "SUBMITTED", "Pesanan sedang dikirim ke provider.")
+        url = f"{BASE_URL}trx?produk={order['produk']}&tujuan={order['tujuan']}&reff_id={reffid}&api_key={API_KEY}"
+        try:
+            data = provider.get("trx", url).json()
+        except ProviderError as e:
+            if not e.terkirim:
+                # Request pasti belum sampai ke provider: tandai gagal, refund saldo dan status order sekaligus
+                proses_status_transaksi(reffid, "GAGAL", f"Gagal request ke provider. Detail: {e}")
+                return
+            # Timeout dsb: provider mungkin sudah menerima trx, biarkan PENDING sampai webhook/rekonsiliasi
+            data = {"status": "PENDING", "message": "Menunggu konfirmasi provider."}
+            logger.warning(f"[ORDER] {reffid} tidak jelas terkirim atau tidak: {e}")
+        except ValueError as e:
+            data = {"status": "PENDING", "message": "Menunggu konfirmasi provider."}
+            logger.warning(f"[ORDER] {reffid} respon provider tidak terbaca: {e}")
+        if not isinstance(data, dict):
+            data = {}
+        
+        status_text = data.get('status', 'PENDING')
+        keterangan = data.get('message', 'Transaksi sedang diproses.')
+        
+        if status_final(status_text):
+            # Provider langsung menjawab sukses/gagal: terapkan seperti webhook (termasuk refund)
+            proses_status_transaksi(reffid, status_text, keterangan)
+            return
+        with db_transaksi(immediate=True):
+            # Webhook bisa sudah lebih dulu memfinalkan transaksi; status final tidak ditimpa
+            riwayat = get_riwayat_by_refid(reffid)
+            if riwayat and not status_final(riwayat[6]):
+                update_riwayat_status(reffid, status_text, keterangan)
+            set_order_status(reffid, ORDER_PENDING, keterangan, dari=(ORDER_SUBMITTED,))
+        order = get_order(reffid)
+        if order["status"] == ORDER_PENDING:
+            self.edit_pesan(order, status_text, keterangan)
+
+order_pipeline = None
+
 def konfirmasi_step(update: Update, context: CallbackContext):
     text = update.message.text.strip().upper()
     if text == "BATAL":
@@ -674,42 +2068,25 @@ def konfirmasi_step(update: Update, context: CallbackContext):
     if harga <= 0:
         harga = get_harga_produk(produk["kode"])
     
-    saldo = get_saldo(user.id)
-    if saldo < harga:
-        update.message.reply_text("❌ Saldo Anda tidak cukup.", reply_markup=get_menu(user.id))
-        return ConversationHandler.END
-        
-    # Kurangi saldo di awal
-    kurang_saldo(user.id, harga)
-    
     reffid = str(uuid.uuid4())
-    url = f"{BASE_URL}trx?produk={produk['kode']}&tujuan={tujuan}&reff_id={reffid}&api_key={API_KEY}"
     
-    try:
-        data = requests.get(url, timeout=15).json()
-    except Exception as e:
-        # Jika request gagal, kembalikan saldo
-        tambah_saldo(user.id, harga)
-        update.message.reply_text(f"❌ Gagal request ke provider. Saldo Anda telah dikembalikan.\n\nDetail: {e}", reply_markup=get_menu(user.id))
+    # Cek dan kurangi saldo lalu antrekan order dalam satu transaksi
+    if buat_order(reffid, user.id, produk["kode"], produk["nama"], tujuan, harga, update.effective_chat.id) != MUTASI_OK:
+        update.message.reply_text("❌ Saldo Anda tidak cukup.", reply_markup=get_menu(user.id))
         return ConversationHandler.END
-        
-    status_text = data.get('status', 'PENDING')
-    keterangan = data.get('message', 'Transaksi sedang diproses.')
-    
-    # Catat transaksi sebagai PENDING
-    log_riwayat(reffid, user.id, produk["kode"], tujuan, harga, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), status_text, keterangan)
     
-    update.message.reply_text(
-        f"⏳ <b>TRANSAKSI SEDANG DIPROSES</b>\n\n"
-        f"📦 <b>Produk:</b> [{produk['kode']}] {produk['nama']}\n"
-        f"📱 <b>Tujuan:</b> {tujuan}\n"
-        f"🔖 <b>RefID:</b> <code>{reffid}</code>\n"
-        f"📊 <b>Status:</b> {status_text.upper()}\n"
-        f"💬 Keterangan: {keterangan}\n\n"
-        f"Mohon tunggu beberapa saat untuk pembaruan status.",
-        parse_mode=ParseMode.HTML,
-        reply_markup=get_menu(user.id)
-    )
+    # Balas langsung; worker order akan mengedit pesan ini saat status berubah.
+    # Order tetap diantrekan walau balasan gagal terkirim, karena saldo sudah dipotong.
+    try:
+        order = get_order(reffid)
+        msg = update.message.reply_text(
+            pesan_order(order, ORDER_QUEUED, "Pesanan masuk antrean."),
+            parse_mode=ParseMode.HTML,
+            reply_markup=get_menu(user.id)
+        )
+        set_order_message(reffid, msg.message_id)
+    finally:
+        order_pipeline.submit(reffid)
     return ConversationHandler.END
 
 # ================= ADMIN PRODUK MANAGEMENT =================
@@ -729,22 +2106,12 @@ def admin_produk_detail(update: Update, context: CallbackContext):
         kode = query.data.split("|")[1]
         
         # Coba dapatkan info produk dari cache
-        produk_api = None
-        if produk_cache["data"]:
-            for p in produk_cache["data"]:
-                if p["type"] == kode:
-                    produk_api = p
-                    break
+        produk_api = katalog.get(kode)
         
         # Jika tidak ditemukan di cache, coba dari API
         if not produk_api:
             try:
-                res = requests.get(cfg["BASE_URL_AKRAB"] + "cek_stock_akrab", timeout=10)
-                data = res.json()
-                for p in data.get("data", []):
-                    if p["type"] == kode:
-                        produk_api = p
-                        break
+                produk_api = ambil_stok_akrab().get(kode)
             except Exception:
                 pass
                 
@@ -895,25 +2262,73 @@ def admin_edit_deskripsi_step(update: Update, context: CallbackContext):
         update.message.reply_text("❌ Terjadi kesalahan saat mengupdate deskripsi.", reply_markup=InlineKeyboardMarkup([btn_kembali()]))
     return ConversationHandler.END
 
-def admin_cekuser_menu(update: Update, context: CallbackContext):
+# Pesan dan keyboard satu halaman direktori user (hasil pencarian jika ada kata kunci)
+def admin_user_directory(context, page=0):
+    cari = context.user_data.get("cari_user")
+    cursors = context.user_data.get("cekuser_cursor") if page > 0 else None
+    if not cursors or page >= len(cursors):
+        cursors, page = [None], 0
+    if cari:
+        rows = cari_user(cari, cursors[page], USER_PER_PAGE + 1)
+    else:
+        rows = get_users_page(cursors[page], USER_PER_PAGE + 1)
+    ada_berikutnya = len(rows) > USER_PER_PAGE
+    rows = rows[:USER_PER_PAGE]
+    del cursors[page + 1:]
+    if ada_berikutnya:
+        cursors.append(rows[-1][0])
+    context.user_data["cekuser_cursor"] = cursors
+    
+    keyboard = []
+    for u in rows:
+        label = f"{u[2]} (@{u[1]}) [{u[0]}]"
+        keyboard.append([InlineKeyboardButton(label, callback_data=f"admin_cekuser_detail|{u[0]}")])
+    nav = btn_navigasi("admin_cekuser_page", page, ada_berikutnya=ada_berikutnya)
+    if nav:
+        keyboard.append(nav)
+    if cari:
+        msg = f"🔍 <b>HASIL PENCARIAN USER</b>\n\nKata kunci: <code>{html.escape(cari)}</code>\n"
+        if not rows:
+            msg += "\nTidak ada user yang cocok."
+        keyboard.append([InlineKeyboardButton("🔍 Cari Lagi", callback_data="admin_cari_user"),
+                         InlineKeyboardButton("❌ Hapus Pencarian", callback_data="admin_cekuser")])
+    else:
+        msg = "👥 <b>DAFTAR USER TERDAFTAR</b>\n\nPilih user untuk melihat detail:"
+        keyboard.append([InlineKeyboardButton("🔍 Cari User", callback_data="admin_cari_user")])
+    keyboard.append(btn_kembali())
+    return msg, InlineKeyboardMarkup(keyboard)
+
+def admin_cekuser_menu(update: Update, context: CallbackContext, page=0):
     query = update.callback_query
     try:
-        users = get_all_users()
-        keyboard = []
-        for u in users:
-            label = f"{u[2]} (@{u[1]}) [{u[0]}]"
-            keyboard.append([InlineKeyboardButton(label, callback_data=f"admin_cekuser_detail|{u[0]}")])
-        keyboard.append(btn_kembali())
-        query.edit_message_text(
-            "👥 <b>DAFTAR USER TERDAFTAR</b>\n\nPilih user untuk melihat detail:",
-            parse_mode=ParseMode.HTML,
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+        if page == 0 and query.data == "admin_cekuser":
+            context.user_data["cari_user"] = None
+        msg, keyboard = admin_user_directory(context, page)
+        query.edit_message_text(msg, parse_mode=ParseMode.HTML, reply_markup=keyboard)
     except Exception as e:
         logger.error(f"Error in admin_cekuser_menu: {e}")
         query.edit_message_text("❌ Terjadi kesalahan saat memuat daftar user.", reply_markup=InlineKeyboardMarkup([btn_kembali()]))
     return ConversationHandler.END
 
+def admin_cari_user(update: Update, context: CallbackContext):
+    query = update.callback_query
+    query.edit_message_text(
+        "🔍 <b>CARI USER</b>\n\nKetik sebagian nama, username atau ID user:",
+        parse_mode=ParseMode.HTML,
+        reply_markup=InlineKeyboardMarkup([btn_kembali()])
+    )
+    return ADMIN_CARI_USER
+
+def admin_cari_user_step(update: Update, context: CallbackContext):
+    try:
+        context.user_data["cari_user"] = update.message.text.strip()[:64]
+        msg, keyboard = admin_user_directory(context)
+        update.message.reply_text(msg, parse_mode=ParseMode.HTML, reply_markup=keyboard)
+    except Exception as e:
+        logger.error(f"Error in admin_cari_user_step: {e}")
+        update.message.reply_text("❌ Terjadi kesalahan saat mencari user.", reply_markup=InlineKeyboardMarkup([btn_kembali()]))
+    return ConversationHandler.END
+
 def admin_cekuser_detail_callback(update: Update, context: CallbackContext):
     query = update.callback_query
     try:
@@ -922,8 +2337,7 @@ def admin_cekuser_detail_callback(update: Update, context: CallbackContext):
             user_id = int(query.data.split("|")[1])
             user = get_user(user_id)
             if user:
-                saldo = get_saldo(user_id)
-                jml_transaksi = get_riwayat_jml(user_id)
+                saldo, jml_transaksi, _ = get_ringkasan_user(user_id)
                 msg = (
                     f"👤 <b>DETAIL USER</b>\n\n"
                     f"<b>Nama:</b> {user[2]}\n"
@@ -977,46 +2391,168 @@ def topup_kode_unik_menu(update, context):
     return INPUT_KODE_UNIK
 
 def input_kode_unik_step(update, context):
-    kode = update.message.text.strip()
+    kode = normalisasi_kode(update.message.text)
     user = update.effective_user
     
-    # Cek kode unik
-    kode_data = get_kode_unik(kode)
-    if not kode_data:
-        update.message.reply_text("❌ Kode unik tidak valid atau tidak ditemukan.", reply_markup=InlineKeyboardMarkup([btn_kembali()]))
-        return INPUT_KODE_UNIK
-        
-    if kode_data["digunakan"]:
-        update.message.reply_text("❌ Kode unik sudah digunakan.", reply_markup=InlineKeyboardMarkup([btn_kembali()]))
+    sisa = kode_unik_filter.sisa_blokir(user.id)
+    if sisa:
+        update.message.reply_text(f"⛔ Terlalu banyak kode salah. Coba lagi dalam {sisa // 60 + 1} menit.",
+                                  reply_markup=get_menu(user.id))
+        return ConversationHandler.END
+    
+    # Kode yang tidak ada di filter ditolak tanpa query database; sisanya ditukar secara atomik
+    nominal = tukar_kode_unik(kode, user.id) if kode_unik_filter.ada(kode) else None
+    if nominal is None:
+        kode_unik_filter.buang(kode)
+        kode_unik_filter.catat_gagal(user.id)
+        update.message.reply_text("❌ Kode unik tidak valid atau sudah digunakan.", reply_markup=InlineKeyboardMarkup([btn_kembali()]))
         return INPUT_KODE_UNIK
-        
-    # Gunakan kode unik
-    tambah_saldo(user.id, kode_data["nominal"])
-    gunakan_kode_unik(kode)
+    kode_unik_filter.buang(kode)
     
     update.message.reply_text(
         f"✅ <b>TOP UP BERHASIL</b>\n\n"
-        f"Kode unik: <b>{kode}</b>\n"
-        f"Nominal: <b>Rp {kode_data['nominal']:,}</b>\n"
+        f"Kode unik: <b>{format_kode(kode)}</b>\n"
+        f"Nominal: <b>Rp {nominal:,}</b>\n"
         f"Saldo sekarang: <b>Rp {get_saldo(user.id):,}</b>",
         parse_mode=ParseMode.HTML,
         reply_markup=get_menu(user.id)
     )
     return ConversationHandler.END
 
+# PNG QRIS dinamis untuk nominal: (True, png_bytes) atau (False, pesan_error)
 def generate_qris(amount, qris_statis):
+    try:
+        payload = qris.qris_dinamis(qris_statis, amount)
+    except qris.QrisError as e:
+        logger.error(f"QRIS_STATIS tidak valid: {e}")
+        return False, f"QRIS statis tidak valid: {e}"
+    if qris.RENDER_TERSEDIA:
+        return True, qris.render_png(payload)
+    # Library qrcode belum terpasang: render lewat API qrisku seperti sebelumnya
     url = "https://qrisku.my.id/api"
-    payload = {"amount": str(amount), "qris_statis": qris_statis}
     try:
-        res = requests.post(url, json=payload, timeout=20)
+        res = provider.post("qris", url, json={"amount": str(amount), "qris_statis": qris_statis})
         data = res.json()
         if data['status'] == 'success' and 'qris_base64' in data:
-            return True, data['qris_base64']
+            return True, base64.b64decode(data['qris_base64'])
         else:
             return False, data.get('message', 'Gagal generate QRIS')
     except Exception as e:
         return False, f"Error koneksi API QRIS: {e}"
 
+# LRU gambar QRIS per nominal dibatasi total byte; setelah terkirim cukup simpan file_id
+class QrisCache:
+    OVERHEAD = 100  # perkiraan byte per entri di luar isi gambar/file_id
+
+    def __init__(self, max_bytes=QRIS_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._data = OrderedDict()  # nominal -> (png_bytes atau None, file_id atau None)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def _ukuran(cls, entri):
+        png, file_id = entri
+        return cls.OVERHEAD + (len(png) if png else 0) + (len(file_id) if file_id else 0)
+
+    # file_id jika ada, selain itu byte PNG, atau None
+    def get(self, nominal):
+        with self._lock:
+            entri = self._data.get(nominal)
+            if entri is None:
+                return None
+            self._data.move_to_end(nominal)
+            return entri[1] or entri[0]
+
+    def _simpan(self, nominal, entri):
+        with self._lock:
+            lama = self._data.pop(nominal, None)
+            if lama is not None:
+                self.bytes -= self._ukuran(lama)
+            ukuran = self._ukuran(entri)
+            if ukuran > self.max_bytes:
+                return
+            self._data[nominal] = entri
+            self.bytes += ukuran
+            while self.bytes > self.max_bytes:
+                _, dibuang = self._data.popitem(last=False)
+                self.bytes -= self._ukuran(dibuang)
+
+    def simpan_gambar(self, nominal, png):
+        self._simpan(nominal, (png, None))
+
+    def simpan_file_id(self, nominal, file_id):
+        self._simpan(nominal, (None, file_id))
+
+    def hapus(self, nominal):
+        with self._lock:
+            lama = self._data.pop(nominal, None)
+            if lama is not None:
+                self.bytes -= self._ukuran(lama)
+
+qris_cache = QrisCache()
+
+# Foto QRIS siap kirim: file_id/bytes dari cache, atau generate baru
+def foto_qris(nominal):
+    foto = qris_cache.get(nominal)
+    if foto is not None:
+        return True, foto
+    sukses, hasil = generate_qris(nominal, QRIS_STATIS)
+    if sukses:
+        qris_cache.simpan_gambar(nominal, hasil)
+    return sukses, hasil
+
+KOLOM_MUTASI = {
+    "nominal": ("nominal", "amount", "jumlah", "kredit", "credit", "mutasi"),
+    "ref": ("ref", "reff", "id", "no", "reference", "referensi"),
+    "keterangan": ("keterangan", "deskripsi", "description", "berita", "catatan"),
+    "jenis": ("jenis", "tipe", "type", "db/cr"),
+}
+
+# 'Rp 10.123' / '10,123.00' -> 10123, negatif untuk debit; None bila kosong atau ada sen
+def parse_nominal(teks):
+    teks = (teks or "").strip()
+    angka = re.sub(r"[^\d.,]", "", teks)
+    m = re.fullmatch(r"(.*?)[.,](\d{2})", angka)
+    if m:
+        if m.group(2) != "00":
+            return None
+        angka = m.group(1)
+    digit = re.sub(r"\D", "", angka)
+    if not digit:
+        return None
+    debit = teks.startswith("-") or teks.upper().endswith(("DB", " D"))
+    return -int(digit) if debit else int(digit)
+
+# CSV mutasi (ber-header) -> [(ref, nominal, keterangan)]; tanpa kolom ref dipakai hash baris
+def baca_csv_mutasi(data):
+    teks = data.decode("utf-8-sig", errors="replace")
+    try:
+        dialect = csv.Sniffer().sniff(teks[:4096], delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    reader = csv.reader(io.StringIO(teks), dialect)
+    header = [h.strip().lower() for h in next(reader, [])]
+    kolom = {nama: next((i for i, h in enumerate(header) if h in alias), None)
+             for nama, alias in KOLOM_MUTASI.items()}
+    if kolom["nominal"] is None:
+        raise ValueError(f"Kolom nominal tidak ditemukan (header: {', '.join(header) or '-'})")
+
+    def ambil(row, nama):
+        i = kolom[nama]
+        return row[i].strip() if i is not None and i < len(row) else ""
+
+    hasil = []
+    for row in reader:
+        if ambil(row, "jenis").upper().startswith("D"):
+            continue
+        nominal = parse_nominal(ambil(row, "nominal"))
+        if not nominal or nominal <= 0:
+            continue
+        ref = ambil(row, "ref") or hashlib.sha1("|".join(row).encode("utf-8")).hexdigest()
+        hasil.append((ref, nominal, ambil(row, "keterangan")))
+    return hasil
+
 def topup_amount_step(update, context):
     try:
         nominal = int(update.message.text.replace(".", "").replace(",", ""))
@@ -1028,41 +2564,48 @@ def topup_amount_step(update, context):
         
     user = update.effective_user
     
-    # Tambahkan nominal unik
-    unique_code = random.randint(100, 999)
-    final_nominal = nominal + unique_code
+    # Tambahkan angka unik yang tidak dipakai top up pending lain, supaya pembayaran bisa dicocokkan otomatis
+    topup_id = str(uuid.uuid4())
+    final_nominal = alokasi_topup_pending(topup_id, user.id, user.username or "", user.full_name, nominal,
+                                          datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    if final_nominal is None:
+        update.message.reply_text("❌ Terlalu banyak top up dengan nominal ini yang sedang menunggu. Coba nominal lain atau beberapa saat lagi.",
+                                  reply_markup=get_menu(user.id))
+        return ConversationHandler.END
+    unique_code = final_nominal - nominal
     
-    sukses, hasil = generate_qris(final_nominal, QRIS_STATIS)
+    sukses, hasil = foto_qris(final_nominal)
     if sukses:
         try:
-            img_bytes = base64.b64decode(hasil)
-            topup_id = str(uuid.uuid4())
-            insert_topup_pending(topup_id, user.id, user.username or "", user.full_name, final_nominal, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "pending")
-            
-            # Notify admins
-            for adm in ADMIN_IDS:
-                try:
-                    context.bot.send_message(
-                        chat_id=adm,
-                        text=f"🔔 Permintaan top up QRIS baru!\nUser: <b>{user.full_name}</b> (@{user.username or '-'})\nID: <code>{user.id}</code>\nNominal: <b>Rp {final_nominal:,}</b>\n\nSilakan cek menu Approve Top Up QRIS.",
-                        parse_mode=ParseMode.HTML)
-                except Exception as e:
-                    logger.error(f"Notif admin gagal: {e}")
+            # Notify admins (diantrekan, tidak menahan balasan ke user)
+            nama = html.escape(user.full_name)
+            admin_notifier.kirim(
+                "topup_baru",
+                f"🔔 Permintaan top up QRIS baru!\nUser: <b>{nama}</b> (@{user.username or '-'})\nID: <code>{user.id}</code>\nNominal: <b>Rp {final_nominal:,}</b>\n\nSilakan cek menu Approve Top Up QRIS.",
+                f"💳 Rp {final_nominal:,} - {nama} (<code>{user.id}</code>)")
                     
-            update.message.reply_photo(photo=img_bytes, caption=(
+            msg = update.message.reply_photo(photo=hasil, caption=(
                 f"💰 <b>QRIS UNTUK TOP UP</b>\n\n"
                 f"Nominal: <b>Rp {final_nominal:,}</b>\n"
                 f"Kode unik: <b>{unique_code}</b>\n\n"
-                "Scan QRIS di atas menggunakan aplikasi e-wallet atau mobile banking Anda.\n\n"
-                "Setelah transfer, klik tombol di bawah untuk upload bukti transfer."
+                "Scan QRIS di atas menggunakan aplikasi e-wallet atau mobile banking Anda.\n"
+                "Transfer <b>tepat</b> sesuai nominal (termasuk kode unik) agar saldo masuk otomatis.\n\n"
+                "Jika saldo belum masuk, klik tombol di bawah untuk upload bukti transfer."
             ), parse_mode=ParseMode.HTML, reply_markup=InlineKeyboardMarkup([
                 [InlineKeyboardButton("📤 Upload Bukti Transfer", callback_data=f"topup_upload|{topup_id}")],
                 btn_kembali()
             ]))
+            if msg.photo and not isinstance(hasil, str):
+                # Gambar baru saja di-upload; kirim berikutnya cukup dengan file_id
+                qris_cache.simpan_file_id(final_nominal, msg.photo[-1].file_id)
         except Exception as e:
             logger.error(f"Error QRIS: {e}")
-            update.message.reply_text("❌ Gagal decode gambar QRIS.", reply_markup=get_menu(user.id))
+            # file_id di cache bisa saja sudah tidak berlaku; generate ulang di permintaan berikutnya
+            qris_cache.hapus(final_nominal)
+            update.message.reply_text("❌ Gagal mengirim gambar QRIS.", reply_markup=get_menu(user.id))
     else:
+        # Lepas nominal yang sudah dialokasikan
+        update_topup_status(topup_id, "batal")
         update.message.reply_text(f"❌ Gagal membuat QRIS: {hasil}", reply_markup=get_menu(user.id))
         
     return ConversationHandler.END
@@ -1096,17 +2639,23 @@ def topup_upload_step(update, context):
         
     file_id = update.message.photo[-1].file_id
     caption = update.message.caption or ""
-    update_topup_bukti(topup_id, file_id, caption)
+    if not update_topup_bukti(topup_id, file_id, caption):
+        context.user_data['topup_upload_id'] = None
+        r = get_topup_by_id(topup_id)
+        if r and r[6] == "approved":
+            teks = "✅ Top up ini sudah disetujui, saldo sudah masuk."
+        else:
+            teks = ("⌛ Top up ini sudah kedaluwarsa atau dibatalkan. Silakan buat top up baru.\n"
+                    "Jika Anda sudah transfer, hubungi admin dengan bukti transfer.")
+        update.message.reply_text(teks, reply_markup=get_menu(user.id))
+        return ConversationHandler.END
     
-    # Notify admins
-    for adm in ADMIN_IDS:
-        try:
-            context.bot.send_message(
-                chat_id=adm,
-                text=f"🔔 Bukti transfer QRIS masuk dari user <b>{user.full_name}</b> (@{user.username or '-'})",
-                parse_mode=ParseMode.HTML)
-        except Exception as e:
-            logger.error(f"Notif admin gagal: {e}")
+    # Notify admins (diantrekan, tidak menahan balasan ke user)
+    nama = html.escape(user.full_name)
+    admin_notifier.kirim(
+        "bukti_topup",
+        f"🔔 Bukti transfer QRIS masuk dari user <b>{nama}</b> (@{user.username or '-'})",
+        f"📤 Bukti dari {nama} (<code>{user.id}</code>)")
             
     context.user_data['topup_upload_id'] = None
     update.message.reply_text("✅ Bukti transfer berhasil dikirim. Silakan tunggu admin verifikasi.", reply_markup=get_menu(user.id))
@@ -1120,7 +2669,7 @@ def topup_riwayat_menu(update: Update, context: CallbackContext):
         msg += "Belum ada permintaan top up."
     else:
         for r in items:
-            emoji = "⏳" if r[6]=="pending" else ("✅" if r[6]=="approved" else "❌")
+            emoji = "⏳" if r[6]=="pending" else ("✅" if r[6]=="approved" else ("⌛" if r[6]=="expired" else "❌"))
             msg += (
                 f"{emoji} <b>{r[5]}</b>\n"
                 f"ID: <code>{r[0]}</code>\n"
@@ -1146,7 +2695,7 @@ def my_kode_unik_menu(update: Update, context: CallbackContext):
         for kode in items:
             status = "✅ Digunakan" if kode["digunakan"] else "⏳ Belum digunakan"
             msg += (
-                f"Kode: <code>{kode['kode']}</code>\n"
+                f"Kode: <code>{format_kode(kode['kode'])}</code>\n"
                 f"Nominal: Rp {kode['nominal']:,}\n"
                 f"Status: {status}\n"
                 f"Dibuat: {kode['dibuat_pada']}\n\n"
@@ -1218,8 +2767,12 @@ def admin_topup_action(update: Update, context: CallbackContext):
             return ConversationHandler.END
             
         if action == "approve":
-            tambah_saldo(r[1], r[4])
-            update_topup_status(topup_id, "approved")
+            with db_transaksi(immediate=True):
+                diproses = (update_topup_status(topup_id, "approved")
+                            and kredit_saldo(r[1], r[4], topup_id, "topup") == MUTASI_OK)
+            if not diproses:
+                query.answer("⚠️ Top up ini sudah diproses.", show_alert=True)
+                return admin_topup_pending_menu(update, context)
             try:
                 context.bot.send_message(r[1], 
                     f"✅ <b>TOP UP DISETUJUI</b>\n\n"
@@ -1231,7 +2784,9 @@ def admin_topup_action(update: Update, context: CallbackContext):
                 logger.error(f"Notif approve gagal: {e}")
             query.answer("✅ Top up berhasil disetujui.", show_alert=True)
         elif action == "reject":
-            update_topup_status(topup_id, "rejected")
+            if not update_topup_status(topup_id, "rejected"):
+                query.answer("⚠️ Top up ini sudah diproses.", show_alert=True)
+                return admin_topup_pending_menu(update, context)
             try:
                 context.bot.send_message(r[1], 
                     f"❌ <b>TOP UP DITOLAK</b>\n\n"
@@ -1248,36 +2803,90 @@ def admin_topup_action(update: Update, context: CallbackContext):
         query.edit_message_text("❌ Terjadi kesalahan saat memproses aksi.", reply_markup=InlineKeyboardMarkup([btn_kembali()]))
         return ConversationHandler.END
 
+def admin_import_mutasi(update: Update, context: CallbackContext):
+    query = update.callback_query
+    if query.from_user.id not in ADMIN_IDS:
+        query.answer()
+        return ConversationHandler.END
+    query.edit_message_text(
+        "📥 <b>IMPORT MUTASI</b>\n\nKirim file CSV mutasi masuk (ber-header). Kolom yang dikenali: "
+        "nominal/amount/kredit, ref/id (opsional), keterangan (opsional), jenis/type (baris debit dilewati).\n\n"
+        "Top up pending yang nominalnya cocok akan di-approve otomatis.",
+        parse_mode=ParseMode.HTML,
+        reply_markup=InlineKeyboardMarkup([btn_kembali()])
+    )
+    return ADMIN_IMPORT_MUTASI
+
+def admin_import_mutasi_step(update: Update, context: CallbackContext):
+    if update.effective_user.id not in ADMIN_IDS:
+        return ConversationHandler.END
+    try:
+        data = bytes(context.bot.get_file(update.message.document.file_id).download_as_bytearray())
+        mutasi = baca_csv_mutasi(data)
+    except ValueError as e:
+        update.message.reply_text(f"❌ {e}", reply_markup=InlineKeyboardMarkup([btn_kembali()]))
+        return ADMIN_IMPORT_MUTASI
+    except Exception as e:
+        logger.error(f"Error import mutasi: {e}", exc_info=True)
+        update.message.reply_text("❌ Gagal membaca file.", reply_markup=InlineKeyboardMarkup([btn_kembali()]))
+        return ConversationHandler.END
+    
+    r = proses_mutasi(mutasi, "csv", notif_admin=False)
+    update.message.reply_text(
+        f"📥 <b>IMPORT MUTASI SELESAI</b>\n\n"
+        f"Baris mutasi masuk: {len(mutasi)}\n"
+        f"✅ Cocok & di-approve: {r['cocok']}\n"
+        f"❔ Tidak ada top up cocok: {r['tidak_cocok']}\n"
+        f"⚠️ Lebih dari satu top up cocok: {r['ganda']}\n"
+        f"⌛ Cocok dengan top up kedaluwarsa/batal: {r['kedaluwarsa']}\n"
+        f"♻️ Sudah pernah diimport: {r['duplikat']}",
+        parse_mode=ParseMode.HTML,
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("✅ Approve Top Up", callback_data="admin_topup_pending")], btn_kembali()])
+    )
+    return ConversationHandler.END
+
 def admin_generate_kode(update: Update, context: CallbackContext):
     query = update.callback_query
+    if query.from_user.id not in ADMIN_IDS:
+        query.answer()
+        return ConversationHandler.END
     query.edit_message_text(
-        "🔑 <b>GENERATE KODE UNIK</b>\n\nMasukkan nominal untuk kode unik (min 10.000):",
+        "🔑 <b>GENERATE KODE UNIK</b>\n\nMasukkan nominal (min 10.000) dan jumlah kode, contoh:\n"
+        f"<code>50000</code> untuk 1 kode, <code>50000 20</code> untuk 20 kode (maks {KODE_UNIK_MAX_BATCH}).",
         parse_mode=ParseMode.HTML,
         reply_markup=InlineKeyboardMarkup([btn_kembali()])
     )
-    return INPUT_KODE_UNIK
+    return ADMIN_GENERATE_KODE
 
 def admin_generate_kode_step(update: Update, context: CallbackContext):
+    if update.effective_user.id not in ADMIN_IDS:
+        return ConversationHandler.END
     try:
-        nominal = int(update.message.text.replace(".", "").replace(",", ""))
+        bagian = update.message.text.split()
+        nominal = int(bagian[0].replace(".", "").replace(",", ""))
+        jumlah = int(bagian[1]) if len(bagian) > 1 else 1
         if nominal < 10000:
             update.message.reply_text("❌ Minimal nominal 10.000", reply_markup=InlineKeyboardMarkup([btn_kembali()]))
-            return INPUT_KODE_UNIK
+            return ADMIN_GENERATE_KODE
+        if not 1 <= jumlah <= KODE_UNIK_MAX_BATCH:
+            update.message.reply_text(f"❌ Jumlah kode 1 - {KODE_UNIK_MAX_BATCH}", reply_markup=InlineKeyboardMarkup([btn_kembali()]))
+            return ADMIN_GENERATE_KODE
             
-        kode = generate_kode_unik()
-        simpan_kode_unik(kode, update.effective_user.id, nominal)
+        kode_list = buat_kode_unik(update.effective_user.id, nominal, jumlah)
         
+        # KODE_UNIK_MAX_BATCH kode (~25 karakter per baris) masih di bawah MAX_MSG_CHARS
+        daftar = "\n".join(f"<code>{format_kode(kode)}</code>" for kode in kode_list)
         update.message.reply_text(
-            f"✅ <b>KODE UNIK BERHASIL DIBUAT</b>\n\n"
-            f"Kode: <code>{kode}</code>\n"
-            f"Nominal: <b>Rp {nominal:,}</b>\n\n"
+            f"✅ <b>{len(kode_list)} KODE UNIK BERHASIL DIBUAT</b>\n"
+            f"Nominal: <b>Rp {nominal:,}</b> per kode\n\n"
+            f"{daftar}\n\n"
             f"Berikan kode ini kepada user untuk top up saldo.",
             parse_mode=ParseMode.HTML,
             reply_markup=get_menu(update.effective_user.id)
         )
-    except ValueError:
+    except (ValueError, IndexError):
         update.message.reply_text("❌ Masukkan angka yang valid", reply_markup=InlineKeyboardMarkup([btn_kembali()]))
-        return INPUT_KODE_UNIK
+        return ADMIN_GENERATE_KODE
     except Exception as e:
         logger.error(f"Error generating kode: {e}")
         update.message.reply_text("❌ Terjadi kesalahan", reply_markup=InlineKeyboardMarkup([btn_kembali()]))
@@ -1285,68 +2894,273 @@ def admin_generate_kode_step(update: Update, context: CallbackContext):
     return ConversationHandler.END
 
 # History functions
-def riwayat_user(query, context):
-    user = query.from_user
-    items = get_riwayat_user(user.id)
-    msg = "📋 <b>RIWAYAT TRANSAKSI ANDA (10 terbaru)</b>\n\n"
-    if not items:
-        msg += "Belum ada transaksi."
-    else:
-        for r in items:
-            status = r[6].upper()
-            emoji = "✅" if "SUKSES" in status else ("❌" if "GAGAL" in status or "BATAL" in status else "⏳")
-            msg += (
-                f"{emoji} <b>{r[5]}</b>\n"
-                f"ID: <code>{r[0]}</code>\n"
-                f"Produk: [{r[2]}] ke {r[3]}\n"
-                f"Harga: Rp {r[4]:,}\n"
-                f"Status: <b>{status}</b>\n"
-                f"Keterangan: {r[7]}\n\n"
-            )
-    query.edit_message_text(msg, parse_mode=ParseMode.HTML, reply_markup=InlineKeyboardMarkup([btn_kembali()]))
+def _status_emoji(status):
+    return "✅" if "SUKSES" in status else ("❌" if "GAGAL" in status or "BATAL" in status else "⏳")
+
+# Render satu halaman keyset; cursor tiap halaman disimpan di context.user_data[key]
+def halaman_keyset(context, key, page, fetch, format_row, judul, kosong, prefix):
+    cursors = context.user_data.get(key) if page > 0 else None
+    if not cursors or page >= len(cursors):
+        cursors, page = [None], 0
+    rows = fetch(cursors[page], RIWAYAT_PER_PAGE + 1)
+    msg = judul
+    shown = 0
+    for r in rows[:RIWAYAT_PER_PAGE]:
+        chunk = format_row(r)
+        if shown and len(msg) + len(chunk) > MAX_MSG_CHARS:
+            break
+        msg += chunk
+        shown += 1
+    if not rows:
+        msg += kosong
+    ada_berikutnya = len(rows) > shown
+    del cursors[page + 1:]
+    if ada_berikutnya:
+        last = rows[shown - 1]
+        cursors.append((last[-1], last[0]))
+    context.user_data[key] = cursors
+    return msg, btn_navigasi(prefix, page, ada_berikutnya=ada_berikutnya)
+
+def _format_riwayat_user(r):
+    status = r[6].upper()
+    return (
+        f"{_status_emoji(status)} <b>{r[5]}</b>\n"
+        f"ID: <code>{r[0]}</code>\n"
+        f"Produk: [{r[2]}] ke {r[3]}\n"
+        f"Harga: Rp {r[4]:,}\n"
+        f"Status: <b>{status}</b>\n"
+        f"Keterangan: {(r[7] or '')[:300]}\n\n"
+    )
 
-def semua_riwayat_admin(query, context):
-    items = get_all_riwayat()
-    msg = "📋 <b>SEMUA RIWAYAT TRANSAKSI (10 terbaru)</b>\n\n"
-    if not items:
-        msg += "Belum ada transaksi."
-    else:
-        for r in items:
-            status = r[6].upper()
-            emoji = "✅" if "SUKSES" in status else ("❌" if "GAGAL" in status or "BATAL" in status else "⏳")
-            user = get_user(r[1])
-            username = f"@{user[1]}" if user and user[1] else "Unknown"
-            msg += (
-                f"{emoji} <b>{r[5]}</b>\n"
-                f"User: {username} ({r[1]})\n"
-                f"Produk: [{r[2]}] ke {r[3]}\n"
-                f"Harga: Rp {r[4]:,}\n"
-                f"Status: <b>{status}</b>\n"
-                f"Keterangan: {r[7]}\n\n"
-            )
-    query.edit_message_text(msg, parse_mode=ParseMode.HTML, reply_markup=InlineKeyboardMarkup([btn_kembali()]))
+def _format_riwayat_admin(r):
+    status = r[6].upper()
+    username = f"@{r[8]}" if r[8] else "Unknown"
+    return (
+        f"{_status_emoji(status)} <b>{r[5]}</b>\n"
+        f"User: {username} ({r[1]})\n"
+        f"Produk: [{r[2]}] ke {r[3]}\n"
+        f"Harga: Rp {r[4]:,}\n"
+        f"Status: <b>{status}</b>\n"
+        f"Keterangan: {(r[7] or '')[:300]}\n\n"
+    )
+
+def riwayat_user(query, context, page=0):
+    user = query.from_user
+    msg, nav = halaman_keyset(
+        context, "riwayat_cursor", page,
+        lambda cursor, limit: get_riwayat_user_page(user.id, cursor, limit),
+        _format_riwayat_user,
+        "📋 <b>RIWAYAT TRANSAKSI ANDA</b>\n\n",
+        "Belum ada transaksi.",
+        "riwayat_page",
+    )
+    keyboard = [nav, btn_kembali()] if nav else [btn_kembali()]
+    query.edit_message_text(msg, parse_mode=ParseMode.HTML, reply_markup=InlineKeyboardMarkup(keyboard))
+
+def semua_riwayat_admin(query, context, page=0):
+    msg, nav = halaman_keyset(
+        context, "semua_riwayat_cursor", page,
+        get_all_riwayat_page,
+        _format_riwayat_admin,
+        "📋 <b>SEMUA RIWAYAT TRANSAKSI</b>\n\n",
+        "Belum ada transaksi.",
+        "semua_riwayat_page",
+    )
+    keyboard = [nav, btn_kembali()] if nav else [btn_kembali()]
+    query.edit_message_text(msg, parse_mode=ParseMode.HTML, reply_markup=InlineKeyboardMarkup(keyboard))
+
+# Pembatas laju kirim pesan Telegram
+# Token bucket thread-safe; pause() dipakai saat Telegram membalas RetryAfter
+class RateLimiter:
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self._tokens = float(self.burst)
+        self._last = time.monotonic()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now >= self._paused_until:
+                    self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                    self._last = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+                else:
+                    self._last = self._paused_until
+                    wait = self._paused_until - now
+            time.sleep(wait)
+
+# Jarak minimum antar pesan ke chat yang sama
+class PerChatLimiter:
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._next = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, chat_id):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next.get(chat_id, 0))
+            self._next[chat_id] = slot + self.interval
+            if len(self._next) > 10000:
+                self._next = {k: v for k, v in self._next.items() if v > now}
+        if slot > now:
+            time.sleep(slot - now)
 
 # Broadcast function
+# Broadcast di thread background dengan batas laju; cursor disimpan tiap batch supaya bisa dilanjutkan
+class BroadcastEngine:
+    def __init__(self, bot):
+        self.bot = bot
+        self.global_limiter = RateLimiter(BROADCAST_RATE)
+        self.chat_limiter = PerChatLimiter(BROADCAST_PER_CHAT_RATE)
+        self._threads = {}
+        self._lock = threading.Lock()
+
+    def mulai(self, job_id):
+        with self._lock:
+            t = self._threads.get(job_id)
+            if t and t.is_alive():
+                return
+            t = threading.Thread(target=self._jalankan, args=(job_id,), name=f"broadcast-{job_id}")
+            t.daemon = True
+            self._threads[job_id] = t
+            t.start()
+
+    def lanjutkan_semua(self):
+        for job_id in get_broadcast_job_berjalan():
+            logger.info(f"Melanjutkan broadcast #{job_id}")
+            self.mulai(job_id)
+
+    def _kirim(self, chat_id, teks):
+        for _ in range(BROADCAST_MAX_RETRY):
+            self.global_limiter.acquire()
+            self.chat_limiter.acquire(chat_id)
+            try:
+                self.bot.send_message(chat_id=chat_id, text=f"📢 <b>BROADCAST</b>\n\n{teks}", parse_mode=ParseMode.HTML)
+                return "ok"
+            except RetryAfter as e:
+                logger.warning(f"[BROADCAST] RetryAfter {e.retry_after}s")
+                self.global_limiter.pause(e.retry_after)
+            except Unauthorized:
+                return "blokir"
+            except BadRequest as e:
+                if "chat not found" in str(e).lower():
+                    return "blokir"
+                return "gagal"
+            except TelegramError as e:
+                logger.warning(f"[BROADCAST] Gagal kirim ke {chat_id}: {e}")
+                time.sleep(1)
+        return "gagal"
+
+    def _lapor(self, job, selesai=False):
+        if not job["progress_message_id"]:
+            return
+        diproses = job["terkirim"] + job["gagal"] + job["diblokir"]
+        judul = {"selesai": "✅ <b>BROADCAST SELESAI</b>", "dibatalkan": "⛔ <b>BROADCAST DIBATALKAN</b>",
+                 "jeda": "⏸ <b>BROADCAST TERHENTI KARENA ERROR</b>"}.get(job["status"], "📢 <b>BROADCAST BERJALAN</b>")
+        msg = (
+            f"{judul} #{job['id']}\n\n"
+            f"Diproses: {diproses}/{job['total']}\n"
+            f"Berhasil: {job['terkirim']}\n"
+            f"Gagal: {job['gagal']}\n"
+            f"Memblokir bot: {job['diblokir']}"
+        )
+        keyboard = [btn_kembali()] if selesai else [
+            [InlineKeyboardButton("⛔ Batalkan", callback_data=f"broadcast_batal|{job['id']}")]]
+        if job["status"] == "jeda":
+            keyboard = [[InlineKeyboardButton("▶️ Lanjutkan", callback_data=f"broadcast_lanjut|{job['id']}")],
+                        [InlineKeyboardButton("⛔ Batalkan", callback_data=f"broadcast_batal|{job['id']}")]]
+        try:
+            self.chat_limiter.acquire(job["admin_id"])
+            self.bot.edit_message_text(msg, chat_id=job["admin_id"], message_id=job["progress_message_id"],
+                                       parse_mode=ParseMode.HTML, reply_markup=InlineKeyboardMarkup(keyboard))
+        except TelegramError as e:
+            logger.warning(f"[BROADCAST] Gagal update progres #{job['id']}: {e}")
+
+    def _jalankan(self, job_id):
+        try:
+            self._kirim_semua(job_id)
+        except Exception as e:
+            # Job tidak boleh tertinggal 'berjalan' tanpa thread; admin bisa melanjutkan dari cursor terakhir
+            logger.error(f"[BROADCAST] #{job_id} terhenti: {e}", exc_info=True)
+            try:
+                selesai_broadcast_job(job_id, "jeda")
+            except Exception as e:
+                logger.error(f"[BROADCAST] Gagal menandai #{job_id} jeda: {e}", exc_info=True)
+        try:
+            job = get_broadcast_job(job_id)
+            if job:
+                logger.info(f"Broadcast #{job_id} {job['status']}: {job['terkirim']} terkirim, {job['gagal']} gagal")
+                self._lapor(job, selesai=True)
+        except Exception as e:
+            logger.error(f"[BROADCAST] Gagal melaporkan #{job_id}: {e}", exc_info=True)
+
+    def _kirim_semua(self, job_id):
+        last_lapor = 0
+        with ThreadPoolExecutor(max_workers=BROADCAST_WORKERS, thread_name_prefix=f"bc{job_id}") as executor:
+            while True:
+                job = get_broadcast_job(job_id)
+                if not job or job["status"] != "berjalan":
+                    break
+                penerima = get_broadcast_penerima(job["cursor_user_id"], BROADCAST_BATCH)
+                if not penerima:
+                    selesai_broadcast_job(job_id, "selesai")
+                    break
+                hasil = list(executor.map(lambda uid: self._kirim(uid, job["teks"]), penerima))
+                diblokir = [uid for uid, h in zip(penerima, hasil) if h == "blokir"]
+                simpan_broadcast_batch(job_id, penerima[-1], hasil.count("ok"), hasil.count("gagal"), diblokir)
+                if time.monotonic() - last_lapor >= BROADCAST_PROGRESS_INTERVAL:
+                    self._lapor(get_broadcast_job(job_id))
+                    last_lapor = time.monotonic()
+
+broadcast_engine = None
+
 def broadcast_step(update: Update, context: CallbackContext):
     text = update.message.text
-    users = get_all_users()
-    count = 0
-    fail = 0
-    for u in users:
-        try:
-            context.bot.send_message(
-                chat_id=int(u[0]),
-                text=f"📢 <b>BROADCAST</b>\n\n{text}",
-                parse_mode=ParseMode.HTML
-            )
-            count += 1
-        except Exception:
-            fail += 1
-    update.message.reply_text(
-        f"✅ <b>BROADCAST SELESAI</b>\n\nBerhasil: {count}\nGagal: {fail}",
+    admin_id = update.effective_user.id
+    job_id = buat_broadcast_job(admin_id, text)
+    msg = update.message.reply_text(
+        f"📢 <b>BROADCAST DIMULAI</b> #{job_id}\n\nPesan dikirim di background. Progres akan diperbarui di pesan ini.",
         parse_mode=ParseMode.HTML,
-        reply_markup=get_menu(update.effective_user.id)
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⛔ Batalkan", callback_data=f"broadcast_batal|{job_id}")]])
     )
+    set_broadcast_progress_message(job_id, msg.message_id)
+    broadcast_engine.mulai(job_id)
+    return ConversationHandler.END
+
+def broadcast_batal(update: Update, context: CallbackContext):
+    query = update.callback_query
+    if query.from_user.id not in ADMIN_IDS:
+        query.answer()
+        return ConversationHandler.END
+    job_id = int(query.data.split("|")[1])
+    selesai_broadcast_job(job_id, "dibatalkan")
+    query.answer("⛔ Broadcast dihentikan.", show_alert=True)
+    return ConversationHandler.END
+
+def broadcast_lanjut(update: Update, context: CallbackContext):
+    query = update.callback_query
+    if query.from_user.id not in ADMIN_IDS:
+        query.answer()
+        return ConversationHandler.END
+    job_id = int(query.data.split("|")[1])
+    if not lanjutkan_broadcast_job(job_id):
+        query.answer("⚠️ Broadcast ini tidak sedang terhenti.", show_alert=True)
+        return ConversationHandler.END
+    broadcast_engine.mulai(job_id)
+    query.answer("▶️ Broadcast dilanjutkan.", show_alert=True)
     return ConversationHandler.END
 
 def bantuan_menu(update: Update, context: CallbackContext):
@@ -1370,6 +3184,46 @@ def bantuan_menu(update: Update, context: CallbackContext):
     query.edit_message_text(msg, parse_mode=ParseMode.HTML, reply_markup=InlineKeyboardMarkup([btn_kembali()]))
     return ConversationHandler.END
 
+def admin_provider_stats(update: Update, context: CallbackContext):
+    query = update.callback_query
+    query.answer()
+    if query.from_user.id not in ADMIN_IDS:
+        return ConversationHandler.END
+    try:
+        query.edit_message_text(
+            "📡 <b>STATUS PROVIDER</b>\n\n" + provider.laporan() + "\n\n🧠 <b>CACHE USER</b>\n" + user_cache.laporan(),
+            parse_mode=ParseMode.HTML,
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔄 Refresh", callback_data="admin_provider_stats")], btn_kembali()])
+        )
+    except BadRequest:
+        # "Message is not modified" jika statistik belum berubah sejak refresh terakhir
+        pass
+    return ConversationHandler.END
+
+def admin_pending_report(update: Update, context: CallbackContext):
+    query = update.callback_query
+    if query.from_user.id not in ADMIN_IDS:
+        query.answer()
+        return ConversationHandler.END
+    if query.data == "admin_rekon_jalan":
+        context.job_queue.run_once(job_rekonsiliasi, 0)
+        query.answer("🔄 Rekonsiliasi dijalankan di background. Refresh beberapa saat lagi.", show_alert=True)
+    else:
+        query.answer()
+    teks, _ = laporan_umur_pending()
+    try:
+        query.edit_message_text(
+            teks, parse_mode=ParseMode.HTML,
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔄 Refresh", callback_data="admin_pending_report"),
+                 InlineKeyboardButton("📡 Cek ke Provider", callback_data="admin_rekon_jalan")],
+                btn_kembali()
+            ])
+        )
+    except BadRequest:
+        pass
+    return ConversationHandler.END
+
 def admin_panel(update: Update, context: CallbackContext):
     query = update.callback_query
     query.edit_message_text(
@@ -1392,16 +3246,31 @@ def callback_router(update: Update, context: CallbackContext):
         return beli_produk_menu(update, context)
     elif data.startswith("produk|") or data == "disabled_produk":
         return pilih_produk_callback(update, context)
+    elif data.startswith("produk_page|") or data.startswith("admin_produk_page|"):
+        return produk_page_callback(update, context)
+    elif data == "noop":
+        query.answer()
+        return ConversationHandler.END
     elif data == "cek_stok":
         return cek_stok_menu(update, context)
     elif data == "riwayat":
         riwayat_user(query, context)
         return ConversationHandler.END
+    elif data.startswith("riwayat_page|"):
+        riwayat_user(query, context, int(data.split("|")[1]))
+        return ConversationHandler.END
     elif data == "semua_riwayat":
         semua_riwayat_admin(query, context)
         return ConversationHandler.END
+    elif data.startswith("semua_riwayat_page|"):
+        semua_riwayat_admin(query, context, int(data.split("|")[1]))
+        return ConversationHandler.END
     elif data == "admin_cekuser":
         return admin_cekuser_menu(update, context)
+    elif data.startswith("admin_cekuser_page|"):
+        return admin_cekuser_menu(update, context, int(data.split("|")[1]))
+    elif data == "admin_cari_user":
+        return admin_cari_user(update, context)
     elif data.startswith("admin_cekuser_detail|"):
         return admin_cekuser_detail_callback(update, context)
     elif data == "topup_menu":
@@ -1427,6 +3296,14 @@ def callback_router(update: Update, context: CallbackContext):
     elif data == "broadcast":
         query.edit_message_text("📢 Ketik pesan yang ingin di-broadcast ke semua user:", parse_mode=ParseMode.HTML, reply_markup=InlineKeyboardMarkup([btn_kembali()]))
         return BC_MESSAGE
+    elif data.startswith("broadcast_batal|"):
+        return broadcast_batal(update, context)
+    elif data.startswith("broadcast_lanjut|"):
+        return broadcast_lanjut(update, context)
+    elif data == "admin_provider_stats":
+        return admin_provider_stats(update, context)
+    elif data in ("admin_pending_report", "admin_rekon_jalan"):
+        return admin_pending_report(update, context)
     elif data == "lihat_saldo":
         saldo = get_saldo(query.from_user.id)
         query.edit_message_text(f"💰 <b>SALDO ANDA</b>\n\nSaldo: <b>Rp {saldo:,}</b>", parse_mode=ParseMode.HTML, reply_markup=InlineKeyboardMarkup([btn_kembali()]))
@@ -1441,6 +3318,8 @@ def callback_router(update: Update, context: CallbackContext):
         return admin_edit_deskripsi(update, context)
     elif data == "admin_generate_kode":
         return admin_generate_kode(update, context)
+    elif data == "admin_import_mutasi":
+        return admin_import_mutasi(update, context)
     elif data == "bantuan":
         return bantuan_menu(update, context)
     elif data == "admin_panel":
@@ -1449,115 +3328,490 @@ def callback_router(update: Update, context: CallbackContext):
     return ConversationHandler.END
 
 def run_flask_app():
-    app.run(host='0.0.0.0', port=WEBHOOK_PORT)
+    if waitress_serve:
+        waitress_serve(app, host='0.0.0.0', port=WEBHOOK_PORT, threads=WEBHOOK_THREADS,
+                       connection_limit=200, channel_timeout=30, ident=None)
+    else:
+        logger.warning("waitress tidak terpasang, webhook memakai server development Flask")
+        app.run(host='0.0.0.0', port=WEBHOOK_PORT, threaded=True)
 
 app = Flask(__name__)
 
-# REGEX untuk parse pesan webhook dari API Khfy-store
-RX = re.compile(
-    r'RC=(?P<reffid>[a-f0-9-]+)\s+TrxID=(?P<trxid>\d+)\s+'
-    r'(?P<produk>[A-Z0-9]+)\.(?P<tujuan>\d+)\s+'
-    r'(?P<status_text>[A-Za-z]+)\s*'
-    r'(?P<keterangan>.+?)'
-    r'(?:\s+Saldo[\s\S]*?)?'
-    r'(?:\bresult=(?P<status_code>\d+))?\s*>?$',
-    re.I
-)
+# Antrean notifikasi user ({chat_id, text[, message_id, reply_markup]}) dengan batas laju
+class Notifier:
+    def __init__(self, bot, rate=NOTIF_RATE):
+        self.bot = bot
+        self.queue = queue.Queue()
+        self.limiter = RateLimiter(rate)
+        self.chat_limiter = PerChatLimiter(1)
+        t = threading.Thread(target=self._worker, name="notifier")
+        t.daemon = True
+        t.start()
+
+    def kirim(self, items):
+        for item in items:
+            self.queue.put(item)
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            try:
+                self._kirim_item(item)
+            except Exception:
+                # Error apa pun tidak boleh menghentikan thread; notifikasi berikutnya tetap dikirim
+                logger.exception(f"Error notifier untuk item {item!r:.200}")
+            finally:
+                self.queue.task_done()
+
+    def _kirim_item(self, item):
+        for _ in range(BROADCAST_MAX_RETRY):
+            self.limiter.acquire()
+            self.chat_limiter.acquire(item["chat_id"])
+            markup = item.get("reply_markup") or get_menu(item["chat_id"])
+            try:
+                if item.get("message_id"):
+                    self.bot.edit_message_text(item["text"], chat_id=item["chat_id"], message_id=item["message_id"],
+                                               parse_mode=ParseMode.HTML, reply_markup=markup)
+                else:
+                    self.bot.send_message(item["chat_id"], item["text"], parse_mode=ParseMode.HTML,
+                                          reply_markup=markup)
+                return
+            except RetryAfter as e:
+                self.limiter.pause(e.retry_after)
+            except TelegramError as e:
+                logger.error(f"Gagal kirim notif ke user {item['chat_id']}: {e}")
+                return
+
+notifier = None
+
+# Notifikasi event top up ke admin; dengan interval > 0 dikumpulkan jadi digest
+class AdminNotifier:
+    LABEL = {"topup_baru": "top up baru", "bukti_topup": "bukti transfer masuk",
+             "mutasi_tidak_cocok": "mutasi masuk tanpa top up cocok"}
+
+    def __init__(self, notifier, interval=ADMIN_DIGEST_INTERVAL):
+        self.notifier = notifier
+        self.interval = interval
+        self._events = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def markup():
+        return InlineKeyboardMarkup([[InlineKeyboardButton("✅ Approve Top Up", callback_data="admin_topup_pending")]])
+
+    def _kirim_semua_admin(self, teks):
+        markup = self.markup()
+        self.notifier.kirim([{"chat_id": adm, "text": teks, "reply_markup": markup} for adm in ADMIN_IDS])
+
+    # jenis: kunci LABEL; teks: pesan satu event; baris: ringkasan satu baris untuk digest
+    def kirim(self, jenis, teks, baris):
+        if self.interval <= 0:
+            self._kirim_semua_admin(teks)
+            return
+        with self._lock:
+            self._events.append((jenis, teks, baris))
+
+    def flush(self):
+        with self._lock:
+            events, self._events = self._events, []
+        if not events:
+            return
+        if len(events) == 1:
+            self._kirim_semua_admin(events[0][1])
+            return
+        jumlah = {}
+        for jenis, _, _ in events:
+            jumlah[jenis] = jumlah.get(jenis, 0) + 1
+        judul = ", ".join(f"{n} {self.LABEL.get(jenis, jenis)}" for jenis, n in jumlah.items())
+        lines = [f"🔔 <b>{judul}</b>\n"]
+        lines += [baris for _, _, baris in events[-ADMIN_DIGEST_MAX_BARIS:]]
+        if len(events) > ADMIN_DIGEST_MAX_BARIS:
+            lines.insert(1, f"... {len(events) - ADMIN_DIGEST_MAX_BARIS} event sebelumnya")
+        self._kirim_semua_admin("\n".join(lines))
+
+admin_notifier = None
+
+def job_digest_admin(context: CallbackContext):
+    admin_notifier.flush()
+
+# Isi kolom epoch data lama sedikit demi sedikit; job berhenti sendiri setelah selesai
+def job_backfill_epoch(context: CallbackContext):
+    try:
+        mulai = time.monotonic()
+        while time.monotonic() - mulai < BACKFILL_DURASI:
+            if backfill_epoch_batch():
+                logger.info("[EPOCH] Backfill selesai, query waktu memakai kolom epoch")
+                cek_query_plan()
+                context.job.schedule_removal()
+                return
+    except Exception as e:
+        logger.error(f"[EPOCH] {e}", exc_info=True)
+
+def _ulang_batch(fungsi, sebelum):
+    total = 0
+    while True:
+        n = fungsi(sebelum, SWEEPER_BATCH)
+        total += n
+        if n < SWEEPER_BATCH:
+            return total
+
+# Kedaluwarsakan top up pending lewat TTL lalu arsipkan data final lama, per batch
+def job_sweeper(context: CallbackContext):
+    try:
+        sebelum = time.time() - TOPUP_TTL_MENIT * 60
+        expired = 0
+        while True:
+            rows = expire_topup_pending(sebelum, SWEEPER_BATCH)
+            expired += len(rows)
+            notifier.kirim([{"chat_id": user_id, "text": (
+                f"⌛ <b>TOP UP KEDALUWARSA</b>\n\n"
+                f"Top up QRIS sebesar Rp {nominal:,} tidak dibayar dalam {TOPUP_TTL_MENIT} menit dan dibatalkan.\n"
+                f"Jika Anda sudah transfer, hubungi admin dengan bukti transfer.")} for _, user_id, nominal in rows])
+            if len(rows) < SWEEPER_BATCH:
+                break
+        arsip_topup = arsip_kode = arsip_riwayat = 0
+        # Pengarsipan menunggu backfill epoch selesai, supaya tabel arsip tidak menerima baris tanpa epoch
+        if _epoch["aktif"]:
+            arsip_topup = _ulang_batch(arsipkan_topup, time.time() - ARSIP_HARI * 86400)
+            arsip_kode = _ulang_batch(arsipkan_kode_unik, time.time() - ARSIP_HARI * 86400)
+            arsip_riwayat = _ulang_batch(arsipkan_riwayat, time.time() - RIWAYAT_ARSIP_HARI * 86400)
+        dikompak = kompak_db() if arsip_topup or arsip_kode or arsip_riwayat else 0
+        if expired or arsip_topup or arsip_kode or arsip_riwayat:
+            logger.info(f"[SWEEPER] expired={expired} arsip_topup={arsip_topup} arsip_kode_unik={arsip_kode} "
+                        f"arsip_riwayat={arsip_riwayat} halaman_dikompak={dikompak}")
+    except Exception as e:
+        logger.error(f"[SWEEPER] {e}", exc_info=True)
+
+# Cocokkan mutasi masuk lalu kirim notifikasi user (dan admin untuk yang tidak cocok)
+def proses_mutasi(mutasi, sumber, notif_admin=True):
+    ringkasan, notifikasi, tidak_cocok = cocokkan_mutasi(mutasi, sumber)
+    notifier.kirim(notifikasi)
+    if notif_admin:
+        for ref, nominal, keterangan, status in tidak_cocok:
+            teks = f"❔ Mutasi masuk Rp {nominal:,} ({html.escape(keterangan or ref)}) tidak cocok dengan top up pending ({status})."
+            admin_notifier.kirim("mutasi_tidak_cocok", teks, f"❔ Rp {nominal:,} - {html.escape(keterangan or ref)}")
+    if any(ringkasan.values()):
+        logger.info(f"[MUTASI] {sumber}: {ringkasan}")
+    return ringkasan
+
+# Terapkan status provider ke riwayat, order dan saldo di transaksi pemanggil; notifikasi dikirim pemanggil
+def terapkan_status_transaksi(reffid, status_text, keterangan):
+    riwayat = get_riwayat_by_refid(reffid)
+    if not riwayat:
+        logger.warning(f"RefID {reffid} tidak ditemukan di database.")
+        return "tidak_ditemukan", []
+    
+    user_id = riwayat[1]
+    produk_kode = riwayat[2]
+    harga = riwayat[4]
+    
+    # Periksa apakah status sudah di-update sebelumnya untuk menghindari duplikasi
+    if status_final(riwayat[6]):
+        logger.info(f"RefID {reffid} sudah memiliki status final. Tidak perlu diupdate.")
+        return "sudah_final", []
+        
+    # Perbarui status di database
+    update_riwayat_status(reffid, status_text.upper(), keterangan)
+    
+    if "sukses" in status_text.lower():
+        hasil, order_status = "sukses", ORDER_SUCCESS
+    elif "gagal" in status_text.lower() or "batal" in status_text.lower():
+        hasil, order_status = "gagal", ORDER_FAILED
+        # Kembalikan saldo yang sudah terlanjur dipotong (sekali per reffid)
+        kredit_saldo(user_id, harga, reffid, "refund")
+    else:
+        hasil, order_status = "diproses", ORDER_PENDING
+        logger.info(f"Status webhook tidak dikenal: {status_text}")
+    set_order_status(reffid, order_status, keterangan)
+    
+    notifikasi = []
+    order = get_order(reffid)
+    if order and order["message_id"]:
+        notifikasi.append({"chat_id": order["chat_id"], "message_id": order["message_id"],
+                           "text": pesan_order(order, status_text, keterangan)})
+    if hasil == "sukses":
+        # Saldo sudah dipotong saat order dibuat di konfirmasi_step
+        notifikasi.append({"chat_id": user_id, "text": (
+            f"✅ <b>TRANSAKSI SUKSES</b>\n\n"
+            f"Produk: [{produk_kode}] dengan harga Rp {harga:,} telah berhasil dikirim.\n"
+            f"Keterangan: {keterangan}\n\n"
+            f"Saldo Anda sekarang: Rp {get_saldo(user_id):,}")})
+    elif hasil == "gagal":
+        notifikasi.append({"chat_id": user_id, "text": (
+            f"❌ <b>TRANSAKSI GAGAL</b>\n\n"
+            f"Transaksi untuk produk [{produk_kode}] dengan harga Rp {harga:,} GAGAL.\n"
+            f"Keterangan: {keterangan}\n\n"
+            f"Saldo Anda telah dikembalikan. Saldo sekarang: Rp {get_saldo(user_id):,}")})
+    return hasil, notifikasi
+
+def proses_status_transaksi(reffid, status_text, keterangan):
+    with db_transaksi(immediate=True):
+        hasil, notifikasi = terapkan_status_transaksi(reffid, status_text, keterangan)
+    notifier.kirim(notifikasi)
+    return hasil
+
+# Tanya status transaksi ke provider: (status_text, keterangan)
+def cek_status_provider(reffid):
+    data = provider.get("status", f"{BASE_URL}{STATUS_PATH}?reff_id={reffid}&api_key={API_KEY}").json()
+    if isinstance(data.get("data"), dict):
+        data = data["data"]
+    return str(data.get("status") or "PENDING"), data.get("message") or data.get("keterangan") or ""
+
+# Cek ulang ke provider transaksi yang terlalu lama belum final (webhook tidak datang)
+class Rekonsiliasi:
+    def __init__(self, workers=REKON_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="rekon")
+        self._lock = threading.Lock()
+        self.terakhir = None  # ringkasan putaran terakhir untuk laporan admin
+        self._terakhir_lapor = 0
+
+    def _cek(self, reffid):
+        try:
+            return cek_status_provider(reffid)
+        except Exception as e:
+            logger.warning(f"[REKON] Gagal cek status {reffid}: {e}")
+            return None
+
+    def jalankan(self):
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            ringkasan = {"dicek": 0, "sukses": 0, "gagal": 0, "pending": 0, "error": 0}
+            sebelum = time.time() - REKON_UMUR_MIN
+            cursor = None
+            while True:
+                # Order yang masih di antrean pipeline dilewati: "tidak ditemukan" dari provider
+                # untuk trx yang belum dikirim tidak boleh me-refund order yang sebentar lagi dikirim
+                rows = get_riwayat_belum_final(sebelum, cursor, REKON_BATCH, tanpa_antrean=True)
+                if not rows:
+                    break
+                cursor = (rows[-1][5], rows[-1][0])
+                reffids = [r[0] for r in rows]
+                hasil_cek = list(self.executor.map(self._cek, reffids))
+                self._terapkan(reffids, hasil_cek, ringkasan)
+                if all(h is None for h in hasil_cek):
+                    # Provider gangguan (circuit terbuka); sisanya dicek di putaran berikutnya
+                    break
+            ringkasan["waktu"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            self.terakhir = ringkasan
+            if ringkasan["dicek"]:
+                logger.info(f"[REKON] {ringkasan}")
+            return ringkasan
+        finally:
+            self._lock.release()
+
+    def _terapkan(self, reffids, hasil_cek, ringkasan):
+        notifikasi = []
+        with db_transaksi(immediate=True) as c:
+            for reffid, cek in zip(reffids, hasil_cek):
+                ringkasan["dicek"] += 1
+                if cek is None:
+                    ringkasan["error"] += 1
+                    continue
+                status_text, keterangan = cek
+                if not status_final(status_text):
+                    ringkasan["pending"] += 1
+                    continue
+                try:
+                    with db_savepoint("rekon"):
+                        hasil, notif = terapkan_status_transaksi(reffid, status_text, keterangan)
+                except Exception as e:
+                    logger.error(f"[REKON] Gagal menerapkan status {reffid}: {e}", exc_info=True)
+                    ringkasan["error"] += 1
+                    continue
+                if hasil in ("sukses", "gagal"):
+                    ringkasan[hasil] += 1
+                notifikasi.extend(notif)
+        notifier.kirim(notifikasi)
+
+    # Laporan umur ke admin bila ada transaksi belum final > 24 jam, paling sering tiap REKON_LAPOR_INTERVAL
+    def lapor_admin(self):
+        if time.time() - self._terakhir_lapor < REKON_LAPOR_INTERVAL:
+            return
+        teks, kelompok = laporan_umur_pending()
+        if not kelompok[-1][1]:
+            return
+        self._terakhir_lapor = time.time()
+        notifier.kirim([{"chat_id": admin_id, "text": teks} for admin_id in ADMIN_IDS])
+
+rekonsiliasi = Rekonsiliasi()
+
+# Teks laporan umur transaksi belum final beserta data per kelompok umur
+def laporan_umur_pending():
+    kelompok = get_umur_belum_final()
+    lines = ["⏳ <b>TRANSAKSI BELUM FINAL</b>\n"]
+    for label, jumlah, total in kelompok:
+        lines.append(f"{label}: <b>{jumlah}</b> (Rp {total:,})")
+    terlama = get_riwayat_belum_final(time.time(), limit=10)
+    if terlama:
+        lines.append("\n<b>Terlama:</b>")
+        for reffid, user_id, produk, harga, waktu, _ in terlama:
+            lines.append(f"{waktu} | {html.escape(str(produk))} | Rp {harga:,} | user {user_id}\n<code>{reffid}</code>")
+    r = rekonsiliasi.terakhir
+    if r:
+        lines.append(f"\nRekonsiliasi terakhir {r['waktu']}: dicek {r['dicek']}, sukses {r['sukses']}, "
+                     f"gagal {r['gagal']}, masih pending {r['pending']}, error {r['error']}")
+    return "\n".join(lines), kelompok
+
+def job_rekonsiliasi(context: CallbackContext):
+    try:
+        rekonsiliasi.jalankan()
+        rekonsiliasi.lapor_admin()
+    except Exception as e:
+        logger.error(f"[REKON] {e}", exc_info=True)
+
+# Proses webhook_inbox per batch dalam satu transaksi; notifikasi dikirim setelah commit
+class WebhookConsumer:
+    def __init__(self):
+        self.ada_pesan = threading.Event()
+        self._last_cleanup = 0
+        t = threading.Thread(target=self._worker, name="webhook-consumer")
+        t.daemon = True
+        t.start()
+
+    def _worker(self):
+        while True:
+            self.ada_pesan.wait(timeout=1)
+            self.ada_pesan.clear()
+            try:
+                while self.proses_batch() == WEBHOOK_BATCH:
+                    pass
+                if time.time() - self._last_cleanup > 3600:
+                    self._last_cleanup = time.time()
+                    hapus_webhook_inbox_lama(WEBHOOK_INBOX_RETENSI_HARI)
+            except Exception as e:
+                logger.error(f"[WEBHOOK][CONSUMER] {e}", exc_info=True)
+                time.sleep(1)
+
+    def proses_batch(self):
+        rows = get_webhook_inbox_baru(WEBHOOK_BATCH)
+        if not rows:
+            return 0
+        notifikasi = []
+        waktu = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with db_transaksi(immediate=True) as c:
+            for inbox_id, message, percobaan in rows:
+                # Savepoint per pesan supaya satu pesan rusak tidak membatalkan seluruh batch
+                try:
+                    with db_savepoint("pesan"):
+                        pesan = parse_pesan_webhook(message)
+                        if not pesan:
+                            hasil, notif = "format_salah", []
+                        else:
+                            logger.info(f"== Webhook masuk untuk RefID: {pesan.reffid} dengan status: {pesan.status_text} ==")
+                            hasil, notif = terapkan_status_transaksi(pesan.reffid, pesan.status_text, pesan.keterangan)
+                    status = "selesai"
+                except Exception as e:
+                    logger.error(f"[WEBHOOK] Gagal memproses inbox #{inbox_id}: {e}", exc_info=True)
+                    hasil, notif, status = f"error: {e}", [], "error"
+                if hasil == "tidak_ditemukan":
+                    # Webhook bisa datang sebelum riwayatnya tercatat: biarkan 'baru' dan coba lagi nanti
+                    if percobaan < len(WEBHOOK_ULANG_DETIK):
+                        c.execute("""UPDATE webhook_inbox SET percobaan=percobaan+1, coba_lagi_pada=?, hasil=?
+                            WHERE id=?""", (int(time.time()) + WEBHOOK_ULANG_DETIK[percobaan], hasil, inbox_id))
+                        continue
+                    logger.warning(f"[WEBHOOK] Inbox #{inbox_id} tetap tidak ditemukan setelah {percobaan} percobaan")
+                    status = "gagal"
+                notifikasi.extend(notif)
+                c.execute("UPDATE webhook_inbox SET status=?, hasil=?, diproses_pada=? WHERE id=?",
+                          (status, hasil, waktu, inbox_id))
+        notifier.kirim(notifikasi)
+        return len(rows)
+
+webhook_consumer = None
 
 @app.route('/webhook', methods=['GET', 'POST'])
 def webhook_handler():
     try:
-        # Menambahkan logging untuk payload lengkap
-        logger.info(f"[WEBHOOK RECEIVE] Headers: {request.headers}")
-        logger.info(f"[WEBHOOK RECEIVE] Form Data: {request.form}")
-        logger.info(f"[WEBHOOK RECEIVE] Arguments: {request.args}")
-
         message = request.args.get('message') or request.form.get('message')
         if not message:
             logger.warning("[WEBHOOK] Pesan kosong diterima.")
             return jsonify({'ok': False, 'error': 'message kosong'}), 400
 
-        match = RX.match(message)
-        if not match:
+        if not parse_pesan_webhook(message):
             logger.warning(f"[WEBHOOK] Format tidak dikenali -> {message}")
             return jsonify({'ok': False, 'error': 'format tidak dikenali'}), 200
 
-        groups = match.groupdict()
-        reffid = groups.get('reffid')
-        status_text = groups.get('status_text')
-        keterangan = groups.get('keterangan', '').strip()
-
-        logger.info(f"== Webhook masuk untuk RefID: {reffid} dengan status: {status_text} ==")
-        
-        riwayat = get_riwayat_by_refid(reffid)
-        if not riwayat:
-            logger.warning(f"RefID {reffid} tidak ditemukan di database.")
-            return jsonify({'ok': False, 'error': 'transaksi tidak ditemukan'}), 200
-        
-        user_id = riwayat[1]
-        produk_kode = riwayat[2]
-        harga = riwayat[4]
-        
-        # Periksa apakah status sudah di-update sebelumnya untuk menghindari duplikasi
-        current_status = riwayat[6].lower()
-        if "sukses" in current_status or "gagal" in current_status or "batal" in current_status:
-            logger.info(f"RefID {reffid} sudah memiliki status final. Tidak perlu diupdate.")
-            return jsonify({'ok': True, 'message': 'Status sudah final'}), 200
-            
-        # Perbarui status di database
-        update_riwayat_status(reffid, status_text.upper(), keterangan)
-
-        if "sukses" in status_text.lower():
-            # Potong saldo, karena ini adalah konfirmasi SUKSES pertama
-            kurang_saldo(user_id, harga)
-            
-            # Kirim notifikasi ke user
-            try:
-                updater.bot.send_message(user_id, 
-                    f"✅ <b>TRANSAKSI SUKSES</b>\n\n"
-                    f"Produk: [{produk_kode}] dengan harga Rp {harga:,} telah berhasil dikirim.\n"
-                    f"Keterangan: {keterangan}\n\n"
-                    f"Saldo Anda sekarang: Rp {get_saldo(user_id):,}",
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=get_menu(user_id))
-            except Exception as e:
-                logger.error(f"Gagal kirim notif sukses ke user {user_id}: {e}")
-                
-        elif "gagal" in status_text.lower() or "batal" in status_text.lower():
-            # Kembalikan saldo yang sudah terlanjur dipotong
-            tambah_saldo(user_id, harga)
-            
-            # Kirim notifikasi ke user
-            try:
-                updater.bot.send_message(user_id, 
-                    f"❌ <b>TRANSAKSI GAGAL</b>\n\n"
-                    f"Transaksi untuk produk [{produk_kode}] dengan harga Rp {harga:,} GAGAL.\n"
-                    f"Keterangan: {keterangan}\n\n"
-                    f"Saldo Anda telah dikembalikan. Saldo sekarang: Rp {get_saldo(user_id):,}",
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=get_menu(user_id))
-            except Exception as e:
-                logger.error(f"Gagal kirim notif gagal ke user {user_id}: {e}")
-                
-        else:
-            logger.info(f"Status webhook tidak dikenal: {status_text}")
-        
+        # Simpan dulu lalu langsung balas; pemrosesan dilakukan WebhookConsumer
+        inbox_id = simpan_webhook_inbox(message)
+        logger.info(f"[WEBHOOK RECEIVE] inbox #{inbox_id}: {message}")
+        if webhook_consumer:
+            webhook_consumer.ada_pesan.set()
         return jsonify({'ok': True, 'message': 'Webhook diterima'}), 200
 
     except Exception as e:
         logger.error(f"[WEBHOOK][ERROR] {e}", exc_info=True)
         return jsonify({'ok': False, 'error': 'internal_error'}), 500
 
+# Mutasi masuk dari sistem lokal, JSON objek atau list {ref, nominal, keterangan}
+@app.route('/mutasi', methods=['POST'])
+def mutasi_handler():
+    if not MUTASI_TOKEN or not hmac.compare_digest(request.headers.get("X-Token", ""), MUTASI_TOKEN):
+        return jsonify({'ok': False, 'error': 'unauthorized'}), 403
+    data = request.get_json(silent=True)
+    items = data if isinstance(data, list) else [data]
+    mutasi = []
+    for item in items:
+        if not isinstance(item, dict):
+            return jsonify({'ok': False, 'error': 'format tidak dikenali'}), 400
+        ref = str(item.get("ref") or "").strip()
+        nominal = parse_nominal(str(item.get("nominal", "")))
+        if not ref or not nominal or nominal <= 0:
+            return jsonify({'ok': False, 'error': 'ref dan nominal wajib diisi'}), 400
+        mutasi.append((ref, nominal, str(item.get("keterangan") or "")))
+    try:
+        ringkasan = proses_mutasi(mutasi, "webhook")
+    except Exception as e:
+        logger.error(f"[MUTASI][ERROR] {e}", exc_info=True)
+        return jsonify({'ok': False, 'error': 'internal_error'}), 500
+    return jsonify({'ok': True, **ringkasan}), 200
+
 def main():
     init_db()
-    
-    logger.info("Memuat cache produk awal...")
-    update_produk_cache_background()
+    siapkan_auto_vacuum()
+    muat_tabel_arsip()
+    if not muat_mode_epoch():
+        print("[DB] Backfill kolom epoch berjalan di background; query memakai kolom waktu TEXT sampai selesai.")
+    cek_query_plan()
+    muat_snapshot_katalog()
+    kode_unik_filter.muat()
+    try:
+        qris.validasi_qris(QRIS_STATIS)
+        if not qris.RENDER_TERSEDIA:
+            print("[QRIS] Library qrcode belum terpasang, gambar QRIS dibuat lewat API qrisku.")
+    except qris.QrisError as e:
+        print(f"[QRIS] QRIS_STATIS di config.json tidak valid: {e}")
+        logger.error(f"QRIS_STATIS tidak valid: {e}")
     
     global updater
-    updater = Updater(TOKEN, use_context=True)
+    # Pool koneksi Telegram cukup untuk worker dispatcher (default 4), broadcast, order dan notifier
+    updater = Updater(TOKEN, use_context=True,
+                      request_kwargs={"con_pool_size": 8 + BROADCAST_WORKERS + ORDER_WORKERS + 1})
     dp = updater.dispatcher
     
+    global broadcast_engine
+    broadcast_engine = BroadcastEngine(updater.bot)
+    broadcast_engine.lanjutkan_semua()
+    
+    global order_pipeline
+    order_pipeline = OrderPipeline(updater.bot)
+    order_pipeline.pulihkan()
+    
+    global notifier, webhook_consumer, admin_notifier
+    notifier = Notifier(updater.bot)
+    admin_notifier = AdminNotifier(notifier)
+    webhook_consumer = WebhookConsumer()
+    
+    # Refresh katalog di background; job pertama langsung jalan saat bot start
+    logger.info("Memuat cache produk awal...")
+    updater.job_queue.run_repeating(job_refresh_katalog, interval=KATALOG_REFRESH_INTERVAL, first=0)
+    updater.job_queue.run_repeating(job_rekonsiliasi, interval=REKON_INTERVAL, first=REKON_INTERVAL)
+    updater.job_queue.run_repeating(job_sweeper, interval=SWEEPER_INTERVAL, first=60)
+    if not _epoch["aktif"]:
+        updater.job_queue.run_repeating(job_backfill_epoch, interval=BACKFILL_INTERVAL, first=5)
+    if ADMIN_DIGEST_INTERVAL > 0:
+        updater.job_queue.run_repeating(job_digest_admin, interval=ADMIN_DIGEST_INTERVAL, first=ADMIN_DIGEST_INTERVAL)
+    
     # Jalankan Flask app di thread terpisah
     flask_thread = threading.Thread(target=run_flask_app)
     flask_thread.daemon = True
@@ -1580,15 +3834,16 @@ def main():
             BC_MESSAGE: [MessageHandler(Filters.text & ~Filters.command, broadcast_step)],
             ADMIN_CEKUSER: [
                 CallbackQueryHandler(admin_produk_detail, pattern="^admin_produk_detail\\|"),
+                CallbackQueryHandler(produk_page_callback, pattern="^admin_produk_page\\|"),
                 CallbackQueryHandler(admin_edit_harga, pattern="^admin_edit_harga\\|"),
                 CallbackQueryHandler(admin_edit_deskripsi, pattern="^admin_edit_deskripsi\\|")
             ],
             ADMIN_EDIT_HARGA: [MessageHandler(Filters.text & ~Filters.command, admin_edit_harga_step)],
             ADMIN_EDIT_DESKRIPSI: [MessageHandler(Filters.text & ~Filters.command, admin_edit_deskripsi_step)],
-            INPUT_KODE_UNIK: [
-                MessageHandler(Filters.text & ~Filters.command, input_kode_unik_step),
-                MessageHandler(Filters.text & ~Filters.command, admin_generate_kode_step)
-            ],
+            ADMIN_CARI_USER: [MessageHandler(Filters.text & ~Filters.command, admin_cari_user_step)],
+            INPUT_KODE_UNIK: [MessageHandler(Filters.text & ~Filters.command, input_kode_unik_step)],
+            ADMIN_GENERATE_KODE: [MessageHandler(Filters.text & ~Filters.command, admin_generate_kode_step)],
+            ADMIN_IMPORT_MUTASI: [MessageHandler(Filters.document, admin_import_mutasi_step)],
         },
         fallbacks=[
             CommandHandler('start', start),
@@ -1605,6 +3860,7 @@ def main():
     updater.start_polling()
     logger.info("Bot started polling...")
     updater.idle()
+    close_all_conn()
 
 if __name__ == "__main__":
     main()
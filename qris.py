@@ -0,0 +1,147 @@
+"""QRIS dinamis tanpa API eksternal.
+
+Payload QRIS statis (format EMVCo: rangkaian TLV "tag(2) panjang(2) nilai") diubah menjadi
+QRIS dinamis dengan mengganti point of initiation (tag 01) menjadi "12", menyisipkan nominal
+(tag 54) sebelum kode negara (tag 58), lalu menghitung ulang CRC16-CCITT (tag 63).
+Gambar PNG dibuat dengan library `qrcode` (+ `pypng`) bila terpasang.
+
+Jalankan `python qris.py` untuk mengecek implementasi terhadap payload contoh.
+"""
+import io
+
+try:
+    import qrcode
+    from qrcode.image.pure import PyPNGImage
+except ImportError:
+    qrcode = None
+
+RENDER_TERSEDIA = qrcode is not None
+
+TAG_POINT_OF_INITIATION = "01"
+TAG_NOMINAL = "54"
+TAG_NEGARA = "58"
+TAG_CRC = "63"
+
+
+class QrisError(ValueError):
+    pass
+
+
+def crc16_ccitt(data):
+    """CRC16-CCITT (poly 0x1021, init 0xFFFF) seperti yang diwajibkan EMVCo untuk tag 63."""
+    crc = 0xFFFF
+    for byte in data:
+        crc ^= byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else crc << 1
+            crc &= 0xFFFF
+    return crc
+
+
+def hitung_crc(payload_tanpa_crc):
+    """Nilai tag 63 untuk payload yang sudah diakhiri "6304"."""
+    return f"{crc16_ccitt(payload_tanpa_crc.encode('utf-8')):04X}"
+
+
+def parse_tlv(payload):
+    """Pecah payload menjadi [(tag, nilai)] level teratas. Panjang dihitung per karakter."""
+    items = []
+    i = 0
+    while i < len(payload):
+        tag, panjang = payload[i:i + 2], payload[i + 2:i + 4]
+        if len(tag) < 2 or not tag.isdigit() or len(panjang) < 2 or not panjang.isdigit():
+            raise QrisError(f"TLV rusak di posisi {i}")
+        akhir = i + 4 + int(panjang)
+        if akhir > len(payload):
+            raise QrisError(f"Panjang tag {tag} melebihi payload")
+        items.append((tag, payload[i + 4:akhir]))
+        i = akhir
+    return items
+
+
+def susun_tlv(items):
+    return "".join(f"{tag}{len(nilai):02d}{nilai}" for tag, nilai in items)
+
+
+def validasi_qris(payload):
+    """Parse payload QRIS lengkap dan cek CRC-nya. Mengembalikan [(tag, nilai)] tanpa tag 63."""
+    payload = payload.strip()
+    items = parse_tlv(payload)
+    if not items or items[-1][0] != TAG_CRC or len(items[-1][1]) != 4:
+        raise QrisError("Tag CRC (63) tidak ada di akhir payload")
+    if hitung_crc(payload[:-4]) != items[-1][1].upper():
+        raise QrisError("CRC payload tidak cocok")
+    return items[:-1]
+
+
+def qris_dinamis(qris_statis, nominal):
+    """Payload QRIS dinamis untuk nominal (rupiah, bilangan bulat) dari payload QRIS statis."""
+    nominal = int(nominal)
+    if nominal <= 0 or len(str(nominal)) > 13:
+        raise QrisError(f"Nominal tidak valid: {nominal}")
+    items = [(tag, nilai) for tag, nilai in validasi_qris(qris_statis) if tag != TAG_NOMINAL]
+    items = [(tag, "12" if tag == TAG_POINT_OF_INITIATION else nilai) for tag, nilai in items]
+    posisi = next((i for i, (tag, _) in enumerate(items) if tag == TAG_NEGARA), len(items))
+    items.insert(posisi, (TAG_NOMINAL, str(nominal)))
+    payload = susun_tlv(items) + TAG_CRC + "04"
+    return payload + hitung_crc(payload)
+
+
+def render_png(payload, box_size=8, border=4):
+    """Gambar QR code payload dalam bentuk PNG (bytes)."""
+    if qrcode is None:
+        raise QrisError("Library qrcode belum terpasang")
+    qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_M, box_size=box_size, border=border)
+    qr.add_data(payload)
+    qr.make(fit=True)
+    buf = io.BytesIO()
+    qr.make_image(image_factory=PyPNGImage).save(buf)
+    return buf.getvalue()
+
+
+# Payload contoh EMVCo QR Code Specification for Payment Systems (Merchant-Presented Mode)
+_CONTOH_EMVCO = (
+    "00020101021229300012D156000000000510A93FO3230Q31280012D15600000001030812345678520441115802CN"
+    "5914BEST TRANSPORT6007BEIJING64200002ZH0104最佳运输0202北京540523.7253031565502016233030412340603***"
+    "0708A60086670902ME91320016A0112233449988770708123456786304A13A"
+)
+_CONTOH_STATIS = (
+    "00020101021126570011ID.DANA.WWW011893600915302259148102090225914810303UMI51440014ID.CO.QRIS.WWW"
+    "0215ID10200176114730303UMI5204481453033605802ID5908TOKO AMI6013KOTA SEMARANG61055011162070703A01"
+    "6304"
+)
+
+
+def _cek_contoh():
+    gagal = []
+    if crc16_ccitt(b"123456789") != 0x29B1:
+        gagal.append("CRC16-CCITT check value '123456789'")
+    if dict(validasi_qris(_CONTOH_EMVCO)).get(TAG_NOMINAL) != "23.72":
+        gagal.append("parse contoh EMVCo")
+    statis = _CONTOH_STATIS + hitung_crc(_CONTOH_STATIS)
+    dinamis = qris_dinamis(statis, 10123)
+    harapan = (
+        "00020101021226570011ID.DANA.WWW011893600915302259148102090225914810303UMI51440014ID.CO.QRIS.WWW"
+        "0215ID10200176114730303UMI520448145303360540510123" "5802ID5908TOKO AMI6013KOTA SEMARANG61055011162070703A01"
+        "6304"
+    )
+    if dinamis[:-4] != harapan or dinamis[-4:] != hitung_crc(harapan):
+        gagal.append("konversi statis -> dinamis")
+    if qris_dinamis(dinamis, 10123) != dinamis:
+        gagal.append("konversi ulang QRIS dinamis harus menghasilkan payload yang sama")
+    try:
+        validasi_qris(statis[:-1] + ("0" if statis[-1] != "0" else "1"))
+        gagal.append("CRC salah harus ditolak")
+    except QrisError:
+        pass
+    if RENDER_TERSEDIA and not render_png(dinamis).startswith(b"\x89PNG\r\n\x1a\n"):
+        gagal.append("render PNG")
+    return gagal
+
+
+if __name__ == "__main__":
+    hasil = _cek_contoh()
+    for g in hasil:
+        print(f"[GAGAL] {g}")
+    print(f"{'OK' if not hasil else 'GAGAL'} (render PNG {'aktif' if RENDER_TERSEDIA else 'tidak tersedia'})")
+    raise SystemExit(1 if hasil else 0)
@@ -0,0 +1,119 @@
+"""Parser pesan webhook provider dengan waktu linear.
+
+Format pesan:
+    RC=<reffid> TrxID=<trxid> <produk>.<tujuan> <status> <keterangan> [Saldo ...] [result=<kode>] [>]
+
+Regex lama (RX) memakai quantifier lazy bertumpuk dan [\\s\\S]*? sehingga bisa
+backtracking kuadratik pada pesan panjang/rusak. Di sini bagian kepala tetap
+memakai regex ter-anchor tanpa ambiguitas, sedangkan ekor pesan (keterangan,
+Saldo, result=) dipindai manual sekali jalan.
+"""
+import re
+from typing import NamedTuple, Optional
+
+# Kelas karakter tiap token saling lepas, jadi match kepala tidak pernah backtracking bertingkat
+_KEPALA = re.compile(
+    r'RC=(?P<reffid>[a-f0-9-]+)\s+TrxID=(?P<trxid>\d+)\s+'
+    r'(?P<produk>[A-Z0-9]+)\.(?P<tujuan>\d+)\s+'
+    r'(?P<status_text>[A-Za-z]+)\s*',
+    re.I
+)
+
+
+class PesanWebhook(NamedTuple):
+    reffid: str
+    trxid: str
+    produk: str
+    tujuan: str
+    status_text: str
+    keterangan: str
+    status_code: Optional[str]
+
+
+def _huruf_kata(ch):
+    # Padanan \w pada regex: huruf/angka unicode dan underscore
+    return ch.isalnum() or ch == "_"
+
+
+def _akhir_isi(ekor):
+    """Index awal penutup `\\s*>?$` (boleh diakhiri satu newline)."""
+    e = len(ekor)
+    if e and ekor[e - 1] == "\n":
+        e -= 1
+    if e and ekor[e - 1] == ">":
+        e -= 1
+    while e and ekor[e - 1].isspace():
+        e -= 1
+    return e
+
+
+def _cari_result(ekor, akhir):
+    """Cari `result=<angka>` tepat di akhir isi. Return (index_awal, kode) atau (None, None)."""
+    j = akhir
+    while j and ekor[j - 1].isdecimal():
+        j -= 1
+    awal = j - 7
+    if j == akhir or awal < 1 or ekor[awal:j].lower() != "result=":
+        return None, None
+    # \bresult: karakter sebelumnya harus bukan huruf kata
+    if _huruf_kata(ekor[awal - 1]):
+        return None, None
+    return awal, ekor[j:akhir]
+
+
+def _cari_saldo(ekor, batas):
+    """Index awal spasi pertama (>= 1) yang diikuti kata 'Saldo', atau None bila tidak ada sebelum batas."""
+    n = len(ekor)
+    i = 1
+    while i < batas:
+        if ekor[i].isspace():
+            j = i
+            while j < n and ekor[j].isspace():
+                j += 1
+            if ekor[j:j + 5].lower() == "saldo":
+                return i
+            i = j
+        else:
+            i += 1
+    return None
+
+
+def parse_pesan_webhook(message):
+    """Parse pesan webhook provider menjadi PesanWebhook, atau None bila format tidak dikenali.
+
+    Hasilnya sama dengan RX lama, kecuali pesan tanpa keterangan: RX lama memotong huruf
+    terakhir status menjadi keterangan (atau gagal bila 'Saldo' ada di baris berikutnya),
+    di sini keterangan kosong. Lihat bench_webhook_parser.py untuk korpus dan pembandingnya.
+    """
+    if not message:
+        return None
+    m = _KEPALA.match(message)
+    if not m:
+        return None
+    ekor = message[m.end():]
+
+    # Seperti RX lama, keterangan minimal satu karakter bila ekor tidak kosong (mis. hanya ">")
+    akhir = max(_akhir_isi(ekor), min(len(ekor), 1))
+    awal_result, status_code = _cari_result(ekor, akhir)
+    batas = awal_result if awal_result is not None else akhir
+    awal_saldo = _cari_saldo(ekor, batas)
+    if awal_saldo is not None:
+        batas = awal_saldo
+
+    keterangan = ekor[:batas]
+    # Keterangan hanya satu baris; baris berikutnya hanya boleh muncul setelah 'Saldo'
+    if "\n" in keterangan:
+        # Kecuali keterangan kosong: status langsung disusul baris 'Saldo ...'
+        if m.end() > m.end("status_text") and ekor[:5].lower() == "saldo":
+            keterangan = ""
+        else:
+            return None
+    return PesanWebhook(
+        reffid=m.group("reffid"),
+        trxid=m.group("trxid"),
+        produk=m.group("produk"),
+        tujuan=m.group("tujuan"),
+        status_text=m.group("status_text"),
+        keterangan=keterangan.strip(),
+        status_code=status_code,
+    )